@@ -22,3 +22,11 @@ __copyright__ = 'Copyright 2018 Joya Communications, John Loehrer'
 
 from .version import __version__  # noqa
 from .api import *  # noqa
+from .breaker import *  # noqa
+from .codec import *  # noqa
+from .events import *  # noqa
+from .limits import *  # noqa
+from .metrics import *  # noqa
+from .retry import *  # noqa
+from .tokens import *  # noqa
+from .campaign import *  # noqa
@@ -0,0 +1,419 @@
+# Copyright 2018 Joya Communications, John Loehrer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+asyncio client for FCM, requires python 3.6+ and `aiohttp
+<https://docs.aiohttp.org>`_::
+
+    pip install fcm-client[async]
+
+This module is not imported by :mod:`fcmclient`, import it explicitly::
+
+    from fcmclient.aio import AsyncFCM
+"""
+
+import asyncio
+import logging
+
+import aiohttp
+
+from .api import FCM, FCM_URL, MAX_MULTICAST, BulkResult, _token_set
+from .breaker import CircuitOpenError
+from .codec import DEFAULT_COMPRESS_LEVEL, get_codec
+from .events import RequestEvent, emit, _clock
+from .limits import is_congested
+from .retry import RetryScheduler
+
+__all__ = ('AsyncFCM', 'AsyncRetryScheduler')
+
+log = logging.getLogger(__name__)
+
+#: Default number of pooled connections per :class:`AsyncFCM` client.
+DEFAULT_ASYNC_POOL_SIZE = 100
+
+
+class _Response(object):
+    """ Buffered aiohttp response, exposing what :class:`Result` reads. """
+
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+
+class AsyncFCM(object):
+    """
+    AsyncFCM
+
+    asyncio counterpart of :class:`fcmclient.FCM`, returning the same
+    :class:`fcmclient.Result` objects.
+    """
+
+    # Initial backoff in milliseconds
+    INITIAL_BACKOFF = FCM.INITIAL_BACKOFF
+
+    def __init__(self, api_key, url=FCM_URL, backoff=INITIAL_BACKOFF,
+                 pool_size=DEFAULT_ASYNC_POOL_SIZE, max_in_flight=None,
+                 codec=None, limiter=None, rate_limiter=None, breaker=None,
+                 observers=None, token_cache=None, compress_threshold=None,
+                 compress_level=DEFAULT_COMPRESS_LEVEL, **options):
+        """
+        Create new client.
+
+        The underlying `aiohttp.ClientSession` is created on first use, so
+        the client may be constructed outside of the event loop. It has to
+        be used from one event loop only. Call :func:`close` or use the
+        client as an async context manager to release the connections.
+
+        :param api_key: (str) Google API key
+        :param url: (str) FCM server URL.
+        :param backoff: (int) initial backoff in milliseconds.
+        :param pool_size: (int) max number of open connections.
+        :param max_in_flight: (int) max number of concurrent requests,
+            defaults to `pool_size`.
+        :param codec: (str or object) JSON codec, see :mod:`fcmclient.codec`.
+        :param limiter: (:class:`fcmclient.AdaptiveLimiter`) adapts the
+            number of requests in flight to what FCM can take, below
+            `max_in_flight`.
+        :param rate_limiter: (:class:`fcmclient.RateLimiter`) keeps requests
+            and registration ID's per second within a budget.
+        :param breaker: (:class:`fcmclient.CircuitBreaker`) stops sending
+            while FCM is down or asked to back off with ``Retry-After``.
+        :param observers: (list) callables receiving a
+            :class:`fcmclient.RequestEvent` for every request, see
+            :mod:`fcmclient.events`. The ``limiter`` timing includes the
+            wait for `max_in_flight`.
+        :param token_cache: (:class:`fcmclient.TokenCache`) skips dead
+            registration ID's and sends to canonical ID's instead.
+        :param compress_threshold: (int) gzip request bodies of at least
+            this many bytes. Off by default.
+        :param compress_level: (int) gzip compression level.
+        :param options: (kwargs) options for `aiohttp.ClientSession.post`
+        """
+        if not api_key:
+            raise ValueError("Google API key is required")
+
+        self.api_key = api_key
+        self.url = url
+        self.backoff = backoff
+        self.pool_size = pool_size
+        self.max_in_flight = max_in_flight or pool_size
+        self.codec = get_codec(codec)
+        self.limiter = limiter
+        self.rate_limiter = rate_limiter
+        self.breaker = breaker
+        self.observers = list(observers or ())
+        self.token_cache = token_cache
+        self.compress_threshold = compress_threshold
+        self.compress_level = compress_level
+        self.request_options = options
+        self._session = None
+        self._semaphore = None
+        self._limiter_cond = None
+
+    @property
+    def session(self):
+        """ The `aiohttp.ClientSession`, created on first access. """
+        if self._session is None:
+            connector = aiohttp.TCPConnector(limit=self.pool_size)
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                headers={
+                    'Authorization': 'key=%s' % self.api_key,
+                    'Content-Type': 'application/json',
+                    'Accept-Encoding': 'gzip',
+                })
+        return self._session
+
+    @property
+    def semaphore(self):
+        """ Semaphore limiting the number of requests in flight. """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_in_flight)
+        return self._semaphore
+
+    async def close(self):
+        """ Close all pooled connections. """
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    async def send(self, message):
+        """
+        Send message, see :func:`fcmclient.FCM.send`.
+
+        Waits for a free slot if `max_in_flight` requests are already
+        running.
+
+        :Raises:
+            - ``aiohttp.ClientError`` or ``asyncio.TimeoutError`` on any
+              network problem.
+            - :class:`fcmclient.CircuitOpenError` while the `breaker` is
+              open.
+            - ``ValueError`` if your FCM request or response is rejected.
+            - :class:`FCMAuthenticationError` your API key is invalid.
+        """
+        filtered = self._prepare(message)
+        if filtered is None:
+            return BulkResult(message, [], self.backoff)
+        return await self._deliver(filtered)
+
+    _prepare = FCM._prepare
+    _compress = FCM._compress
+
+    async def _deliver(self, message):
+        """ Send message as it is and report the result. """
+        if self.observers:
+            result = await self._send_observed(message)
+        else:
+            result = await self._send(message)
+        if self.token_cache is not None:
+            self.token_cache.update(result)
+        return result
+
+    async def _send_observed(self, message):
+        event = RequestEvent('request', message)
+        started = _clock()
+        try:
+            result = await self._send(message, event)
+        except Exception as e:
+            event.error = e
+            raise
+        else:
+            event._set_result(result)
+            return result
+        finally:
+            event.timings['total'] = _clock() - started
+            emit(self.observers, event)
+
+    async def _send(self, message, event=None):
+        """ Send message within the limits, recording timings in `event`.
+        """
+        breaker = self.breaker
+        if breaker is not None:
+            admitted = breaker.before_send()
+
+        if self.rate_limiter is not None:
+            wait = self.rate_limiter.reserve(len(message.registration_ids))
+            if wait > 0:
+                await asyncio.sleep(wait)
+            if event is not None:
+                event.timings['rate_limit'] = max(0.0, wait)
+
+        if self.limiter is None and breaker is None:
+            return await self._post(message, event)
+
+        started = None
+        if self.limiter is not None:
+            waiting = _clock()
+            started = await self._acquire()
+            if event is not None:
+                event.timings['limiter'] = _clock() - waiting
+        congested = retry_after = None
+        try:
+            result = await self._post(message, event)
+            congested = is_congested(result)
+            retry_after = result.retry_after
+            return result
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            congested = True
+            raise
+        finally:
+            if self.limiter is not None:
+                self.limiter.release(started, congested)
+                async with self._limiter_cond:
+                    self._limiter_cond.notify_all()
+            if breaker is not None:
+                breaker.record(congested, retry_after, admitted)
+
+    async def _acquire(self):
+        """ Wait until the limiter has a free slot. """
+        if self._limiter_cond is None:
+            self._limiter_cond = asyncio.Condition()
+
+        async with self._limiter_cond:
+            while True:
+                started = self.limiter.try_acquire()
+                if started is not None:
+                    return started
+                await self._limiter_cond.wait()
+
+    async def _post(self, message, event=None):
+        """ Post message to FCM and interpret the response. """
+        if event is None:
+            data, headers = self._compress(message.encode(self.codec))
+            async with self.semaphore:
+                async with self.session.post(
+                        self.url, data=data, headers=headers,
+                        **self.request_options) as resp:
+                    content = await resp.read()
+
+            response = _Response(resp.status, resp.headers, content)
+            return message._result(response, self.backoff, codec=self.codec)
+
+        timings = event.timings
+        started = _clock()
+        data = message.encode(self.codec)
+        timings['encode'] = _clock() - started
+        data, headers = self._compress(data, event)
+        event.payload_bytes = len(data)
+        encoded = _clock()
+        async with self.semaphore:
+            sending = _clock()
+            timings['limiter'] = timings.get('limiter', 0.0) + \
+                sending - encoded
+            async with self.session.post(
+                    self.url, data=data, headers=headers,
+                    **self.request_options) as resp:
+                responded = _clock()
+                timings['request'] = responded - sending
+                content = await resp.read()
+                received = _clock()
+                timings['read'] = received - responded
+
+        event.status_code = resp.status
+        response = _Response(resp.status, resp.headers, content)
+        try:
+            return message._result(response, self.backoff, codec=self.codec)
+        finally:
+            timings['decode'] = _clock() - received
+
+    async def send_many(self, message, chunk_size=MAX_MULTICAST,
+                        dedupe=False):
+        """
+        Send message to any number of registration ID's, see
+        :func:`fcmclient.FCM.send_many`. Concurrency is bounded by
+        `max_in_flight`.
+        """
+        seen = _token_set(dedupe, len(message.registration_ids))
+        filtered = self._prepare(message, seen)
+        if filtered is None:
+            return BulkResult(message, [], self.backoff)
+        chunks = list(filtered.split(chunk_size))
+        results = await asyncio.gather(
+            *[self._send_chunk(chunk, self._deliver) for chunk in chunks])
+        return BulkResult(filtered, list(results), self.backoff)
+
+    async def iter_send(self, messages, dedupe=False):
+        """
+        Send messages concurrently, yielding a :class:`fcmclient.Result` for
+        each one as soon as it completes, see :func:`fcmclient.FCM.iter_send`.
+
+        Only `max_in_flight` messages are pulled from `messages` ahead of the
+        completed ones, so lazy sources like
+        :func:`fcmclient.JSONMessage.stream` are never materialized.
+        """
+        send = self.send
+        seen = _token_set(dedupe)
+        if seen is not None:
+            filtered = (self._prepare(message, seen) for message in messages)
+            messages = (message for message in filtered if message is not None)
+            send = self._deliver
+
+        pending = set()
+        try:
+            for message in messages:
+                pending.add(
+                    asyncio.ensure_future(self._send_chunk(message, send)))
+                if len(pending) < self.max_in_flight:
+                    continue
+
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    yield task.result()
+
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    yield task.result()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def _send_chunk(self, message, send=None):
+        """ Send message, turning network problems into a retry result. """
+        try:
+            return await (send or self.send)(message)
+        except (aiohttp.ClientError, asyncio.TimeoutError,
+                CircuitOpenError) as e:
+            return message._result(None, self.backoff, error=e)
+
+
+class AsyncRetryScheduler(RetryScheduler):
+    """
+    :class:`fcmclient.RetryScheduler` for :class:`AsyncFCM`, sending due
+    retries from :func:`run` on the event loop instead of threads.
+    Concurrency is bounded by the `max_in_flight` of the client.
+    """
+
+    def __init__(self, fcm, **kwargs):
+        super(AsyncRetryScheduler, self).__init__(fcm, **kwargs)
+        self._wakeup = None
+
+    def add(self, result, attempt=0):
+        scheduled = super(AsyncRetryScheduler, self).add(result, attempt)
+        if scheduled and self._wakeup is not None:
+            self._wakeup.set()
+        return scheduled
+
+    def start(self):
+        raise TypeError("AsyncRetryScheduler is driven by run()")
+
+    def stop(self, wait=True):
+        """ Make :func:`run` return once in-flight retries are done. """
+        self._stopped = True
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def run(self):
+        """ Send due retries until :func:`stop` is called. """
+        self._stopped = False
+        self._wakeup = asyncio.Event()
+        tasks = set()
+        try:
+            while not self._stopped:
+                self._wakeup.clear()
+                for message, attempt in self.pop_due():
+                    task = asyncio.ensure_future(self._send(message, attempt))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+
+                next_due = self.next_due()
+                timeout = None
+                if next_due is not None:
+                    timeout = max(0, next_due - self.clock())
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self._wakeup = None
+            if tasks:
+                await asyncio.wait(tasks)
+
+    async def _send(self, message, attempt):
+        try:
+            result = await self.fcm._send_chunk(message)
+        except Exception:
+            log.exception("Retry of %d registration ID's failed",
+                          len(message.registration_ids))
+            return
+        self.handle(result, attempt)
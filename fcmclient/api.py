@@ -12,17 +12,55 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import array
+import collections
+import itertools
+import json
 import random
+import re
+import time
+from concurrent import futures
 import requests
+import requests.adapters
 import six
+from six.moves import collections_abc
+from .codec import DEFAULT_CODEC, DEFAULT_COMPRESS_LEVEL, get_codec, \
+    gzip_compress
+from .events import RequestEvent, emit
+from .limits import is_congested
+from .tokens import TokenSet
 
 # all you need
-__all__ = ('FCMAuthenticationError', 'JSONMessage', 'FCM', 'Result')
+__all__ = ('FCMAuthenticationError', 'JSONMessage', 'TopicMessage', 'FCM',
+           'Result', 'BulkResult', 'TopicResult', 'coalesce')
 
 # More info: http://developer.android.com/google/fcm/fcm.html
 #: Default URL to FCM service.
 FCM_URL = 'https://fcm.googleapis.com/fcm/send'
 
+#: Default number of pooled keep-alive connections per :class:`FCM` client.
+DEFAULT_POOL_SIZE = 10
+
+#: Default max concurrent streams per connection with ``http2=True``.
+DEFAULT_MAX_STREAMS = 100
+
+#: Cap on the default number of threads sending in parallel with
+#: ``http2=True``, pass `concurrency` explicitly to go beyond it.
+DEFAULT_MAX_CONCURRENCY = 64
+
+#: Max number of registration ID's FCM accepts in one multicast.
+MAX_MULTICAST = 1000
+
+#: Prefix of topic names in the ``to`` field.
+TOPIC_PREFIX = '/topics/'
+
+_TOPIC_NAME = re.compile(r'^[a-zA-Z0-9\-_.~%]+$')
+
+_clock = getattr(time, 'monotonic', time.time)
+
+# headers of a compressed request body
+_GZIP_HEADERS = {'Content-Encoding': 'gzip'}
+
 
 class FCMAuthenticationError(ValueError):
     """ Raised if your Google API key is rejected. """
@@ -44,8 +82,13 @@ class JSONMessage(object):
         'dry_run': bool,
     }
 
+    # pre-encoded request body up to the registration ID's, see `template`
+    _template = None
+    _body = None
+
     def __init__(self, registration_ids, data=None, message_title=None,
-                 message_body=None, payload=None, **options):
+                 message_body=None, payload=None, template=False,
+                 **options):
         """ Multicast message, uses JSON format.
 
             :Arguments:
@@ -54,6 +97,8 @@ class JSONMessage(object):
                 - `data` (dict): key-value pairs, payload of this message.
                 - `message_title` (str): a title for the notification
                 - `message_body` (str): the message body of the alert.
+                - `template` (bool): encode everything but the
+                    registration ID's once, see :func:`encode`.
                 - `options` (dict): FCM options.
 
             Refer to `FCM <http://developer.android.com/google/fcm/fcm.html
@@ -71,6 +116,22 @@ class JSONMessage(object):
         if not registration_ids:
             raise ValueError("Empty registration_ids list")
 
+        payload = self._build_payload(
+            payload, data, message_title, message_body, options)
+
+        if not isinstance(registration_ids, (list, tuple)):
+            registration_ids = list(registration_ids)
+
+        payload['registration_ids'] = registration_ids
+
+        self.payload = payload
+
+        if template:
+            self._template = self._encode_template(payload)
+
+    def _build_payload(self, payload, data, message_title, message_body,
+                       options):
+        """ Payload of all but the target of the message. """
         if payload is None:
             payload = {}
 
@@ -94,12 +155,33 @@ class JSONMessage(object):
             if message_body is not None:
                 payload['notification']['text'] = message_body
 
-        if not isinstance(registration_ids, (list, tuple)):
-            registration_ids = list(registration_ids)
-
-        payload['registration_ids'] = registration_ids
+        return payload
 
-        self.payload = payload
+    @staticmethod
+    def _encode_template(payload):
+        """ Encode all of `payload` but the registration ID's, leaving the
+            JSON object open for them to be appended.
+        """
+        base = {k: v for k, v in payload.items() if k != 'registration_ids'}
+        if not base:
+            return b'{"registration_ids":'
+        return DEFAULT_CODEC.dumps(base)[:-1] + b',"registration_ids":'
+
+    def encode(self, codec=DEFAULT_CODEC):
+        """ Request body as JSON encoded bytes.
+
+            In template mode, the part of the payload that is shared with
+            chunks and retries of this message is encoded only once, and
+            just the registration ID's are spliced in per message. The body
+            is kept, so resending the same message is free. The payload
+            must not be modified after construction in this mode.
+        """
+        if self._template is None:
+            return codec.dumps(self.payload)
+        if self._body is None:
+            self._body = (self._template +
+                          codec.dumps(self.registration_ids) + b'}')
+        return self._body
 
     @property
     def registration_ids(self):
@@ -136,9 +218,47 @@ class JSONMessage(object):
         """ Create new message for given unavailable ID's list. """
         payload = {k: v for k, v in self.payload.items()}
         payload.pop('registration_ids', None)
-        return self.__class__(
+        message = self.__class__(
             unavailable,
             payload=payload)
+        message._template = self._template
+        return message
+
+    @classmethod
+    def stream(cls, registration_ids, chunk_size=MAX_MULTICAST, **kwargs):
+        """ Lazily build messages of at most `chunk_size` registration ID's
+            each from any iterable, such as a generator or DB cursor.
+
+            Registration ID's are pulled one chunk at a time, so the whole
+            audience is never held in memory. All messages share the payload
+            built from `kwargs`, which are the remaining arguments of
+            :class:`JSONMessage`. Feed the messages to :func:`FCM.iter_send`.
+        """
+        registration_ids = iter(registration_ids)
+        chunk = list(itertools.islice(registration_ids, chunk_size))
+        if not chunk:
+            return
+
+        base = cls(chunk, **kwargs)
+        yield base
+
+        while True:
+            chunk = list(itertools.islice(registration_ids, chunk_size))
+            if not chunk:
+                return
+            yield base._retry(chunk)
+
+    def split(self, chunk_size=MAX_MULTICAST):
+        """ Split into messages of at most `chunk_size` registration ID's,
+            sharing payload and options of this message.
+        """
+        registration_ids = self.registration_ids
+        if len(registration_ids) <= chunk_size:
+            yield self
+            return
+
+        for i in range(0, len(registration_ids), chunk_size):
+            yield self._retry(registration_ids[i:i + chunk_size])
 
     def __getstate__(self):
         """
@@ -164,6 +284,254 @@ class JSONMessage(object):
         """ Overwrite message state with given kwargs. """
         self.payload = state
 
+    def _payload_key(self):
+        """ Hashable key, equal for messages that only differ in their
+            registration ID's.
+        """
+        template = self._template
+        if template is None:
+            base = {k: v for k, v in self.payload.items()
+                    if k != 'registration_ids'}
+            template = json.dumps(base, sort_keys=True)
+        return type(self), template
+
+    def _result(self, response, backoff, error=None, codec=DEFAULT_CODEC):
+        """ Interpret the FCM response to this message. """
+        return Result(self, response, backoff, error=error, codec=codec)
+
+
+class TopicMessage(JSONMessage):
+    """ Message to the devices subscribed to a topic, or to a condition on
+        topics, fanned out to them by FCM. """
+
+    def __init__(self, topic=None, data=None, message_title=None,
+                 message_body=None, condition=None, payload=None,
+                 **options):
+        """ Topic message, uses JSON format.
+
+            :Arguments:
+                - `topic` (str): topic name, with or without the
+                    ``/topics/`` prefix.
+                - `condition` (str): condition on topics instead of a
+                    topic, like ``"'dogs' in topics || 'cats' in topics"``.
+
+            The other arguments are those of :class:`JSONMessage`.
+        """
+        payload = self._build_payload(
+            payload, data, message_title, message_body, options)
+
+        if topic is not None:
+            if not topic.startswith(TOPIC_PREFIX):
+                topic = TOPIC_PREFIX + topic
+            if not _TOPIC_NAME.match(topic[len(TOPIC_PREFIX):]):
+                raise ValueError("Invalid topic name: %s" % topic)
+            payload['to'] = topic
+        if condition is not None:
+            payload['condition'] = condition
+        if ('to' in payload) == ('condition' in payload):
+            raise ValueError("Expected either a topic or a condition")
+
+        self.payload = payload
+
+    @property
+    def registration_ids(self):
+        """ No registration ID's, FCM looks up the devices. """
+        return ()
+
+    @property
+    def topic(self):
+        return self.payload.get('to')
+
+    @property
+    def condition(self):
+        return self.payload.get('condition')
+
+    def _retry(self, unavailable):
+        return self
+
+    def _payload_key(self):
+        # never merged with other messages
+        return type(self), id(self)
+
+    def _result(self, response, backoff, error=None, codec=DEFAULT_CODEC):
+        return TopicResult(self, response, backoff, error=error, codec=codec)
+
+
+def coalesce(messages, chunk_size=MAX_MULTICAST):
+    """
+    Merge messages with identical payload and options into as few messages
+    of at most `chunk_size` registration ID's as possible.
+
+    Typically used on retry messages, which only carry the few registration
+    ID's that were unavailable. Order of first appearance is kept.
+
+    :param messages: (iterable) :class:`JSONMessage` objects.
+    :param chunk_size: (int) max registration ID's per merged message.
+    :return: list of messages.
+    """
+    groups = collections.OrderedDict()
+    for message in messages:
+        key = message._payload_key()
+        if key in groups:
+            groups[key][1].extend(message.registration_ids)
+        else:
+            groups[key] = (message, list(message.registration_ids))
+
+    merged = []
+    for first, registration_ids in groups.values():
+        if len(registration_ids) == len(first.registration_ids):
+            merged.extend(first.split(chunk_size))
+            continue
+        for i in range(0, len(registration_ids), chunk_size):
+            merged.append(first._retry(registration_ids[i:i + chunk_size]))
+    return merged
+
+
+#: Per registration ID status codes of a :class:`Result`.
+STATUS_SUCCESS = 0
+STATUS_RETRY = 1
+STATUS_NOT_REGISTERED = 2
+STATUS_FAILED = 3
+
+#: Errors after which FCM says the registration ID may be retried.
+RETRY_ERRORS = frozenset(['Unavailable', 'InternalServerError'])
+
+#: Errors after which FCM says a topic message may be retried.
+TOPIC_RETRY_ERRORS = RETRY_ERRORS | frozenset(['TopicsMessageRateExceeded'])
+
+# separates message ID's, which FCM never puts in them
+_MESSAGE_ID_SEP = '\n'
+
+# retry message is not built yet
+_UNSET = object()
+
+
+class _Decoded(object):
+    """ Codec of a response that is decoded already. """
+
+    @staticmethod
+    def loads(data):
+        return data
+
+
+_DECODED = _Decoded()
+
+
+class _SuccessView(collections_abc.Mapping):
+    """ Read-only ``{registration_id: message_id}`` view of results.
+
+        Looking up a single registration ID scans the results, convert the
+        view with ``dict()`` if you need many lookups.
+    """
+    __slots__ = ('_results',)
+
+    def __init__(self, results):
+        self._results = results
+
+    def _iteritems(self):
+        for res in self._results:
+            registration_ids, status, message_ids, _, _ = res._compact()
+            if not message_ids:
+                continue
+            indices = (i for i, code in enumerate(status)
+                       if code == STATUS_SUCCESS)
+            for i, message_id in six.moves.zip(
+                    indices, message_ids.split(_MESSAGE_ID_SEP)):
+                yield registration_ids[i], message_id
+
+    def __getitem__(self, key):
+        for reg_id, value in self._iteritems():
+            if reg_id == key:
+                return value
+        raise KeyError(key)
+
+    def __iter__(self):
+        return (reg_id for reg_id, _ in self._iteritems())
+
+    def __len__(self):
+        return sum(res._compact()[1].count(STATUS_SUCCESS)
+                   for res in self._results)
+
+    def items(self):
+        return _ItemsView(self)
+
+    def values(self):
+        return _ValuesView(self)
+
+    def __repr__(self):
+        return repr(dict(self._iteritems()))
+
+
+class _SparseView(_SuccessView):
+    """ Read-only view of ``{index: value}`` mappings of results, keyed by
+        registration ID.
+    """
+    __slots__ = ('_field',)
+
+    def __init__(self, results, field):
+        super(_SparseView, self).__init__(results)
+        self._field = field
+
+    def _iteritems(self):
+        for res in self._results:
+            registration_ids = res._compact()[0]
+            values = getattr(res, self._field)
+            for i, value in sorted(six.iteritems(values)):
+                yield registration_ids[i], value
+
+    def __len__(self):
+        count = 0
+        for res in self._results:
+            res._compact()
+            count += len(getattr(res, self._field))
+        return count
+
+
+class _ItemsView(collections_abc.ItemsView):
+    def __iter__(self):
+        return self._mapping._iteritems()
+
+
+class _ValuesView(collections_abc.ValuesView):
+    def __iter__(self):
+        return (value for _, value in self._mapping._iteritems())
+
+
+class _StatusView(collections_abc.Sequence):
+    """ Read-only list view of registration ID's with the given status. """
+    __slots__ = ('_results', '_status')
+
+    def __init__(self, results, status):
+        self._results = results
+        self._status = status
+
+    def __iter__(self):
+        for res in self._results:
+            registration_ids, status = res._compact()[:2]
+            for i, code in enumerate(status):
+                if code == self._status:
+                    yield registration_ids[i]
+
+    def __getitem__(self, index):
+        return list(self)[index]
+
+    def __len__(self):
+        return sum(res._compact()[1].count(self._status)
+                   for res in self._results)
+
+    def __eq__(self, other):
+        if not isinstance(other, collections_abc.Sequence):
+            return NotImplemented
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(list(self))
+
 
 class Result(object):
     """
@@ -173,9 +541,51 @@ class Result(object):
     recoverably failed, then :func:`retry` will provide you with new
     message. You have to wait :func:`delay` seconds before attempting a new
     request.
+
+    The :attr:`success_count`, :attr:`failure_count` and
+    :attr:`canonical_count` attributes are taken straight from the FCM
+    response. Of an all success response, only the message ID's are kept.
+
+    Details are stored compactly as one status code per registration ID,
+    referring to the registration ID's of the message by index. The
+    :attr:`success`, :attr:`canonical`, :attr:`not_registered` and
+    :attr:`failed` properties are read-only views on them. The views are
+    not ``dict`` or ``list`` objects, and looking up a registration ID scans
+    the results: convert them with ``dict()`` or ``list()`` for repeated
+    lookups or to serialize them with ``json.dumps``.
     """
+    __slots__ = (
+        'message', 'error', 'status_code', 'retry_after', 'multicast_id',
+        'success_count', 'failure_count', 'canonical_count',
+        '_random', '_backoff', '_status', '_message_ids', '_canonical_ids',
+        '_failed_ids', '_error_counts', '_retry_message',
+    )
+
+    def __init__(self, message, response, backoff, error=None,
+                 codec=DEFAULT_CODEC):
+        """
+        :param message: (:class:`JSONMessage`) the message that was sent.
+        :param response: (`requests.Response`) FCM response, or None if
+            the request failed before a response was received.
+        :param backoff: (int) initial backoff in milliseconds.
+        :param error: (Exception) why there is no response.
+        :param codec: JSON codec to decode the response with.
+        """
+        self.message = message
+        self.error = error
+        self.status_code = None
+        self._random = None
+        self._backoff = backoff
+        self._retry_message = _UNSET
+        self.retry_after = None
+        self.multicast_id = None
 
-    def __init__(self, message, response, backoff):
+        if response is None:
+            # nothing was delivered, whole message has to be retried. An
+            # open circuit tells when it is worth trying again.
+            self.retry_after = getattr(error, 'retry_after', None)
+            self._set_retry_all(message)
+            return
 
         # invalid JSON. Body contains explanation. Happens if options are
         # invalid.
@@ -191,13 +601,10 @@ class Result(object):
             raise RuntimeError(
                 "Unknown status code: {0}".format(response.status_code))
 
-        self.message = message
-        self._random = None
-        self._backoff = backoff
-
+        self.status_code = response.status_code
         try:
             # on failures, retry-after
-            self.retry_after = response.headers.get('Retry-After', 0)
+            self.retry_after = int(response.headers.get('Retry-After', 0))
             if self.retry_after < 1:
                 self.retry_after = None
         except ValueError:
@@ -205,64 +612,136 @@ class Result(object):
 
         if response.status_code != 200:  # For all 5xx Google says "you may
             # retry"
-            self._retry_message = message
-            self._success_ids = {}
-            self._canonical_ids = {}
-            self._not_registered_ids = []
-            self._failed_ids = {}
-        else:
-            info = self._parse_response(response.json())
-            self._success_ids = info['success']
-            self._canonical_ids = info['canonicals']
-            self._not_registered_ids = info['not_registered']
-            self._failed_ids = info['failed']
-
-            # user has to retry anyway, so pre-create
-            unavailable = info.get('unavailable', None)
-            if unavailable:
-                self._retry_message = message._retry(unavailable)
-            else:
-                self._retry_message = None
+            self._set_retry_all(message)
+            return
 
-    def _parse_response(self, data):
-        """ Parse JSON response. """
-        registration_ids = self.message.registration_ids
-        len_reg_ids = len(registration_ids)
-        if 'results' not in data or len(data.get('results')) != len_reg_ids:
+        self._set_response(codec.loads(response.content))
+
+    def _set_response(self, data):
+        """ Take counts and per registration ID details of a decoded FCM
+            response, which is not kept.
+        """
+        self._check_response(data)
+        self.multicast_id = data.get('multicast_id')
+
+        try:
+            self.success_count = int(data['success'])
+            self.failure_count = int(data['failure'])
+            self.canonical_count = int(data['canonical_ids'])
+        except (KeyError, TypeError, ValueError):
+            self._set_details(self._parse_response(data))
+            self.success_count = self._status.count(STATUS_SUCCESS)
+            self.failure_count = len(self._status) - self.success_count
+            self.canonical_count = len(self._canonical_ids)
+            return
+
+        if self.failure_count or self.canonical_count or \
+                not self._set_success(data['results']):
+            self._set_details(self._parse_response(data))
+
+    def _set_success(self, results):
+        """ Compact details of an all success response, just the message
+            ID's, without a full parse.
+
+            :return: False if a result has no message ID after all.
+        """
+        try:
+            message_ids = _MESSAGE_ID_SEP.join(
+                [res['message_id'] for res in results])
+        except (KeyError, TypeError):
+            return False
+        self._status = array.array('b', [STATUS_SUCCESS]) * len(results)
+        self._message_ids = message_ids
+        self._canonical_ids = {}
+        self._failed_ids = {}
+        self._error_counts = {}
+        return True
+
+    def _set_retry_all(self, message):
+        count = len(message.registration_ids)
+        self._retry_message = message
+        self._status = array.array('b', [STATUS_RETRY]) * count
+        self._message_ids = ''
+        self._canonical_ids = {}
+        self._failed_ids = {}
+        self._error_counts = {}
+        self.success_count = 0
+        self.failure_count = count
+        self.canonical_count = 0
+
+    def _check_response(self, data):
+        """ Validate that JSON response covers all registration ID's. """
+        results = data.get('results')
+        if results is None or \
+                len(results) != len(self.message.registration_ids):
             raise ValueError("Invalid response")
 
-        success = {}
+    def _set_details(self, info):
+        """ Take the per registration ID details of :func:`_parse_response`.
+        """
+        self._status = info['status']
+        self._message_ids = info['message_ids']
+        self._canonical_ids = info['canonicals']
+        self._failed_ids = info['failed']
+        self._error_counts = info['error_counts']
+
+    def _compact(self):
+        """ Parsed details as ``(registration_ids, status, message_ids,
+            canonicals, failed)``.
+        """
+        return (self.message.registration_ids, self._status,
+                self._message_ids, self._canonical_ids, self._failed_ids)
+
+    def _parse_response(self, data):
+        """ Parse JSON response into compact per index status codes.
+
+            Message ID's of successful registration ID's are joined into one
+            string in index order, canonical ID's and error codes are kept
+            as ``{index: value}`` only where present.
+        """
+        self._check_response(data)
+        results = data['results']
+
+        status = array.array('b', [STATUS_SUCCESS]) * len(results)
+        message_ids = []
         canonicals = {}
-        unavailable = []
-        not_registered = []
         errors = {}
-        for reg_id, res in zip(registration_ids, data['results']):
-            if 'message_id' in res:
-                success[reg_id] = res['message_id']
+        error_counts = {}
+        for i, res in enumerate(results):
+            message_id = res.get('message_id')
+            if message_id is not None:
+                message_ids.append(message_id)
                 if 'registration_id' in res:
-                    canonicals[reg_id] = res['registration_id']
+                    canonicals[i] = res['registration_id']
             else:
-                if res['error'] in ["Unavailable", "InternalServerError"]:
-                    unavailable.append(reg_id)
-                elif res['error'] == "NotRegistered":
-                    not_registered.append(reg_id)
+                error = res['error']
+                error_counts[error] = error_counts.get(error, 0) + 1
+                if error in RETRY_ERRORS:
+                    status[i] = STATUS_RETRY
+                elif error == "NotRegistered":
+                    status[i] = STATUS_NOT_REGISTERED
                 else:
-                    errors[reg_id] = res['error']
+                    status[i] = STATUS_FAILED
+                    errors[i] = error
 
         return {
             'multicast_id': data['multicast_id'],
-            'success': success,
+            'status': status,
+            'message_ids': _MESSAGE_ID_SEP.join(message_ids),
             'canonicals': canonicals,
-            'unavailable': unavailable,
-            'not_registered': not_registered,
             'failed': errors,
+            'error_counts': error_counts,
         }
 
+    def _parts(self):
+        """ Results the views of this result are made of. """
+        return (self,)
+
     @property
     def success(self):
         """ Successfully processed registration ID's as mapping ``{
         registration_id: message_id}``. """
-        return self._success_ids
+        return _SuccessView(self._parts())
 
     @property
     def canonical(self):
@@ -273,14 +752,14 @@ class Result(object):
             replacing them with corresponding canonical ID. Read more `here
             <http://developer.android.com/google/fcm/adv.html#canonical>`_.
         """
-        return self._canonical_ids
+        return _SparseView(self._parts(), '_canonical_ids')
 
     @property
     def not_registered(self):
         """ List all registration ID's that FCM reports as ``NotRegistered``.
             You should remove them from your database.
         """
-        return self._not_registered_ids
+        return _StatusView(self._parts(), STATUS_NOT_REGISTERED)
 
     @property
     def failed(self):
@@ -296,11 +775,25 @@ class Result(object):
             Read more about possible `error codes
             <http://developer.android.com/google/fcm/fcm.html#error_codes>`_.
         """
-        return self._failed_ids
+        return _SparseView(self._parts(), '_failed_ids')
+
+    @property
+    def error_counts(self):
+        """ Number of registration ID's per FCM error code, as mapping
+        ``{error code: count}``, including ``Unavailable`` and
+        ``NotRegistered``.
+        """
+        counts = {}
+        for res in self._parts():
+            for error, count in six.iteritems(res._error_counts):
+                counts[error] = counts.get(error, 0) + count
+        return counts
 
     def needs_retry(self):
         """ True if :func:`retry` will return message. """
-        return self._retry_message is not None
+        if not self.failure_count:
+            return False
+        return self.retry() is not None
 
     def retry(self):
         """ Construct new message that will unicast/multicast to remaining
@@ -308,10 +801,16 @@ class Result(object):
             is nothing to retry. Do not forget to wait for :func:`delay`
             seconds before new attempt.
         """
+        if self._retry_message is _UNSET:
+            unavailable = list(_StatusView(self._parts(), STATUS_RETRY))
+            if unavailable:
+                self._retry_message = self.message._retry(unavailable)
+            else:
+                self._retry_message = None
         return self._retry_message
 
     def delay(self, retry=0):
-        """ Time to wait in seconds before attempting a retry as a float number.
+        """ Time to wait in seconds before attempting a retry, as a float.
 
             This method will return value of Retry-After header if it is
             provided by FCM. Otherwise, it will return (backoff * 2^retry) with
@@ -332,6 +831,122 @@ class Result(object):
         return (base + self._random.randrange(self._backoff)) / 1000.0
 
 
+class BulkResult(Result):
+    """
+    Merged result of sending one message in several chunks, see
+    :func:`FCM.send_many`.
+
+    Provides the same interface as :class:`Result` for the whole message,
+    counts are summed up and the views span all chunks.
+    All recoverably failed registration ID's, including the ones of chunks
+    that failed with a network error, are combined into one :func:`retry`
+    message. Per-chunk results are available as :attr:`results`.
+    """
+    __slots__ = ('results',)
+
+    def __init__(self, message, results, backoff):
+        self.message = message
+        self.results = results
+        self.error = None
+        self.status_code = None
+        self._random = None
+        self._backoff = backoff
+        self._retry_message = _UNSET
+
+        retry_after = [res.retry_after for res in results if res.retry_after]
+        self.retry_after = max(retry_after) if retry_after else None
+        self.multicast_id = None
+        self.success_count = sum(res.success_count for res in results)
+        self.failure_count = sum(res.failure_count for res in results)
+        self.canonical_count = sum(res.canonical_count for res in results)
+
+    def _parts(self):
+        return self.results
+
+    def needs_retry(self):
+        """ True if :func:`retry` will return message. """
+        return any(res.needs_retry() for res in self.results)
+
+    def retry(self):
+        """ One message for the recoverably failed registration ID's of all
+            chunks, see :func:`Result.retry`.
+        """
+        if self._retry_message is _UNSET:
+            unavailable = []
+            for res in self.results:
+                if res.needs_retry():
+                    unavailable.extend(res.retry().registration_ids)
+            if unavailable:
+                self._retry_message = self.message._retry(unavailable)
+            else:
+                self._retry_message = None
+        return self._retry_message
+
+    @property
+    def errors(self):
+        """ Network errors of chunks that got no response from FCM. """
+        return [res.error for res in self.results if res.error is not None]
+
+
+def _token_set(dedupe, capacity=1024):
+    """ :class:`fcmclient.TokenSet` to use for the `dedupe` argument. """
+    if dedupe is True:
+        return TokenSet(capacity)
+    if dedupe is False or dedupe is None:
+        return None
+    return dedupe
+
+
+class TopicResult(Result):
+    """
+    Result of a :class:`TopicMessage`.
+
+    FCM answers a topic message with one :attr:`message_id`, or an
+    :attr:`error_code` such as ``TopicsMessageRateExceeded``. It counts as
+    one success or failure, there are no per registration ID details.
+    :attr:`error` is a network error, like for :class:`Result`.
+    """
+    __slots__ = ('message_id', 'error_code')
+
+    def _set_retry_all(self, message):
+        self._retry_message = message
+        self.message_id = None
+        self.error_code = None
+        self.success_count = 0
+        self.failure_count = 1
+        self.canonical_count = 0
+
+    def _set_response(self, data):
+        #: FCM message ID, if accepted.
+        self.message_id = data.get('message_id')
+        #: FCM error code, if rejected.
+        self.error_code = data.get('error')
+        if self.message_id is None and self.error_code is None:
+            raise ValueError("Invalid response")
+
+        failed = self.error_code is not None
+        self.success_count = int(not failed)
+        self.failure_count = int(failed)
+        self.canonical_count = 0
+        self._retry_message = None
+        if self.error_code in TOPIC_RETRY_ERRORS:
+            self._retry_message = self.message
+
+    def _parts(self):
+        return ()
+
+    @property
+    def error_counts(self):
+        """ ``{error code: 1}`` if FCM rejected the message. """
+        if self.error_code is None:
+            return {}
+        return {self.error_code: 1}
+
+    def retry(self):
+        """ The message, if it may be retried after :func:`delay`. """
+        return self._retry_message
+
+
 class FCM(object):
     """
     FCM
@@ -343,13 +958,47 @@ class FCM(object):
     INITIAL_BACKOFF = 1000
 
     def __init__(self, api_key, url=FCM_URL, backoff=INITIAL_BACKOFF,
-                 **options):
+                 pool_size=DEFAULT_POOL_SIZE, warm_up=False, codec=None,
+                 limiter=None, rate_limiter=None, breaker=None,
+                 observers=None, token_cache=None, http2=False,
+                 max_streams=DEFAULT_MAX_STREAMS, compress_threshold=None,
+                 compress_level=DEFAULT_COMPRESS_LEVEL, **options):
         """
         Create new connection.
 
+        The client keeps a `requests.Session` with a pool of keep-alive
+        connections, so consecutive sends reuse the TCP+TLS connection to
+        FCM instead of doing a fresh handshake every time. Call
+        :func:`close` (or use the client as a context manager) to release
+        the pooled connections.
+
         :param api_key: (str) Google API key
         :param url: (str) FCM server URL.
         :param backoff: (int) initial backoff in milliseconds.
+        :param pool_size: (int) max number of pooled keep-alive connections.
+        :param warm_up: (bool) open a connection to FCM right away.
+        :param codec: (str or object) JSON codec, see :mod:`fcmclient.codec`.
+            Defaults to the fastest one installed.
+        :param limiter: (:class:`fcmclient.AdaptiveLimiter`) adapts the
+            number of requests in flight to what FCM can take.
+        :param rate_limiter: (:class:`fcmclient.RateLimiter`) keeps requests
+            and registration ID's per second within a budget.
+        :param breaker: (:class:`fcmclient.CircuitBreaker`) stops sending
+            while FCM is down or asked to back off with ``Retry-After``.
+        :param observers: (list) callables receiving a
+            :class:`fcmclient.RequestEvent` for every request, see
+            :mod:`fcmclient.events`.
+        :param token_cache: (:class:`fcmclient.TokenCache`) skips dead
+            registration ID's and sends to canonical ID's instead.
+        :param http2: (bool) multiplex requests over `pool_size` HTTP/2
+            connections, see :mod:`fcmclient.http2`.
+        :param max_streams: (int) max concurrent requests per HTTP/2
+            connection. Parallel sends use at most
+            :data:`DEFAULT_MAX_CONCURRENCY` threads unless asked for more.
+        :param compress_threshold: (int) gzip request bodies of at least
+            this many bytes, see :func:`fcmclient.codec.gzip_compress`.
+            Off by default.
+        :param compress_level: (int) gzip compression level, 1 is fastest.
         :param options: (kwargs) options for `requests
         """
         if not api_key:
@@ -358,7 +1007,66 @@ class FCM(object):
         self.api_key = api_key
         self.url = url
         self.backoff = backoff
+        self.pool_size = pool_size
+        self.codec = get_codec(codec)
+        self.limiter = limiter
+        self.rate_limiter = rate_limiter
+        self.breaker = breaker
+        self.observers = list(observers or ())
+        self.token_cache = token_cache
+        self.http2 = http2
+        self.max_streams = max_streams
+        self.compress_threshold = compress_threshold
+        self.compress_level = compress_level
         self.requests_options = options
+        self.session = self._create_session()
+
+        if warm_up:
+            self.warm_up()
+
+    def _create_session(self):
+        """ Create the pooled session used for all requests. """
+        if self.http2:
+            from .http2 import HTTP2Session
+            session = HTTP2Session(
+                self.pool_size, self.max_streams,
+                verify=self.requests_options.pop('verify', True))
+        else:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=self.pool_size)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+        session.headers.update({
+            'Authorization': 'key=%s' % self.api_key,
+            'Content-Type': 'application/json',
+            'Accept-Encoding': 'gzip',
+            'Connection': 'keep-alive',
+        })
+        return session
+
+    def warm_up(self):
+        """
+        Establish a pooled connection to FCM ahead of the first send.
+
+        The response itself is ignored, only the connection matters. Network
+        problems are not raised here; they will surface on :func:`send`.
+        """
+        try:
+            self.session.head(self.url, **self.requests_options).close()
+        except requests.exceptions.RequestException:
+            pass
+
+    def close(self):
+        """ Close all pooled connections. """
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
 
     def send(self, message):
         """
@@ -377,18 +1085,241 @@ class FCM(object):
 
         :Raises:
             - ``requests.exceptions.RequestException`` on any network problem.
+            - :class:`fcmclient.CircuitOpenError` while the `breaker` is
+              open, a ``RequestException`` too.
             - ``ValueError`` if your FCM request or response is rejected.
             - :class:`FCMAuthenticationError` your API key is invalid.
         """
+        filtered = self._prepare(message)
+        if filtered is None:
+            # all registration ID's are dead, nothing to send
+            return BulkResult(message, [], self.backoff)
+        return self._deliver(filtered)
+
+    def _prepare(self, message, seen=None):
+        """ Filter message through the `token_cache` and the
+            :class:`fcmclient.TokenSet` `seen`, None if nothing is left.
+        """
+        if self.token_cache is not None:
+            message = self.token_cache.filter_message(message)
+        if seen is not None and message is not None:
+            message = seen.filter_message(message)
+        return message
+
+    def _deliver(self, message):
+        """ Send message as it is and report the result. """
+        if self.observers:
+            result = self._send_observed(message)
+        else:
+            result = self._send(message)
+        if self.token_cache is not None:
+            self.token_cache.update(result)
+        return result
+
+    def _send_observed(self, message):
+        event = RequestEvent('request', message)
+        started = _clock()
+        try:
+            result = self._send(message, event)
+        except Exception as e:
+            event.error = e
+            raise
+        else:
+            event._set_result(result)
+            return result
+        finally:
+            event.timings['total'] = _clock() - started
+            emit(self.observers, event)
+
+    def _send(self, message, event=None):
+        """ Send message within the limits, recording timings in `event`.
+        """
+        breaker = self.breaker
+        if breaker is not None:
+            # fails fast while the circuit is open
+            admitted = breaker.before_send()
+
+        if self.rate_limiter is not None:
+            wait = self.rate_limiter.acquire(len(message.registration_ids))
+            if event is not None:
+                event.timings['rate_limit'] = wait
+
+        if self.limiter is None and breaker is None:
+            return self._post(message, event)
+
+        # waits for the limiter if too many requests are in flight
+        started = None
+        if self.limiter is not None:
+            waiting = _clock()
+            started = self.limiter.acquire()
+            if event is not None:
+                event.timings['limiter'] = _clock() - waiting
+        congested = retry_after = None
+        try:
+            result = self._post(message, event)
+            congested = is_congested(result)
+            retry_after = result.retry_after
+            return result
+        except requests.exceptions.RequestException:
+            congested = True
+            raise
+        finally:
+            if self.limiter is not None:
+                self.limiter.release(started, congested)
+            if breaker is not None:
+                breaker.record(congested, retry_after, admitted)
+
+    def _post(self, message, event=None):
+        """ Post message to FCM and interpret the response. """
         # raises requests.exceptions.RequestException on timeouts, connection
         # and other problems.
-        response = requests.post(
-            self.url,
-            json=message.payload,
-            headers={
-                'Authorization': 'key=%s' % self.api_key,
-            },
-            **self.requests_options)
+        if event is None:
+            data, headers = self._compress(message.encode(self.codec))
+            response = self.session.post(
+                self.url, data=data, headers=headers,
+                **self.requests_options)
+
+            # either request is accepted or rejected with possibility for
+            # retry
+            return message._result(response, self.backoff, codec=self.codec)
+
+        started = _clock()
+        data = message.encode(self.codec)
+        encoded = _clock()
+        event.timings['encode'] = encoded - started
+        data, headers = self._compress(data, event)
+        event.payload_bytes = len(data)
+        sending = _clock()
+        response = self.session.post(self.url, data=data, headers=headers,
+                                     **self.requests_options)
+        received = _clock()
+        event.status_code = response.status_code
+        # elapsed ends when the response headers are parsed
+        request = response.elapsed.total_seconds()
+        event.timings['request'] = request
+        event.timings['read'] = max(0.0, received - sending - request)
+        try:
+            return message._result(response, self.backoff, codec=self.codec)
+        finally:
+            event.timings['decode'] = _clock() - received
 
-        # either request is accepted or rejected with possibility for retry
-        return Result(message, response, self.backoff)
+    def _compress(self, data, event=None):
+        """ Request body `data` compressed if above `compress_threshold`,
+            and the headers to send it with.
+        """
+        if self.compress_threshold is None or \
+                len(data) < self.compress_threshold:
+            return data, None
+        started = _clock()
+        data = gzip_compress(data, self.compress_level)
+        if event is not None:
+            event.timings['compress'] = _clock() - started
+        return data, _GZIP_HEADERS
+
+    def send_many(self, message, chunk_size=MAX_MULTICAST, concurrency=None,
+                  dedupe=False):
+        """
+        Send message to any number of registration ID's.
+
+        The message is split into multicasts of at most `chunk_size`
+        registration ID's, which are sent in parallel on a thread pool
+        sharing the connection pool of this client. Keep `concurrency` at or
+        below `pool_size`, otherwise extra connections are not kept alive.
+        With HTTP/2, requests beyond `pool_size` times `max_streams` wait for
+        a free stream. Every parallel request takes a thread, so the default
+        is capped at :data:`DEFAULT_MAX_CONCURRENCY`.
+
+        Unlike :func:`send`, a network problem does not raise but marks the
+        registration ID's of that chunk for retry, so results of the other
+        chunks are not lost.
+
+        With a `token_cache` or `dedupe`, the message is filtered before it
+        is split, and the result covers the filtered message.
+
+        :param message: (:class:`JSONMessage`) message to send.
+        :param chunk_size: (int) max registration ID's per request.
+        :param concurrency: (int) max parallel requests, defaults to
+            `pool_size` (times `max_streams` with HTTP/2, at most
+            :data:`DEFAULT_MAX_CONCURRENCY`), or the `max_limit` of the
+            `limiter`.
+        :param dedupe: (bool or :class:`fcmclient.TokenSet`) skip duplicate
+            registration ID's, and the ones already in the given set.
+        :return: :class:`BulkResult` covering the whole message.
+        """
+        seen = _token_set(dedupe, len(message.registration_ids))
+        filtered = self._prepare(message, seen)
+        if filtered is None:
+            return BulkResult(message, [], self.backoff)
+        results = list(self._iter_send(
+            filtered.split(chunk_size), concurrency, self._deliver))
+        return BulkResult(filtered, results, self.backoff)
+
+    def iter_send(self, messages, concurrency=None, dedupe=False):
+        """
+        Send messages in parallel, yielding a :class:`Result` for each one
+        as soon as it completes.
+
+        `messages` may be any iterable, including a lazy one such as
+        :func:`JSONMessage.stream`. Only `concurrency` messages are pulled
+        from it ahead of the completed ones, so memory use does not depend on
+        the size of the audience as long as the results are not kept.
+        Network problems are reported like in :func:`send_many`.
+
+        With `dedupe`, registration ID's seen in earlier messages are
+        removed, and messages left without any are skipped. Pass the same
+        :class:`fcmclient.TokenSet` to several calls to deduplicate a
+        campaign across them.
+
+        :param messages: (iterable) :class:`JSONMessage` objects to send.
+        :param concurrency: (int) max parallel requests, defaults to
+            `pool_size` (times `max_streams` with HTTP/2, at most
+            :data:`DEFAULT_MAX_CONCURRENCY`), or the `max_limit` of the
+            `limiter`.
+        :param dedupe: (bool or :class:`fcmclient.TokenSet`) skip duplicate
+            registration ID's.
+        """
+        seen = _token_set(dedupe)
+        if seen is None:
+            return self._iter_send(messages, concurrency, self.send)
+
+        filtered = (self._prepare(message, seen) for message in messages)
+        return self._iter_send(
+            (message for message in filtered if message is not None),
+            concurrency, self._deliver)
+
+    def _max_concurrency(self):
+        """ Default number of parallel requests: as many as the pooled
+            connections can carry at once, within a sane number of threads.
+        """
+        if self.http2:
+            return max(self.pool_size, min(
+                self.pool_size * self.max_streams, DEFAULT_MAX_CONCURRENCY))
+        return self.pool_size
+
+    def _iter_send(self, messages, concurrency, send):
+        if concurrency is None:
+            concurrency = self._max_concurrency()
+            if self.limiter is not None:
+                concurrency = max(concurrency, self.limiter.max_limit)
+
+        with futures.ThreadPoolExecutor(max_workers=concurrency) as pool:
+            pending = set()
+            for message in messages:
+                pending.add(pool.submit(self._send_chunk, message, send))
+                if len(pending) < concurrency:
+                    continue
+
+                done, pending = futures.wait(
+                    pending, return_when=futures.FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+
+            for future in futures.as_completed(pending):
+                yield future.result()
+
+    def _send_chunk(self, message, send=None):
+        """ Send message, turning network problems into a retry result. """
+        try:
+            return (send or self.send)(message)
+        except requests.exceptions.RequestException as e:
+            return message._result(None, self.backoff, error=e)
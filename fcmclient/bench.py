@@ -0,0 +1,298 @@
+# Copyright 2018 Joya Communications, John Loehrer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Benchmarks for the send and parse hot paths, and a load generator sending
+to a local stand-in for FCM::
+
+    fcmclient bench --concurrency 10 --requests 1000
+
+or ``python -m fcmclient.bench``. Reports ops/sec, p50/p99 latency and the
+peak memory allocated by one operation, or by one round of `concurrency`
+sends. The local server runs in the same process and takes its share of
+the CPU, so compare numbers of runs on the same machine only.
+"""
+from __future__ import print_function
+
+import argparse
+import collections
+import json
+import random
+import string
+import sys
+import threading
+import timeit
+from concurrent import futures
+
+import requests
+
+try:
+    import tracemalloc
+except ImportError:  # python 2
+    tracemalloc = None
+
+from .api import FCM, JSONMessage, MAX_MULTICAST, Result, _clock
+from .codec import CODECS, DEFAULT_CODEC, get_codec
+from .testing import FakeFCMServer
+
+REG_ID_CHARSET = string.ascii_letters + string.digits + '-_'
+
+
+def generate_reg_id(rand=random):
+    return ''.join([rand.choice(REG_ID_CHARSET) for _ in range(152)])
+
+
+def sample_message(count=MAX_MULTICAST, template=False):
+    """ Multicast to `count` registration ID's with a typical payload. """
+    rand = random.Random(count)
+    return JSONMessage(
+        [generate_reg_id(rand) for _ in range(count)],
+        data={'key%s' % i: 'value %s' % i for i in range(20)},
+        message_title='Title',
+        message_body='Body ' * 20,
+        collapse_key='bench',
+        time_to_live=3600,
+        template=template)
+
+
+def sample_response(message):
+    """ FCM response to `message`, mostly successes with a few errors. """
+    results = []
+    for i, _ in enumerate(message.registration_ids):
+        if i % 50 == 1:
+            results.append({'error': 'Unavailable'})
+        elif i % 50 == 2:
+            results.append({'error': 'NotRegistered'})
+        elif i % 50 == 3:
+            results.append({'message_id': '0:%s' % i,
+                            'registration_id': generate_reg_id()})
+        else:
+            results.append({'message_id': '0:1500415560392%06d' % i})
+    return {
+        'multicast_id': 216,
+        'success': len(results) - 2 * len(results) // 50,
+        'failure': 2 * len(results) // 50,
+        'canonical_ids': len(results) // 50,
+        'results': results,
+    }
+
+
+def measure(func, number):
+    """ Best of three runs, in microseconds per call. """
+    best = min(timeit.repeat(func, number=number, repeat=3))
+    return best / number * 1e6
+
+
+def bench_codec(number=200, out=sys.stdout):
+    """
+    Encode and decode cost per 1000 token multicast for each installed
+    codec. The `requests` row is what :class:`FCM` did before codecs were
+    pluggable: ``json=payload`` and ``response.json()``.
+    """
+    message = sample_message()
+    body = json.dumps(sample_response(message)).encode('utf-8')
+
+    rows = [(
+        'requests',
+        measure(lambda: json.dumps(message.payload).encode('utf-8'), number),
+        measure(lambda: json.loads(body.decode('utf-8')), number),
+    )]
+    for name, _ in CODECS:
+        try:
+            codec = get_codec(name)
+        except ImportError:
+            continue
+        rows.append((
+            name,
+            measure(lambda: message.encode(codec), number),
+            measure(lambda: codec.loads(body), number),
+        ))
+
+    out.write('%-10s %12s %12s\n' % ('codec', 'encode us', 'decode us'))
+    for name, encode, decode in rows:
+        out.write('%-10s %12.1f %12.1f\n' % (name, encode, decode))
+    return rows
+
+
+#: One benchmark: operations per second, latency percentiles in seconds and
+#: peak memory in bytes, None if it could not be traced.
+Stats = collections.namedtuple('Stats', 'name ops_per_sec p50 p99 peak')
+
+
+def percentile(samples, pct):
+    """ Nearest rank percentile of sorted `samples`. """
+    if not samples:
+        return 0.0
+    rank = int(round(pct / 100.0 * len(samples) + 0.5)) - 1
+    return samples[max(0, min(len(samples) - 1, rank))]
+
+
+def peak_memory(func):
+    """ Peak bytes allocated while calling `func` once. """
+    if tracemalloc is None:
+        return None
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def run(name, func, number):
+    """ Call `func` `number` times, timing each call. """
+    func()  # warm up
+    samples = []
+    started = _clock()
+    for _ in range(number):
+        call_started = _clock()
+        func()
+        samples.append(_clock() - call_started)
+    elapsed = _clock() - started
+    samples.sort()
+    return Stats(name, number / elapsed if elapsed else 0.0,
+                 percentile(samples, 50), percentile(samples, 99),
+                 peak_memory(func))
+
+
+def bench_hot_paths(number=200, codec=DEFAULT_CODEC):
+    """ Message construction, encoding, response parsing and retries. """
+    message = sample_message()
+    registration_ids = message.registration_ids
+    data = message.data
+    rows = [
+        run('construct 1000', lambda: JSONMessage(
+            registration_ids, data=data, message_title='Title',
+            message_body='Body ' * 20, collapse_key='bench'), number),
+        run('encode 1000', lambda: message.encode(codec), number),
+    ]
+
+    for count in (1, 100, MAX_MULTICAST):
+        chunk = sample_message(count)
+        body = sample_response(chunk)
+        result = Result(chunk, _http_response(body, codec),
+                        FCM.INITIAL_BACKOFF, codec=codec)
+        rows.append(run('parse %d' % count,
+                        lambda: result._parse_response(body), number))
+
+    result = Result(message, _http_response(sample_response(message), codec),
+                    FCM.INITIAL_BACKOFF, codec=codec)
+    unavailable = list(result.retry().registration_ids)
+    rows.append(run('retry %d' % len(unavailable),
+                    lambda: message._retry(unavailable), number))
+    return rows
+
+
+def _http_response(body, codec):
+    response = requests.Response()
+    response.status_code = 200
+    response._content = codec.dumps(body)
+    return response
+
+
+def bench_send(count=200, concurrency=10, tokens=MAX_MULTICAST, url=None):
+    """
+    End-to-end :func:`fcmclient.FCM.send`, `count` times, of `tokens`
+    registration ID's from `concurrency` threads, to `url` or else to a
+    :class:`fcmclient.testing.FakeFCMServer`.
+    """
+    server = None
+    if url is None:
+        server = FakeFCMServer()
+        url = server.url
+
+    message = sample_message(tokens)
+    fcm = FCM('bench', url=url, pool_size=concurrency)
+    lock = threading.Lock()
+    samples = []
+
+    def send():
+        started = _clock()
+        fcm.send(message)
+        latency = _clock() - started
+        with lock:
+            samples.append(latency)
+
+    def load(count):
+        with futures.ThreadPoolExecutor(max_workers=concurrency) as pool:
+            for future in [pool.submit(send) for _ in range(count)]:
+                future.result()
+
+    try:
+        load(concurrency)  # opens the pooled connections
+        peak = peak_memory(lambda: load(concurrency))
+        del samples[:]
+        started = _clock()
+        load(count)
+        elapsed = _clock() - started
+    finally:
+        fcm.close()
+        if server is not None:
+            server.stop()
+
+    samples.sort()
+    return Stats('send %d x%d' % (tokens, concurrency),
+                 count / elapsed if elapsed else 0.0,
+                 percentile(samples, 50), percentile(samples, 99), peak)
+
+
+def report(rows, out=sys.stdout):
+    out.write('%-20s %12s %12s %12s %10s\n' % (
+        'benchmark', 'ops/sec', 'p50 us', 'p99 us', 'peak KB'))
+    for row in rows:
+        peak = '-' if row.peak is None else '%.1f' % (row.peak / 1024.0)
+        out.write('%-20s %12.1f %12.1f %12.1f %10s\n' % (
+            row.name, row.ops_per_sec, row.p50 * 1e6, row.p99 * 1e6, peak))
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(
+        prog='fcmclient bench',
+        description='benchmark the send and parse hot paths')
+    parser.add_argument(
+        '-n', '--number', type=int, default=200,
+        help='calls per hot path benchmark')
+    parser.add_argument(
+        '-c', '--concurrency', type=int, default=10,
+        help='parallel sends of the load test')
+    parser.add_argument(
+        '-r', '--requests', type=int, default=1000,
+        help='sends of the load test, 0 to skip it')
+    parser.add_argument(
+        '-t', '--tokens', type=int, default=MAX_MULTICAST,
+        help='registration ids per send of the load test')
+    parser.add_argument(
+        '-u', '--url', type=str, default=None,
+        help='server to load instead of a local stand-in for FCM')
+    args = parser.parse_args(args=args)
+    if not 0 < args.tokens <= MAX_MULTICAST:
+        parser.error('--tokens must be between 1 and %d' % MAX_MULTICAST)
+    return args
+
+
+def main(args=None, out=None):
+    args = parse_args(args=args)
+    if out is None:
+        out = sys.stdout
+
+    bench_codec(args.number, out)
+    out.write('\n')
+    rows = bench_hot_paths(args.number)
+    if args.requests:
+        rows.append(bench_send(args.requests, args.concurrency,
+                               args.tokens, args.url))
+    report(rows, out)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+# Copyright 2018 Joya Communications, John Loehrer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Circuit breaker failing sends fast while FCM is down.
+"""
+
+import threading
+import time
+
+import requests
+
+__all__ = ('CircuitBreaker', 'CircuitOpenError')
+
+_clock = getattr(time, 'monotonic', time.time)
+
+
+class CircuitOpenError(requests.exceptions.RequestException):
+    """ Raised instead of sending while the circuit is open.
+
+        It is a ``requests.exceptions.RequestException``, so it is handled
+        like any network problem: :func:`fcmclient.FCM.send_many` and
+        friends turn it into a :class:`fcmclient.Result` to retry after
+        :attr:`retry_after` seconds.
+    """
+
+    def __init__(self, retry_after):
+        super(CircuitOpenError, self).__init__(
+            "FCM circuit is open, retry after %.1f seconds" % retry_after)
+        #: seconds until the circuit lets a probe request through.
+        self.retry_after = retry_after
+
+
+class CircuitBreaker(object):
+    """
+    CircuitBreaker
+
+    Opens after `failure_threshold` consecutive network errors, timeouts or
+    5xx responses for `reset_timeout` seconds, or right away until the
+    deadline of a ``Retry-After`` header. While open, sends raise
+    :class:`CircuitOpenError` without touching the network. Once the time
+    is up, one probe request is let through (half-open): if it succeeds
+    the circuit closes, otherwise it opens again. Outcomes of requests sent
+    before the circuit last opened tell nothing about the probe and are
+    ignored, except for a ``Retry-After``.
+
+    Pass it to :class:`fcmclient.FCM` or :class:`fcmclient.aio.AsyncFCM` as
+    `breaker`; one breaker may be shared by several clients.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0,
+                 clock=_clock):
+        """
+        :param failure_threshold: (int) consecutive failures that open the
+            circuit.
+        :param reset_timeout: (float) seconds the circuit stays open before
+            a probe, unless ``Retry-After`` says otherwise.
+        :param clock: (callable) monotonic time in seconds.
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.failures = 0
+        self._state = self.CLOSED
+        self._open_until = 0.0
+        self._opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        """ One of :attr:`CLOSED`, :attr:`OPEN` or :attr:`HALF_OPEN`. """
+        with self._lock:
+            if self._state == self.OPEN and \
+                    self.clock() >= self._open_until:
+                return self.HALF_OPEN
+            return self._state
+
+    def before_send(self):
+        """ Check whether a request may be sent.
+
+            :return: time the request was let through, to pass to
+                :func:`record`.
+            :raises: :class:`CircuitOpenError` while the circuit is open or
+                a probe is in flight.
+        """
+        with self._lock:
+            now = self.clock()
+            if self._state == self.CLOSED:
+                return now
+
+            if now < self._open_until:
+                raise CircuitOpenError(self._open_until - now)
+            if self._probing:
+                raise CircuitOpenError(self.reset_timeout)
+            self._state = self.HALF_OPEN
+            self._probing = True
+            return now
+
+    def record(self, congested, retry_after=None, admitted=None):
+        """ Record the outcome of a request let through by
+            :func:`before_send`.
+
+            :param congested: (bool) whether the request failed with a
+                network error, timeout or 5xx, None if the outcome tells
+                nothing about FCM's health.
+            :param retry_after: (int) ``Retry-After`` seconds, if any.
+            :param admitted: (float) time returned by :func:`before_send`.
+        """
+        with self._lock:
+            now = self.clock()
+            if retry_after:
+                self._open(now + retry_after)
+            if admitted is not None and self._opened_at is not None and \
+                    admitted < self._opened_at:
+                # sent before the circuit opened, not the probe
+                return
+
+            if self._state == self.HALF_OPEN:
+                self._probing = False
+            if congested:
+                self.failures += 1
+            elif congested is not None:
+                self.failures = 0
+
+            if retry_after:
+                return
+            if congested:
+                if self._state != self.CLOSED or \
+                        self.failures >= self.failure_threshold:
+                    self._open(now + self.reset_timeout)
+            elif congested is not None and self._state == self.HALF_OPEN \
+                    and now >= self._open_until:
+                self._state = self.CLOSED
+
+    def _open(self, until):
+        if self._state != self.OPEN:
+            self._opened_at = self.clock()
+        self._state = self.OPEN
+        self._open_until = max(self._open_until, until)
+        self._probing = False
@@ -0,0 +1,277 @@
+# Copyright 2018 Joya Communications, John Loehrer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Bulk sends from the command line, reading registration ID's from a file or
+stdin, one per line or in a CSV column::
+
+    fcmclient bulk -k API_KEY -t title -b body tokens.csv > outcomes.jsonl
+
+or ``python -m fcmclient.bulk``. Registration ID's are sent in concurrent
+multicasts and retried after :func:`fcmclient.Result.delay`. The final
+outcome of every registration ID is written as a JSON line as soon as it is
+known, progress and throughput go to stderr.
+"""
+
+import argparse
+import csv
+import io
+import json
+import sys
+import time
+
+from .api import FCM, FCM_URL, JSONMessage, MAX_MULTICAST, _clock
+from .retry import DEFAULT_MAX_ATTEMPTS, RetryScheduler
+from .tokens import DEAD_ERRORS
+
+#: Default seconds between progress reports.
+DEFAULT_PROGRESS_INTERVAL = 5.0
+
+
+def read_tokens(lines, column=0, skip_header=False):
+    """ Registration ID's from `lines` of a text file, one per line or in
+        `column` of CSV rows. Blank lines are skipped.
+    """
+    rows = csv.reader(lines)
+    if skip_header:
+        next(rows, None)
+    for row in rows:
+        if len(row) > column:
+            token = row[column].strip()
+            if token:
+                yield token
+
+
+class BulkSender(object):
+    """
+    BulkSender
+
+    Sends messages with :func:`fcmclient.FCM.iter_send`, retries them with
+    a :class:`fcmclient.RetryScheduler`, and writes the final outcome of
+    every registration ID to `out` as a JSON object per line:
+
+        - ``{"token": ..., "status": "success", "message_id": ...}``, with
+          the ``"canonical"`` ID to use instead, if any.
+        - ``{"token": ..., "status": "dead", "error": ...}`` for
+          registration ID's to remove, see
+          :data:`fcmclient.tokens.DEAD_ERRORS`.
+        - ``{"token": ..., "status": "failed", "error": ...}`` for other
+          errors.
+        - ``{"token": ..., "status": "gave_up"}`` if still failing after
+          `max_attempts` retries.
+    """
+
+    def __init__(self, fcm, out, err=None, concurrency=None,
+                 max_attempts=DEFAULT_MAX_ATTEMPTS,
+                 progress_interval=DEFAULT_PROGRESS_INTERVAL, clock=_clock):
+        """
+        :param fcm: (:class:`fcmclient.FCM`) client to send with.
+        :param out: (file) receives the JSON lines.
+        :param err: (file) receives progress reports, if given.
+        :param concurrency: (int) max parallel requests.
+        :param max_attempts: (int) max retries of a registration ID.
+        :param progress_interval: (float) seconds between progress reports.
+        :param clock: (callable) monotonic time in seconds.
+        """
+        self.fcm = fcm
+        self.out = out
+        self.err = err
+        self.concurrency = concurrency
+        self.progress_interval = progress_interval
+        self.clock = clock
+        #: ``{status: count}`` of registration ID's written so far.
+        self.counts = dict.fromkeys(
+            ('success', 'canonical', 'dead', 'failed', 'gave_up'), 0)
+        #: registration ID's sent again.
+        self.retries = 0
+        self.scheduler = RetryScheduler(
+            fcm, max_attempts=max_attempts, on_result=self._on_retry,
+            on_give_up=self._give_up, clock=clock)
+        self._started = self._last_progress = None
+
+    @property
+    def token_count(self):
+        """ Registration ID's with a final outcome. """
+        counts = self.counts
+        return counts['success'] + counts['dead'] + counts['failed'] + \
+            counts['gave_up']
+
+    def send(self, messages):
+        """ Send `messages` and all retries.
+
+            :return: ``{status: count}`` of all registration ID's.
+        """
+        self._started = self._last_progress = self.clock()
+        scheduler = self.scheduler
+        for result in self.fcm.iter_send(messages, self.concurrency):
+            self._write(result)
+            scheduler.add(result)
+            scheduler.send_due()
+            self._progress()
+
+        while len(scheduler):
+            if not scheduler.send_due():
+                time.sleep(max(0.0, scheduler.next_due() - self.clock()))
+            self._progress()
+
+        self._progress(final=True)
+        return dict(self.counts)
+
+    def _on_retry(self, result, attempt):
+        self.retries += len(result.message.registration_ids)
+        self._write(result)
+
+    def _write(self, result):
+        """ Write the final outcomes of `result`. """
+        lines = []
+        canonical = dict(result.canonical)
+        for token, message_id in result.success.items():
+            line = {'token': token, 'status': 'success',
+                    'message_id': message_id}
+            if token in canonical:
+                line['canonical'] = canonical[token]
+                self.counts['canonical'] += 1
+            lines.append(line)
+        self.counts['success'] += len(lines)
+
+        for token in result.not_registered:
+            lines.append(self._failure(token, 'NotRegistered'))
+        for token, error in result.failed.items():
+            lines.append(self._failure(token, error))
+        self._dump(lines)
+
+    def _failure(self, token, error):
+        status = 'dead' if error in DEAD_ERRORS else 'failed'
+        self.counts[status] += 1
+        return {'token': token, 'status': status, 'error': error}
+
+    def _give_up(self, result, attempt):
+        tokens = result.retry().registration_ids
+        self.counts['gave_up'] += len(tokens)
+        self._dump([{'token': token, 'status': 'gave_up'}
+                    for token in tokens])
+
+    def _dump(self, lines):
+        if lines:
+            self.out.write(''.join(json.dumps(line) + '\n'
+                                   for line in lines))
+            self.out.flush()
+
+    def _progress(self, final=False):
+        if self.err is None:
+            return
+        now = self.clock()
+        if not final and now - self._last_progress < self.progress_interval:
+            return
+        self._last_progress = now
+        elapsed = now - self._started
+        rate = self.token_count / elapsed if elapsed > 0 else 0.0
+        self.err.write(
+            '%s%d tokens in %.1fs, %.1f/s: %d success (%d canonical), '
+            '%d dead, %d failed, %d gave up, %d retries, %d pending\n' % (
+                'done, ' if final else '', self.token_count, elapsed, rate,
+                self.counts['success'], self.counts['canonical'],
+                self.counts['dead'], self.counts['failed'],
+                self.counts['gave_up'], self.retries, len(self.scheduler)))
+        self.err.flush()
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(
+        prog='fcmclient bulk',
+        description='send a message to registration ids read from a file '
+                    'or stdin, writing the outcome of each one as a JSON '
+                    'line',
+        epilog='exits with status 1 if any registration id failed for '
+               'another reason than being dead, or was given up on')
+    parser.add_argument(
+        'file', nargs='?', default='-',
+        help='registration ids, one per line or in a CSV column, '
+             '"-" for stdin')
+    parser.add_argument(
+        '-k', '--api-key', type=str, required=True,
+        help='the fcm API key')
+    parser.add_argument(
+        '-u', '--url', type=str, default=FCM_URL,
+        help='the fcm server url')
+    parser.add_argument(
+        '-d', '--data', type=json.loads, default={}, help='data')
+    parser.add_argument(
+        '-t', '--message-title', type=str, default=None,
+        help='the message title')
+    parser.add_argument(
+        '-b', '--message-body', type=str, default=None,
+        help='the message body')
+    parser.add_argument(
+        '--column', type=int, default=0,
+        help='CSV column of the registration ids, counting from 0')
+    parser.add_argument(
+        '--skip-header', action='store_true',
+        help='skip the first line')
+    parser.add_argument(
+        '-c', '--concurrency', type=int, default=10,
+        help='parallel requests')
+    parser.add_argument(
+        '-s', '--chunk-size', type=int, default=MAX_MULTICAST,
+        help='registration ids per request')
+    parser.add_argument(
+        '-a', '--max-attempts', type=int, default=DEFAULT_MAX_ATTEMPTS,
+        help='max retries of a registration id')
+    parser.add_argument(
+        '--backoff', type=int, default=1000,
+        help='initial retry backoff in milliseconds, unless FCM sends '
+             'Retry-After')
+    parser.add_argument(
+        '-p', '--progress', type=float, default=DEFAULT_PROGRESS_INTERVAL,
+        help='seconds between progress reports on stderr')
+    args = parser.parse_args(args=args)
+    if not 0 < args.chunk_size <= MAX_MULTICAST:
+        parser.error('--chunk-size must be between 1 and %d' % MAX_MULTICAST)
+    if args.concurrency < 1:
+        parser.error('--concurrency must be at least 1')
+    return args
+
+
+def main(args=None, out=None, err=None):
+    args = parse_args(args=args)
+    if out is None:
+        out = sys.stdout
+    if err is None:
+        err = sys.stderr
+
+    if args.file == '-':
+        lines = sys.stdin
+    else:
+        lines = io.open(args.file, newline='')
+    fcm = FCM(args.api_key, url=args.url, backoff=args.backoff,
+              pool_size=args.concurrency)
+    try:
+        messages = JSONMessage.stream(
+            read_tokens(lines, args.column, args.skip_header),
+            chunk_size=args.chunk_size,
+            data=args.data,
+            message_title=args.message_title,
+            message_body=args.message_body)
+        sender = BulkSender(fcm, out, err, concurrency=args.concurrency,
+                            max_attempts=args.max_attempts,
+                            progress_interval=args.progress)
+        counts = sender.send(messages)
+    finally:
+        fcm.close()
+        if lines is not sys.stdin:
+            lines.close()
+    return 1 if counts['failed'] or counts['gave_up'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,373 @@
+# Copyright 2018 Joya Communications, John Loehrer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Campaigns sent from a pool of processes, for audiences too large for the
+CPU of one process.
+
+Encoding messages and parsing results hold the GIL, so threads of a single
+process stop scaling long before the network does. A :class:`Campaign`
+shards the registration ID's across worker processes instead, each with its
+own pooled client, and streams back what the caller needs to know::
+
+    campaign = Campaign(API_KEY, processes=8, pool_size=10)
+    report = campaign.send(cursor, data=data, collapse_key='my.key')
+    for reg_id in report.dead:
+        print("Removing %s from database" % reg_id)
+"""
+
+import itertools
+import logging
+import multiprocessing
+import pickle
+import threading
+
+import six
+
+from .api import FCM, JSONMessage, MAX_MULTICAST, _clock
+from .retry import DEFAULT_MAX_ATTEMPTS, RetryScheduler
+from .tokens import DEAD_ERRORS
+
+__all__ = ('Campaign', 'CampaignReport')
+
+log = logging.getLogger(__name__)
+
+# separates registration ID's on the wire, which FCM never puts in them
+_SEP = '\n'
+
+# seconds between checks that the workers are still alive
+_POLL_INTERVAL = 1.0
+
+
+class CampaignReport(object):
+    """
+    CampaignReport
+
+    Final outcomes of registration ID's of a :class:`Campaign`. Registration
+    ID's to retry are reported once their retries are done.
+    """
+    __slots__ = ('success_count', 'failure_count', 'retry_count',
+                 'gave_up_count', 'errors', 'canonical', 'dead', 'elapsed')
+
+    def __init__(self):
+        #: registration ID's delivered to.
+        self.success_count = 0
+        #: registration ID's not delivered to, including the ones given up.
+        self.failure_count = 0
+        #: retries of registration ID's sent.
+        self.retry_count = 0
+        #: registration ID's still failing after all retries.
+        self.gave_up_count = 0
+        #: ``{error code: count}`` of registration ID's rejected by FCM.
+        self.errors = {}
+        #: ``{registration ID: canonical ID}`` to update.
+        self.canonical = {}
+        #: registration ID's to remove, see
+        #: :data:`fcmclient.tokens.DEAD_ERRORS`.
+        self.dead = []
+        #: seconds the campaign took, only set on the report of
+        #: :func:`Campaign.send`.
+        self.elapsed = None
+
+    @property
+    def token_count(self):
+        """ Number of registration ID's reported on. """
+        return self.success_count + self.failure_count
+
+    @property
+    def tokens_per_second(self):
+        """ Throughput of the campaign, if :attr:`elapsed` is known. """
+        if not self.elapsed:
+            return None
+        return self.token_count / self.elapsed
+
+    def merge(self, other):
+        """ Add the outcomes of `other` to this report. """
+        self.success_count += other.success_count
+        self.failure_count += other.failure_count
+        self.retry_count += other.retry_count
+        self.gave_up_count += other.gave_up_count
+        for error, count in six.iteritems(other.errors):
+            self.errors[error] = self.errors.get(error, 0) + count
+        self.canonical.update(other.canonical)
+        self.dead.extend(other.dead)
+
+    def _add_result(self, result):
+        """ Add the final outcomes of a :class:`fcmclient.Result`. """
+        self.success_count += result.success_count
+        self.canonical.update(result.canonical)
+        not_registered = list(result.not_registered)
+        if not_registered:
+            self.errors['NotRegistered'] = \
+                self.errors.get('NotRegistered', 0) + len(not_registered)
+            self.dead.extend(not_registered)
+        for reg_id, error in six.iteritems(result.failed):
+            self.errors[error] = self.errors.get(error, 0) + 1
+            if error in DEAD_ERRORS:
+                self.dead.append(reg_id)
+        self.failure_count += len(not_registered) + len(result.failed)
+
+    def _dumps(self):
+        """ Compact tuple sent from a worker to the parent process. """
+        return (self.success_count, self.failure_count, self.retry_count,
+                self.gave_up_count, tuple(six.iteritems(self.errors)),
+                tuple(six.iteritems(self.canonical)), _SEP.join(self.dead))
+
+    @classmethod
+    def _loads(cls, data):
+        report = cls()
+        (report.success_count, report.failure_count, report.retry_count,
+         report.gave_up_count, errors, canonical, dead) = data
+        report.errors = dict(errors)
+        report.canonical = dict(canonical)
+        report.dead = dead.split(_SEP) if dead else []
+        return report
+
+    def __repr__(self):
+        return '<CampaignReport success=%d failure=%d retries=%d>' % (
+            self.success_count, self.failure_count, self.retry_count)
+
+
+class _WorkerError(object):
+    """ Exception of a worker, sent to the parent process. """
+
+    def __init__(self, error):
+        try:
+            pickle.dumps(error)
+        except Exception:
+            error = RuntimeError(repr(error))
+        self.error = error
+
+
+def _messages(tasks, kwargs):
+    """ Messages of the chunks of registration ID's from `tasks`. """
+    base = None
+    while True:
+        chunk = tasks.get()
+        if chunk is None:
+            return
+        registration_ids = chunk.split(_SEP)
+        if base is None:
+            base = JSONMessage(registration_ids, **kwargs)
+            yield base
+        else:
+            yield base._retry(registration_ids)
+
+
+def _work(tasks, reports, client_class, credentials, options, kwargs,
+          concurrency, max_attempts):
+    """ Worker process: send the chunks from `tasks`, put a report of each
+        result on `reports`, then None once done.
+    """
+    try:
+        fcm = client_class(credentials, **options)
+        try:
+            _send(fcm, tasks, reports, kwargs, concurrency, max_attempts)
+        finally:
+            fcm.close()
+    except Exception as e:
+        log.exception("Campaign worker failed")
+        reports.put(_WorkerError(e))
+    else:
+        reports.put(None)
+
+
+def _send(fcm, tasks, reports, kwargs, concurrency, max_attempts):
+    def report(result, attempt=None):
+        outcome = CampaignReport()
+        outcome._add_result(result)
+        if attempt is not None:
+            # result of a retry
+            outcome.retry_count = len(result.message.registration_ids)
+        reports.put(outcome._dumps())
+
+    def give_up(result, attempt):
+        outcome = CampaignReport()
+        outcome.gave_up_count = outcome.failure_count = len(
+            result.retry().registration_ids)
+        reports.put(outcome._dumps())
+
+    scheduler = RetryScheduler(fcm, max_attempts=max_attempts,
+                               on_result=report, on_give_up=give_up)
+    for result in fcm.iter_send(_messages(tasks, kwargs), concurrency):
+        report(result)
+        scheduler.add(result)
+        scheduler.send_due()
+
+    while len(scheduler):
+        if not scheduler.send_due():
+            _sleep_until(scheduler.next_due())
+
+
+def _sleep_until(due):
+    delay = due - _clock()
+    if delay > 0:
+        threading.Event().wait(delay)
+
+
+class Campaign(object):
+    """
+    Campaign
+
+    Sends a message to any number of registration ID's from `processes`
+    worker processes. The parent process reads the registration ID's and
+    hands them out in chunks. Each worker sends its chunks like
+    :func:`fcmclient.FCM.iter_send` on a client of its own and retries
+    them after :func:`fcmclient.Result.delay`, up to `max_attempts` times.
+
+    Workers send back a compact :class:`CampaignReport` per result, with
+    outcome counts, canonical ID's and dead registration ID's, so neither
+    messages nor results cross process boundaries. Throughput grows with
+    the number of cores, as long as the network and FCM keep up.
+
+    All arguments are pickled to start the workers unless processes are
+    forked, so leave out locks and open files, such as a shared
+    :class:`fcmclient.RateLimiter`. Pass a :class:`fcmclient.v1.FCMv1` as
+    `client_class` to send with the HTTP v1 API.
+    """
+
+    def __init__(self, credentials, processes=None, chunk_size=MAX_MULTICAST,
+                 concurrency=None, max_attempts=DEFAULT_MAX_ATTEMPTS,
+                 client_class=FCM, **options):
+        """
+        :param credentials: API key, or the first argument of
+            `client_class`.
+        :param processes: (int) number of worker processes, defaults to the
+            number of CPU's.
+        :param chunk_size: (int) max registration ID's per request.
+        :param concurrency: (int) max parallel requests per worker, see
+            :func:`fcmclient.FCM.iter_send`.
+        :param max_attempts: (int) max retries of a registration ID.
+        :param client_class: (type) client every worker sends with.
+        :param options: (kwargs) options of `client_class`.
+        """
+        self.credentials = credentials
+        self.processes = processes or multiprocessing.cpu_count()
+        self.chunk_size = chunk_size
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.client_class = client_class
+        self.options = options
+
+    def send(self, registration_ids, **kwargs):
+        """
+        Send a message to all `registration_ids` and wait for the outcome.
+
+        Dead registration ID's and canonical ID's of the whole audience are
+        kept in the report, use :func:`iter_send` for audiences with
+        millions of them.
+
+        :param registration_ids: (iterable) registration ID's, such as a
+            generator or DB cursor.
+        :param kwargs: arguments of :class:`fcmclient.JSONMessage`.
+        :return: :class:`CampaignReport` of the whole campaign.
+        """
+        started = _clock()
+        total = CampaignReport()
+        for report in self.iter_send(registration_ids, **kwargs):
+            total.merge(report)
+        total.elapsed = _clock() - started
+        return total
+
+    def iter_send(self, registration_ids, **kwargs):
+        """
+        Send a message to all `registration_ids`, yielding a
+        :class:`CampaignReport` for every result as soon as it arrives.
+
+        Registration ID's are read a few chunks ahead of the workers, so the
+        audience is never held in memory.
+
+        :param registration_ids: (iterable) registration ID's, such as a
+            generator or DB cursor.
+        :param kwargs: arguments of :class:`fcmclient.JSONMessage`.
+        :raises: the exception of a failed worker, such as
+            :class:`fcmclient.FCMAuthenticationError`.
+        """
+        tasks = multiprocessing.Queue(self.processes * 2)
+        reports = multiprocessing.Queue()
+        workers = [
+            multiprocessing.Process(target=_work, args=(
+                tasks, reports, self.client_class, self.credentials,
+                self.options, kwargs, self.concurrency, self.max_attempts))
+            for _ in range(self.processes)]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+
+        errors = []
+        stop = threading.Event()
+        feeder = threading.Thread(
+            target=self._feed, args=(registration_ids, tasks, errors, stop),
+            name='fcm-campaign-feeder')
+        feeder.daemon = True
+        feeder.start()
+
+        try:
+            running = len(workers)
+            while running:
+                try:
+                    data = reports.get(timeout=_POLL_INTERVAL)
+                except six.moves.queue.Empty:
+                    self._check(workers)
+                    continue
+                if data is None:
+                    running -= 1
+                elif isinstance(data, _WorkerError):
+                    raise data.error
+                else:
+                    yield CampaignReport._loads(data)
+            feeder.join()
+            if errors:
+                raise errors[0]
+        finally:
+            stop.set()
+            for worker in workers:
+                if worker.is_alive():
+                    worker.terminate()
+                worker.join()
+
+    def _feed(self, registration_ids, tasks, errors, stop):
+        """ Put chunks of registration ID's on `tasks`, then one None per
+            worker.
+        """
+        try:
+            registration_ids = iter(registration_ids)
+            while not stop.is_set():
+                chunk = list(itertools.islice(registration_ids,
+                                              self.chunk_size))
+                if not chunk:
+                    break
+                self._put(tasks, _SEP.join(chunk), stop)
+        except Exception as e:
+            log.exception("Reading registration ID's failed")
+            errors.append(e)
+        finally:
+            for _ in range(self.processes):
+                self._put(tasks, None, stop)
+
+    @staticmethod
+    def _put(tasks, item, stop):
+        # gives up once the campaign is over, the workers may be gone
+        while not stop.is_set():
+            try:
+                tasks.put(item, timeout=_POLL_INTERVAL)
+                return
+            except six.moves.queue.Full:
+                continue
+
+    @staticmethod
+    def _check(workers):
+        for worker in workers:
+            if worker.exitcode not in (None, 0):
+                raise RuntimeError("Campaign worker exited with code %d" %
+                                   worker.exitcode)
@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 import argparse
 from .version import __version__
-from .api import FCM, JSONMessage
+from .api import FCM, FCM_URL, JSONMessage
 import json
 import sys
 
@@ -12,8 +12,9 @@ def parse_args(args=None):
     :return: argparse.Namespace
     """
     parser = argparse.ArgumentParser(
-        description='fcmclient v%s - import keys from one or more'
-                    ' redis instances to another' % __version__)
+        description='fcmclient v%s - send a message, run "fcmclient bulk"'
+                    ' to send to many, or "fcmclient bench" to benchmark' %
+                    __version__)
 
     parser.add_argument('--version', action='version',
                         version='fcmclient %s' % __version__)
@@ -26,6 +27,10 @@ def parse_args(args=None):
         '-r', '--registration-id', type=str, required=True,
         help='the registration id')
 
+    parser.add_argument(
+        '-u', '--url', type=str, default=FCM_URL,
+        help='the fcm server url')
+
     parser.add_argument(
         '-d', '--data', type=json.loads, default={}, help='data')
 
@@ -41,6 +46,18 @@ def parse_args(args=None):
 
 
 def main(args=None, out=None):
+    if args is None:
+        args = sys.argv[1:]
+
+    if args and args[0] == 'bench':
+        # pulls in the fake server, only needed to benchmark
+        from . import bench
+        return bench.main(args[1:], out=out)
+
+    if args and args[0] == 'bulk':
+        from . import bulk
+        return bulk.main(args[1:], out=out)
+
     args = parse_args(args=args)
 
     if out is None:
@@ -48,7 +65,7 @@ def main(args=None, out=None):
 
     out.write("%s\n" % vars(args))
 
-    client = FCM(args.api_key)
+    client = FCM(args.api_key, url=args.url)
     message = JSONMessage(
         [args.registration_id],
         data=args.data,
@@ -56,7 +73,15 @@ def main(args=None, out=None):
         message_title=args.message_title)
 
     res = client.send(message)
-    out.write("%s\n" % vars(res))
+    out.write("%s\n" % {
+        'status_code': res.status_code,
+        'success_count': res.success_count,
+        'failure_count': res.failure_count,
+        'success': dict(res.success),
+        'canonical': dict(res.canonical),
+        'not_registered': list(res.not_registered),
+        'failed': dict(res.failed),
+    })
 
 
 if __name__ == '__main__':
@@ -0,0 +1,131 @@
+# Copyright 2018 Joya Communications, John Loehrer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+JSON codecs used to encode requests and decode FCM responses.
+
+A codec is any object with ``dumps(obj) -> bytes`` and ``loads(bytes) ->
+obj`` methods. `orjson <https://pypi.org/project/orjson/>`_ or `ujson
+<https://pypi.org/project/ujson/>`_ are used when installed, otherwise the
+standard library :mod:`json`.
+
+Request bodies are compressed with :func:`gzip_compress` if the client is
+given a `compress_threshold`.
+"""
+
+import json
+import zlib
+
+import six
+
+__all__ = ('JSONCodec', 'OrjsonCodec', 'UjsonCodec', 'get_codec',
+           'gzip_compress')
+
+#: Default gzip compression level of request bodies.
+DEFAULT_COMPRESS_LEVEL = 6
+
+# zlib window bits producing a gzip header and trailer
+_GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+class JSONCodec(object):
+    """ Standard library :mod:`json`. """
+    name = 'json'
+
+    def dumps(self, obj):
+        return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+    def loads(self, data):
+        return json.loads(data.decode('utf-8'))
+
+
+class OrjsonCodec(JSONCodec):
+    """ `orjson <https://pypi.org/project/orjson/>`_, python 3 only. """
+    name = 'orjson'
+
+    def __init__(self):
+        import orjson
+        self._dumps = orjson.dumps
+        self._loads = orjson.loads
+        self._option = orjson.OPT_NON_STR_KEYS
+
+    def dumps(self, obj):
+        return self._dumps(obj, option=self._option)
+
+    def loads(self, data):
+        return self._loads(data)
+
+
+class UjsonCodec(JSONCodec):
+    """ `ujson <https://pypi.org/project/ujson/>`_. """
+    name = 'ujson'
+
+    def __init__(self):
+        import ujson
+        self._dumps = ujson.dumps
+        self._loads = ujson.loads
+
+    def dumps(self, obj):
+        return self._dumps(
+            obj, ensure_ascii=False,
+            escape_forward_slashes=False).encode('utf-8')
+
+    def loads(self, data):
+        return self._loads(data)
+
+
+#: Codecs by name, in order of preference.
+CODECS = (
+    ('orjson', OrjsonCodec),
+    ('ujson', UjsonCodec),
+    ('json', JSONCodec),
+)
+
+
+def get_codec(codec=None):
+    """
+    Resolve a codec.
+
+    :param codec: (str or object) codec name, codec object or None for the
+        fastest installed codec.
+    :return: codec object.
+    :raises: ``ValueError`` for an unknown name, ``ImportError`` if the
+        library of the named codec is not installed.
+    """
+    if codec is not None and not isinstance(codec, six.string_types):
+        return codec
+
+    for name, cls in CODECS:
+        if codec is None:
+            try:
+                return cls()
+            except ImportError:
+                continue
+        elif codec == name:
+            return cls()
+
+    raise ValueError("Unknown codec: %s" % codec)
+
+
+#: Codec used when none is given.
+DEFAULT_CODEC = get_codec()
+
+
+def gzip_compress(data, level=DEFAULT_COMPRESS_LEVEL):
+    """ Compress `data` in gzip format, for ``Content-Encoding: gzip``.
+
+        Unlike :func:`gzip.compress`, no timestamp is written, so equal
+        bodies compress to equal bytes.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, _GZIP_WBITS)
+    return compressor.compress(data) + compressor.flush()
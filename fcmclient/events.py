@@ -0,0 +1,98 @@
+# Copyright 2018 Joya Communications, John Loehrer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Timing events of requests to FCM, for tracing and metrics.
+
+An observer is any callable taking a :class:`RequestEvent`. Pass observers
+to :class:`fcmclient.FCM` or :class:`fcmclient.aio.AsyncFCM` as
+`observers`. They are called in the sending thread, so keep them cheap.
+Exceptions raised by an observer are logged and do not affect the send.
+"""
+
+import logging
+import time
+
+__all__ = ('RequestEvent',)
+
+log = logging.getLogger(__name__)
+
+_clock = getattr(time, 'monotonic', time.time)
+
+
+class RequestEvent(object):
+    """
+    RequestEvent
+
+    Sizes, outcome and per phase timings in seconds of one request.
+
+    A ``'request'`` event is emitted when a send completes, its
+    :attr:`timings` may hold:
+
+    - ``rate_limit``: waiting for the `rate_limiter`.
+    - ``limiter``: waiting for a free slot of the `limiter`.
+    - ``encode``: encoding the JSON payload.
+    - ``compress``: compressing it, with a `compress_threshold`.
+    - ``request``: from sending the request until the response headers
+      arrived, that is connection acquire, TLS handshake if a new connection
+      was needed, writing the request and the time FCM took.
+    - ``read``: reading the response body.
+    - ``decode``: decoding the JSON response into a :class:`fcmclient.Result`,
+      including its per registration ID details.
+    - ``total``: the whole send.
+    """
+    __slots__ = (
+        'kind', 'message', 'token_count', 'payload_bytes', 'status_code',
+        'success_count', 'failure_count', 'canonical_count', 'retry_after',
+        'error', 'result', 'timings',
+    )
+
+    def __init__(self, kind, message):
+        self.kind = kind
+        #: the :class:`fcmclient.JSONMessage` sent.
+        self.message = message
+        self.token_count = len(message.registration_ids)
+        self.payload_bytes = None
+        self.status_code = None
+        self.success_count = None
+        self.failure_count = None
+        self.canonical_count = None
+        self.retry_after = None
+        #: exception the send failed with, if any.
+        self.error = None
+        #: the :class:`fcmclient.Result`, if there is one.
+        self.result = None
+        self.timings = {}
+
+    def __repr__(self):
+        return '<RequestEvent %s %s>' % (self.kind, ' '.join(
+            '%s=%.6f' % item for item in sorted(self.timings.items())))
+
+    def _set_result(self, result):
+        self.result = result
+        self.status_code = result.status_code
+        self.success_count = result.success_count
+        self.failure_count = result.failure_count
+        self.canonical_count = result.canonical_count
+        self.retry_after = result.retry_after
+        if result.error is not None:
+            self.error = result.error
+
+
+def emit(observers, event):
+    """ Hand `event` to every observer. """
+    for observer in observers:
+        try:
+            observer(event)
+        except Exception:
+            log.exception("Observer %r failed on %r", observer, event)
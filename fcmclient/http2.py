@@ -0,0 +1,148 @@
+# Copyright 2018 Joya Communications, John Loehrer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+HTTP/2 transport, requires `httpx <https://www.python-httpx.org>`_ with
+HTTP/2 support::
+
+    pip install fcm-client[http2]
+
+Used by :class:`fcmclient.FCM` and :class:`fcmclient.v1.FCMv1` when
+created with ``http2=True``::
+
+    fcm = FCMv1(SERVICE_ACCOUNT, http2=True, pool_size=2, max_streams=100)
+
+Every request is a stream on one of `pool_size` connections, so hundreds of
+requests can be in flight without a socket and TLS session each.
+"""
+
+import threading
+
+import httpx
+import requests
+from requests.structures import CaseInsensitiveDict
+
+from .api import DEFAULT_POOL_SIZE, DEFAULT_MAX_STREAMS
+
+__all__ = ('HTTP2Session',)
+
+# connection specific headers, not allowed in HTTP/2
+_HOP_BY_HOP = frozenset(['connection', 'keep-alive', 'proxy-connection',
+                         'transfer-encoding', 'upgrade'])
+
+
+def _timeout(timeout):
+    """ httpx timeout of a requests `timeout` option. """
+    if isinstance(timeout, tuple):
+        connect, read = timeout
+        return httpx.Timeout(read, connect=connect)
+    return httpx.Timeout(timeout)
+
+
+class HTTP2Session(object):
+    """
+    HTTP2Session
+
+    Stands in for the `requests.Session` of a client, sending requests as
+    multiplexed streams over `connections` HTTP/2 connections.
+
+    Each request goes to the connection with the fewest streams in flight,
+    and waits while all of them have `max_streams`. Connections also keep
+    within the ``SETTINGS_MAX_CONCURRENT_STREAMS`` and the flow control
+    windows of the server, so a lower limit of FCM is never exceeded.
+
+    HTTP/2 is used over TLS if the server offers it in ALPN, and with prior
+    knowledge for plain ``http://`` URLs. Network problems are raised as
+    `requests` exceptions, like the session it replaces. Of the `requests`
+    options, only ``timeout`` is supported.
+    """
+
+    def __init__(self, connections=DEFAULT_POOL_SIZE,
+                 max_streams=DEFAULT_MAX_STREAMS, verify=True):
+        """
+        :param connections: (int) number of HTTP/2 connections.
+        :param max_streams: (int) max concurrent streams per connection.
+        :param verify: (bool or str) verify TLS certificates, or the CA
+            bundle to verify them with.
+        """
+        self.headers = CaseInsensitiveDict()
+        self.max_streams = max_streams
+        self._clients = [
+            httpx.Client(http1=False, http2=True, verify=verify,
+                         timeout=None, limits=httpx.Limits(
+                             max_connections=1, max_keepalive_connections=1))
+            for _ in range(connections)]
+        self._streams = [0] * connections
+        self._available = threading.Condition()
+
+    @property
+    def streams(self):
+        """ Number of requests in flight. """
+        return sum(self._streams)
+
+    def _acquire(self):
+        """ Index of the least busy connection with a free stream. """
+        streams = self._streams
+        with self._available:
+            while True:
+                index = min(range(len(streams)), key=streams.__getitem__)
+                if streams[index] < self.max_streams:
+                    streams[index] += 1
+                    return index
+                self._available.wait()
+
+    def _release(self, index):
+        with self._available:
+            self._streams[index] -= 1
+            self._available.notify()
+
+    def request(self, method, url, data=None, headers=None, timeout=None,
+                **options):
+        """ Send a request, returning the `httpx.Response`.
+
+            :raises: ``requests.exceptions.RequestException`` on network
+                problems.
+        """
+        if options:
+            raise TypeError("Options not supported with HTTP/2: %s" %
+                            ', '.join(sorted(options)))
+
+        merged = CaseInsensitiveDict(self.headers)
+        merged.update(headers or {})
+        merged = {key: value for key, value in merged.items()
+                  if key.lower() not in _HOP_BY_HOP}
+
+        index = self._acquire()
+        try:
+            return self._clients[index].request(
+                method, url, content=data, headers=merged,
+                timeout=_timeout(timeout))
+        except httpx.TimeoutException as e:
+            raise requests.exceptions.Timeout(e)
+        except httpx.TransportError as e:
+            raise requests.exceptions.ConnectionError(e)
+        except httpx.HTTPError as e:
+            raise requests.exceptions.RequestException(e)
+        finally:
+            self._release(index)
+
+    def post(self, url, data=None, **kwargs):
+        return self.request('POST', url, data=data, **kwargs)
+
+    def head(self, url, **kwargs):
+        return self.request('HEAD', url, **kwargs)
+
+    def close(self):
+        """ Close all connections. """
+        for client in self._clients:
+            client.close()
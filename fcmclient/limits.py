@@ -0,0 +1,292 @@
+# Copyright 2018 Joya Communications, John Loehrer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Client side limits protecting FCM, and your sender, from overload.
+"""
+
+import contextlib
+import mmap
+import os
+import struct
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # windows
+    fcntl = None
+
+__all__ = ('AdaptiveLimiter', 'RateLimiter')
+
+_clock = getattr(time, 'monotonic', time.time)
+
+
+def is_congested(result):
+    """ True if `result` tells FCM is overloaded: a network error or
+        timeout, a 5xx response or a ``Retry-After`` header.
+    """
+    if result.error is not None or result.retry_after:
+        return True
+    return result.status_code is not None and result.status_code >= 500
+
+
+class AdaptiveLimiter(object):
+    """
+    AdaptiveLimiter
+
+    Limits the number of requests in flight with an additive increase,
+    multiplicative decrease (AIMD) controller. Every healthy response
+    increases the limit by about `increase` per round of `limit` requests,
+    every congestion signal (see :func:`is_congested`) multiplies it by
+    `decrease`. Requests that were already in flight when the limit was
+    decreased do not decrease it again, so one burst of errors counts once.
+
+    A response is healthy if it is no congestion signal and its latency is
+    within `latency_tolerance` times the lowest latency seen. Slow responses
+    hold the limit where it is.
+
+    Pass it to :class:`fcmclient.FCM` or :class:`fcmclient.aio.AsyncFCM` as
+    `limiter`; one limiter may be shared by several clients.
+    """
+
+    def __init__(self, initial=10, min_limit=1, max_limit=100,
+                 increase=1.0, decrease=0.5, latency_tolerance=2.0,
+                 clock=_clock):
+        """
+        :param initial: (int) initial limit.
+        :param min_limit: (int) lowest limit.
+        :param max_limit: (int) highest limit.
+        :param increase: (float) limit increase per round of requests.
+        :param decrease: (float) factor to multiply the limit with on
+            congestion.
+        :param latency_tolerance: (float) max latency as multiple of the
+            lowest latency seen to still count as healthy, None to ignore
+            latency.
+        :param clock: (callable) monotonic time in seconds.
+        """
+        if not 0 < min_limit <= initial <= max_limit:
+            raise ValueError("Expected 0 < min_limit <= initial <= max_limit")
+
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_tolerance = latency_tolerance
+        self.clock = clock
+        self.in_flight = 0
+        self.min_latency = None
+        self._limit = float(initial)
+        self._last_decrease = None
+        self._cond = threading.Condition()
+
+    @property
+    def limit(self):
+        """ Current max number of requests in flight. """
+        return int(self._limit)
+
+    def try_acquire(self):
+        """ Take a slot if one is free.
+
+            :return: start time to pass to :func:`release`, or None.
+        """
+        with self._cond:
+            if self.in_flight >= int(self._limit):
+                return None
+            self.in_flight += 1
+            return self.clock()
+
+    def acquire(self, timeout=None):
+        """ Wait for a free slot.
+
+            :return: start time to pass to :func:`release`, or None on
+                timeout.
+        """
+        with self._cond:
+            deadline = None if timeout is None else self.clock() + timeout
+            while self.in_flight >= int(self._limit):
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - self.clock()
+                    if remaining <= 0:
+                        return None
+                self._cond.wait(remaining)
+            self.in_flight += 1
+            return self.clock()
+
+    def release(self, started, congested=None):
+        """ Free the slot taken at `started` and adapt the limit.
+
+            :param started: (float) value returned by :func:`acquire`.
+            :param congested: (bool) whether the request ran into
+                congestion, None if it tells nothing about FCM's load.
+        """
+        with self._cond:
+            self.in_flight -= 1
+            now = self.clock()
+            if congested:
+                self._on_congestion(started, now)
+            elif congested is not None:
+                self._on_healthy(now - started)
+            self._cond.notify_all()
+
+    def _on_congestion(self, started, now):
+        if self._last_decrease is not None and \
+                started < self._last_decrease:
+            return
+        self._limit = max(self.min_limit, self._limit * self.decrease)
+        self._last_decrease = now
+
+    def _on_healthy(self, latency):
+        if self.min_latency is None or latency < self.min_latency:
+            self.min_latency = latency
+
+        tolerance = self.latency_tolerance
+        if tolerance is not None and self.min_latency and \
+                latency > self.min_latency * tolerance:
+            return
+        self._limit = min(self.max_limit,
+                          self._limit + self.increase / self._limit)
+
+
+class RateLimiter(object):
+    """
+    RateLimiter
+
+    Token buckets for requests per second and registration ID's (device
+    tokens) per second. A send takes one request and one token per
+    registration ID, and waits if a budget is used up.
+
+    Given a `path`, the buckets live in that file and are shared by every
+    process on the host that uses the same path, with access serialized by
+    a file lock. All of them must use the same rates. Without a `path`,
+    the buckets are shared by the threads of this process only. The
+    default clock is system-wide on Linux and macOS.
+
+    Pass it to :class:`fcmclient.FCM` or :class:`fcmclient.aio.AsyncFCM` as
+    `rate_limiter`.
+    """
+    # requests balance, requests stamp, tokens balance, tokens stamp
+    STATE = struct.Struct('=4d')
+
+    def __init__(self, requests_per_second=None, tokens_per_second=None,
+                 burst=1.0, path=None, clock=_clock):
+        """
+        :param requests_per_second: (float) request budget, None for no
+            limit.
+        :param tokens_per_second: (float) registration ID budget, None for
+            no limit.
+        :param burst: (float) seconds worth of budget that may be used up
+            at once after being idle.
+        :param path: (str) file to share the budgets through.
+        :param clock: (callable) monotonic time in seconds.
+        """
+        if not requests_per_second and not tokens_per_second:
+            raise ValueError("No rate given")
+        if path is not None and fcntl is None:
+            raise RuntimeError("Sharing a RateLimiter needs fcntl")
+
+        self.requests_per_second = requests_per_second
+        self.tokens_per_second = tokens_per_second
+        self.burst = burst
+        self.path = path
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._pid = None
+        self._fd = None
+        self._state = None
+
+    def _open(self):
+        """ (Re)open the state, after a fork the file lock has to be taken
+            through a new file descriptor.
+        """
+        self._pid = os.getpid()
+        if self.path is None:
+            if self._state is None:
+                self._state = bytearray(self.STATE.size)
+            return
+
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(fd).st_size < self.STATE.size:
+                os.ftruncate(fd, self.STATE.size)
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        self._fd = fd
+        self._state = mmap.mmap(fd, self.STATE.size)
+
+    def close(self):
+        """ Release the shared state file. """
+        with self._lock:
+            if self._fd is not None:
+                self._state.close()
+                os.close(self._fd)
+            self._fd = self._state = self._pid = None
+
+    @contextlib.contextmanager
+    def _locked(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                self._open()
+            if self._fd is None:
+                yield self._state
+                return
+
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                yield self._state
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def reserve(self, tokens=1):
+        """ Take one request and `tokens` registration ID's from the
+            budgets, going into debt if needed.
+
+            :return: seconds to wait before sending.
+        """
+        buckets = (
+            (self.requests_per_second, 1),
+            (self.tokens_per_second, tokens),
+        )
+        wait = 0.0
+        with self._locked() as state:
+            now = self.clock()
+            values = list(self.STATE.unpack_from(state))
+            for i, (rate, amount) in enumerate(buckets):
+                if not rate:
+                    continue
+
+                balance, stamp = values[2 * i], values[2 * i + 1]
+                capacity = rate * self.burst
+                if not stamp:
+                    balance = capacity
+                else:
+                    balance = min(capacity,
+                                  balance + max(0.0, now - stamp) * rate)
+                balance -= amount
+                values[2 * i], values[2 * i + 1] = balance, now
+                if balance < 0:
+                    wait = max(wait, -balance / rate)
+            self.STATE.pack_into(state, 0, *values)
+        return wait
+
+    def acquire(self, tokens=1):
+        """ Like :func:`reserve`, but sleeps until sending is allowed.
+
+            :return: seconds waited.
+        """
+        wait = self.reserve(tokens)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
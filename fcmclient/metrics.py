@@ -0,0 +1,254 @@
+# Copyright 2018 Joya Communications, John Loehrer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+In-process metrics aggregated from request events, see
+:mod:`fcmclient.events`.
+"""
+
+import bisect
+import threading
+import time
+
+import six
+
+from .api import RETRY_ERRORS
+
+__all__ = ('Metrics',)
+
+#: Default latency histogram bucket bounds in seconds.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+
+_clock = getattr(time, 'monotonic', time.time)
+
+
+class _Shard(object):
+    """ Counters and histograms written by one thread only. """
+    __slots__ = ('counters', 'histograms')
+
+    def __init__(self):
+        # {(name, label): value}
+        self.counters = {}
+        # {phase: [count per bucket..., count above, sum]}
+        self.histograms = {}
+
+
+class Metrics(object):
+    """
+    Metrics
+
+    Aggregates :class:`fcmclient.RequestEvent` objects into counters and
+    latency histograms. Pass it to :class:`fcmclient.FCM` as one of the
+    `observers`::
+
+        metrics = Metrics()
+        fcm = FCM(API_KEY, observers=[metrics])
+
+    Every thread writes to its own counters without taking a lock, the
+    counters of all threads are merged on read by :func:`snapshot` and
+    :func:`export`. Counters of finished threads are folded into one, so
+    short lived threads, like those of :func:`fcmclient.FCM.send_many`, do
+    not add up.
+
+    Per error code counts come from the per registration ID details, which
+    are parsed for every result with failures.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, prefix='fcm', clock=_clock):
+        """
+        :param buckets: (tuple) ascending latency bucket bounds in seconds.
+        :param prefix: (str) prefix of the exported metric names.
+        :param clock: (callable) monotonic time in seconds.
+        """
+        self.buckets = tuple(buckets)
+        self.prefix = prefix
+        self.clock = clock
+        self._local = threading.local()
+        # [(thread, shard)] of live threads
+        self._shards = []
+        # counters of finished threads
+        self._base = _Shard()
+        self._lock = threading.Lock()
+        self._last_read = (clock(), 0)
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = _Shard()
+            with self._lock:
+                self._retire()
+                self._shards.append((threading.current_thread(), shard))
+            return shard
+
+    def _retire(self):
+        """ Fold the shards of finished threads into the base shard, with
+            the lock held.
+        """
+        live = []
+        for thread, shard in self._shards:
+            if thread.is_alive():
+                live.append((thread, shard))
+            else:
+                self._merge(self._base, shard)
+        self._shards = live
+
+    @staticmethod
+    def _merge(into, shard):
+        """ Add the counters and histograms of `shard` to `into`. """
+        counters, histograms = into.counters, into.histograms
+        # copies, the owning thread may keep writing
+        for key, value in list(shard.counters.items()):
+            counters[key] = counters.get(key, 0) + value
+        for phase, histogram in list(shard.histograms.items()):
+            merged = histograms.get(phase)
+            if merged is None:
+                histograms[phase] = list(histogram)
+            else:
+                histograms[phase] = [a + b for a, b in
+                                     zip(merged, histogram)]
+
+    def __call__(self, event):
+        """ Record `event`. """
+        shard = self._shard()
+        self._observe(shard, event.timings)
+        if event.kind != 'request':
+            return
+
+        counters = shard.counters
+        result = event.result
+        if event.status_code is not None:
+            status = str(event.status_code)
+        else:
+            status = 'error'
+        self._incr(counters, 'requests', status)
+        self._incr(counters, 'tokens', None, event.token_count)
+        if result is None:
+            return
+
+        if event.status_code != 200:
+            # nothing was delivered
+            self._incr(counters, 'retries', None, event.token_count)
+            return
+
+        self._incr(counters, 'results', 'success', result.success_count)
+        self._incr(counters, 'results', 'failure', result.failure_count)
+        self._incr(counters, 'results', 'canonical', result.canonical_count)
+        if not result.failure_count:
+            return
+
+        for error, count in six.iteritems(result.error_counts):
+            self._incr(counters, 'errors', error, count)
+            if error in RETRY_ERRORS:
+                self._incr(counters, 'retries', None, count)
+
+    @staticmethod
+    def _incr(counters, name, label, value=1):
+        key = (name, label)
+        counters[key] = counters.get(key, 0) + value
+
+    def _observe(self, shard, timings):
+        size = len(self.buckets)
+        for phase, seconds in six.iteritems(timings):
+            histogram = shard.histograms.get(phase)
+            if histogram is None:
+                histogram = shard.histograms[phase] = [0] * (size + 1) + [0.0]
+            histogram[bisect.bisect_left(self.buckets, seconds)] += 1
+            histogram[-1] += seconds
+
+    def snapshot(self):
+        """
+        Merge the counters of all threads.
+
+        :return: dict with
+
+            - ``counters``: ``{(name, label): value}``, names are
+              ``requests`` by status code or ``'error'``, ``tokens`` sent,
+              ``results`` by ``success``, ``failure`` and ``canonical``,
+              ``errors`` by FCM error code and ``retries``, the number of
+              registration ID's handed back for retry.
+            - ``histograms``: ``{phase: (cumulative bucket counts, sum)}``,
+              with one count per bucket bound and the total count last.
+            - ``tokens_per_second``: rate since the previous snapshot.
+        """
+        merged = _Shard()
+        with self._lock:
+            self._retire()
+            self._merge(merged, self._base)
+            shards = [shard for _, shard in self._shards]
+        for shard in shards:
+            self._merge(merged, shard)
+        counters, histograms = merged.counters, merged.histograms
+
+        cumulative = {}
+        for phase, histogram in histograms.items():
+            counts, total = [], 0
+            for count in histogram[:-1]:
+                total += count
+                counts.append(total)
+            cumulative[phase] = (counts, histogram[-1])
+
+        now, tokens = self.clock(), counters.get(('tokens', None), 0)
+        with self._lock:
+            last_time, last_tokens = self._last_read
+            self._last_read = (now, tokens)
+        elapsed = now - last_time
+        rate = (tokens - last_tokens) / elapsed if elapsed > 0 else 0.0
+
+        return {
+            'counters': counters,
+            'histograms': cumulative,
+            'tokens_per_second': rate,
+        }
+
+    def export(self):
+        """ Snapshot in the Prometheus text exposition format. """
+        snapshot = self.snapshot()
+        prefix = self.prefix
+        labels = {
+            'requests': 'status',
+            'results': 'result',
+            'errors': 'error',
+        }
+        lines = []
+        last = None
+        for (name, label), value in sorted(
+                snapshot['counters'].items(),
+                key=lambda item: (item[0][0], item[0][1] or '')):
+            metric = '%s_%s_total' % (prefix, name)
+            if name != last:
+                lines.append('# TYPE %s counter' % metric)
+                last = name
+            if label is None:
+                lines.append('%s %s' % (metric, value))
+            else:
+                lines.append('%s{%s="%s"} %s' % (
+                    metric, labels[name], label, value))
+
+        metric = '%s_tokens_per_second' % prefix
+        lines.append('# TYPE %s gauge' % metric)
+        lines.append('%s %.3f' % (metric, snapshot['tokens_per_second']))
+
+        metric = '%s_latency_seconds' % prefix
+        if snapshot['histograms']:
+            lines.append('# TYPE %s histogram' % metric)
+        for phase, (counts, total) in sorted(snapshot['histograms'].items()):
+            bounds = ['%g' % bound for bound in self.buckets] + ['+Inf']
+            for bound, count in zip(bounds, counts):
+                lines.append('%s_bucket{phase="%s",le="%s"} %d' % (
+                    metric, phase, bound, count))
+            lines.append('%s_sum{phase="%s"} %.6f' % (metric, phase, total))
+            lines.append('%s_count{phase="%s"} %d' % (
+                metric, phase, counts[-1]))
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,224 @@
+# Copyright 2018 Joya Communications, John Loehrer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+In-process retries for long-lived sender processes.
+"""
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+from concurrent import futures
+
+from .api import MAX_MULTICAST, coalesce
+
+__all__ = ('RetryScheduler',)
+
+log = logging.getLogger(__name__)
+
+#: Default number of retries of a message before giving up.
+DEFAULT_MAX_ATTEMPTS = 5
+
+_clock = getattr(time, 'monotonic', time.time)
+
+
+class RetryScheduler(object):
+    """
+    RetryScheduler
+
+    Keeps retry messages in a timer heap ordered by when they are due, as
+    told by :func:`fcmclient.Result.delay`, which honors ``Retry-After``.
+    Adding a retry costs O(log n) and no thread sleeps per pending retry.
+
+    Either :func:`start` a dispatcher thread that sends due retries on a
+    thread pool, or drive the scheduler yourself with :func:`send_due`.
+
+    Retry messages that are due together and share payload and options are
+    merged into multicasts of up to `chunk_size` registration ID's, see
+    :func:`fcmclient.coalesce`. The dispatcher thread may wait `window`
+    seconds past the due time to collect more of them.
+
+    Every result of a retry is handed to `on_result`, so canonical ID's and
+    not registered devices of retries are not lost, and is scheduled again
+    if it needs another retry. Results still needing a retry after
+    `max_attempts` retries are handed to `on_give_up`.
+    """
+
+    def __init__(self, fcm, max_attempts=DEFAULT_MAX_ATTEMPTS,
+                 concurrency=None, on_result=None, on_give_up=None,
+                 coalesce=True, chunk_size=MAX_MULTICAST, window=0.0,
+                 clock=_clock):
+        """
+        :param fcm: (:class:`fcmclient.FCM`) client to send retries with.
+        :param max_attempts: (int) max retries per message.
+        :param concurrency: (int) max parallel retries when started,
+            defaults to the `pool_size` of `fcm`.
+        :param on_result: (callable) ``on_result(result, attempt)`` for
+            every result of a retry.
+        :param on_give_up: (callable) ``on_give_up(result, attempt)`` for
+            results that will not be retried any more.
+        :param coalesce: (bool) merge due retry messages.
+        :param chunk_size: (int) max registration ID's of a merged message.
+        :param window: (float) max seconds a retry may be sent late to be
+            merged with others.
+        :param clock: (callable) monotonic time in seconds.
+        """
+        self.fcm = fcm
+        self.max_attempts = max_attempts
+        self.concurrency = concurrency or fcm.pool_size
+        self.on_result = on_result
+        self.on_give_up = on_give_up
+        self.coalesce = coalesce
+        self.chunk_size = chunk_size
+        self.window = window
+        self.clock = clock
+        self._heap = []
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._pool = None
+        self._stopped = False
+
+    def __len__(self):
+        """ Number of pending retries. """
+        return len(self._heap)
+
+    def add(self, result, attempt=0):
+        """
+        Schedule the retry message of `result`, if it has one.
+
+        :param result: (:class:`fcmclient.Result`) result of a send.
+        :param attempt: (int) number of retries done so far.
+        :return: True if a retry was scheduled.
+        """
+        if not result.needs_retry():
+            return False
+
+        if attempt >= self.max_attempts:
+            if self.on_give_up is not None:
+                self.on_give_up(result, attempt)
+            return False
+
+        due = self.clock() + result.delay(attempt)
+        with self._cond:
+            heapq.heappush(
+                self._heap,
+                (due, next(self._counter), result.retry(), attempt))
+            self._cond.notify()
+        return True
+
+    def next_due(self):
+        """ Clock time the next retry is due at, or None. """
+        with self._cond:
+            return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now=None):
+        """ Remove and return ``(message, attempt)`` of all due retries.
+
+            Merged messages count as the highest attempt among them.
+        """
+        if now is None:
+            now = self.clock()
+        due = []
+        with self._cond:
+            while self._heap and self._heap[0][0] <= now:
+                _, _, message, attempt = heapq.heappop(self._heap)
+                due.append((message, attempt))
+
+        if not self.coalesce or len(due) < 2:
+            return due
+
+        attempts = {}
+        for message, attempt in due:
+            key = message._payload_key()
+            attempts[key] = max(attempt, attempts.get(key, 0))
+        return [(message, attempts[message._payload_key()])
+                for message in coalesce([m for m, _ in due],
+                                        chunk_size=self.chunk_size)]
+
+    def send_due(self, now=None):
+        """
+        Send all due retries in the calling thread and handle the results.
+
+        :return: number of retries sent.
+        """
+        due = self.pop_due(now)
+        for message, attempt in due:
+            self._send(message, attempt)
+        return len(due)
+
+    def handle(self, result, attempt):
+        """ Report the result of a retry and schedule the next one. """
+        if self.on_result is not None:
+            self.on_result(result, attempt)
+        self.add(result, attempt + 1)
+
+    def _send(self, message, attempt):
+        try:
+            result = self.fcm._send_chunk(message)
+        except Exception:
+            log.exception("Retry of %d registration ID's failed",
+                          len(message.registration_ids))
+            return
+        self.handle(result, attempt)
+
+    def start(self):
+        """ Send due retries from a background dispatcher thread. """
+        with self._cond:
+            if self._thread is not None:
+                return
+            self._stopped = False
+            self._pool = futures.ThreadPoolExecutor(
+                max_workers=self.concurrency)
+            self._thread = threading.Thread(
+                target=self._dispatch, name='fcm-retry-scheduler')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self, wait=True):
+        """ Stop the dispatcher thread. Pending retries are kept. """
+        with self._cond:
+            thread, pool = self._thread, self._pool
+            self._thread = self._pool = None
+            self._stopped = True
+            self._cond.notify()
+        if thread is not None:
+            thread.join()
+            pool.shutdown(wait=wait)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def _dispatch(self):
+        pool = self._pool
+        while True:
+            with self._cond:
+                while not self._stopped:
+                    now = self.clock()
+                    if self._heap and self._heap[0][0] + self.window <= now:
+                        break
+                    timeout = None
+                    if self._heap:
+                        timeout = self._heap[0][0] + self.window - now
+                    self._cond.wait(timeout)
+                if self._stopped:
+                    return
+
+            for message, attempt in self.pop_due():
+                pool.submit(self._send, message, attempt)
@@ -0,0 +1,584 @@
+# Copyright 2018 Joya Communications, John Loehrer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Local stand-in for FCM to test and load test senders without hitting
+Google::
+
+    from fcmclient.testing import FakeFCMServer
+
+    with FakeFCMServer(errors={'Unavailable': 0.01},
+                       latency=lambda: random.expovariate(20)) as server:
+        fcm = FCM(API_KEY, url=server.url)
+
+It also serves the HTTP v1 API and an OAuth2 token endpoint, see
+:attr:`FakeFCMServer.v1_url` and :attr:`FakeFCMServer.token_url`::
+
+        fcm = FCMv1(ServiceAccount(KEY, token_url=server.token_url),
+                    url=server.v1_url)
+
+This module is not imported by :mod:`fcmclient`.
+"""
+
+import base64
+import itertools
+import json
+import random
+import threading
+import time
+import zlib
+
+from requests.structures import CaseInsensitiveDict
+from six.moves import BaseHTTPServer, socketserver
+from six.moves.urllib.parse import parse_qs
+
+from .api import MAX_MULTICAST
+from .codec import DEFAULT_CODEC, _GZIP_WBITS, gzip_compress
+
+__all__ = ('FakeFCMServer',)
+
+# first bytes of an HTTP/2 connection
+_HTTP2_PREFACE = b'PRI * HTTP/2.0'
+
+#: Path of the OAuth2 token endpoint.
+TOKEN_PATH = '/token'
+
+# legacy error codes as v1 HTTP status, status and FCM error code
+_V1_ERRORS = {
+    'NotRegistered': (404, 'NOT_FOUND', 'UNREGISTERED'),
+    'InvalidRegistration': (400, 'INVALID_ARGUMENT', 'INVALID_ARGUMENT'),
+    'MismatchSenderId': (403, 'PERMISSION_DENIED', 'SENDER_ID_MISMATCH'),
+    'Unavailable': (503, 'UNAVAILABLE', 'UNAVAILABLE'),
+    'InternalServerError': (500, 'INTERNAL', 'INTERNAL'),
+    'DeviceMessageRateExceeded': (429, 'RESOURCE_EXHAUSTED',
+                                  'QUOTA_EXCEEDED'),
+}
+
+
+class _FCMEndpoints(object):
+    """ FCM endpoints, answering a request to `path` with `headers` of the
+        `server` through ``_reply``.
+    """
+
+    def _handle(self, body):
+        server = self.server
+        server._on_body(len(body))
+        if self.headers.get('Content-Encoding') == 'gzip':
+            try:
+                body = zlib.decompress(body, _GZIP_WBITS)
+            except zlib.error:
+                return self._reply(400, b'Invalid gzip body')
+        if self.path == TOKEN_PATH:
+            return self._token(body)
+        if self.path.endswith('/messages:send'):
+            return self._send_v1(body)
+
+        if server.api_key is not None and \
+                self.headers.get('Authorization') != 'key=%s' % server.api_key:
+            return self._reply(401, b'Unauthorized')
+
+        try:
+            payload = server.codec.loads(body)
+            registration_ids = payload.get('registration_ids')
+            topic = payload.get('to') or payload.get('condition')
+        except (ValueError, AttributeError):
+            return self._reply(400, b'Invalid JSON')
+        if topic is None and (not registration_ids or
+                              len(registration_ids) > MAX_MULTICAST):
+            return self._reply(400, b'Invalid number of registration ids')
+
+        status, retry_after = server._on_request(self.headers, payload)
+        delay = server.latency() if callable(server.latency) \
+            else server.latency
+        if delay:
+            time.sleep(delay)
+
+        if status != 200:
+            headers = {}
+            if retry_after:
+                headers['Retry-After'] = str(retry_after)
+            return self._reply(status, b'Server Error', headers)
+
+        if registration_ids:
+            response = server.response(registration_ids)
+        else:
+            response = server.topic_response(topic)
+        self._reply(200, server.codec.dumps(response),
+                    {'Content-Type': 'application/json'})
+
+    def _token(self, body):
+        """ OAuth2 token endpoint, accepting any JWT of the `api_key`
+            service account.
+        """
+        server = self.server
+        form = parse_qs(body.decode('utf-8'))
+        try:
+            assertion = form['assertion'][0]
+            claims = assertion.split('.')[1]
+            claims = json.loads(base64.urlsafe_b64decode(
+                claims + '=' * (-len(claims) % 4)).decode('utf-8'))
+        except (KeyError, IndexError, ValueError):
+            return self._reply(400, b'{"error":"invalid_request"}')
+        if server.api_key is not None and claims.get('iss') != server.api_key:
+            return self._reply(400, b'{"error":"invalid_grant"}')
+
+        response = server._issue_token(claims)
+        self._reply(200, server.codec.dumps(response),
+                    {'Content-Type': 'application/json'})
+
+    def _send_v1(self, body):
+        """ HTTP v1 send endpoint, one registration ID per request. """
+        server = self.server
+        authorization = self.headers.get('Authorization') or ''
+        if not server._valid_token(authorization[len('Bearer '):]):
+            return self._respond_v1(401, 'UNAUTHENTICATED')
+
+        try:
+            message = server.codec.loads(body)['message']
+        except (ValueError, KeyError, TypeError):
+            return self._respond_v1(400, 'INVALID_ARGUMENT')
+        token = message.get('token')
+
+        status, retry_after = server._on_request(
+            self.headers, message, 1 if token else 0)
+        delay = server.latency() if callable(server.latency) \
+            else server.latency
+        if delay:
+            time.sleep(delay)
+
+        headers = {}
+        if retry_after:
+            headers['Retry-After'] = str(retry_after)
+        if status != 200:
+            return self._respond_v1(status, 'UNAVAILABLE', headers=headers)
+
+        project = self.path.split('/')[-2]
+        if token is None:
+            message_id = next(server._message_ids)
+        else:
+            error = server.outcome(token)[0]
+            if error is not None:
+                status, name, code = _V1_ERRORS.get(
+                    error, (400, 'INVALID_ARGUMENT', error))
+                field = 'message.token' \
+                    if error == 'InvalidRegistration' else None
+                return self._respond_v1(status, name, code, headers, field)
+            message_id = server.message_id(token)
+
+        response = {'name': 'projects/%s/messages/%s' % (project, message_id)}
+        self._reply(200, server.codec.dumps(response),
+                    {'Content-Type': 'application/json'})
+
+    def _respond_v1(self, status, name, code=None, headers=None, field=None):
+        error = {'code': status, 'message': name, 'status': name}
+        if code is not None:
+            error['details'] = [{
+                '@type': 'type.googleapis.com/google.firebase.fcm.v1.FcmError',
+                'errorCode': code,
+            }]
+        if field is not None:
+            error.setdefault('details', []).append({
+                '@type': 'type.googleapis.com/google.rpc.BadRequest',
+                'fieldViolations': [{'field': field}],
+            })
+        headers = dict(headers or {}, **{'Content-Type': 'application/json'})
+        self._reply(status, self.server.codec.dumps({'error': error}),
+                    headers)
+
+    def _reply(self, status, body, headers=None):
+        """ Respond, compressing the body if the server is asked to and
+            the client accepts it.
+        """
+        if self.server.compress_responses and body and \
+                'gzip' in (self.headers.get('Accept-Encoding') or ''):
+            body = gzip_compress(body)
+            headers = dict(headers or {}, **{'Content-Encoding': 'gzip'})
+        self._respond(status, body, headers)
+
+
+class FakeFCMHandler(_FCMEndpoints, BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Answers FCM requests on keep-alive connections, HTTP/1.1 or
+        HTTP/2 with prior knowledge.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def handle(self):
+        self.server._on_connection()
+        peek = getattr(self.rfile, 'peek', None)
+        if peek is not None and \
+                peek(len(_HTTP2_PREFACE)).startswith(_HTTP2_PREFACE):
+            return _HTTP2Connection(self).serve()
+        BaseHTTPServer.BaseHTTPRequestHandler.handle(self)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        self._handle(self.rfile.read(length))
+
+    def _respond(self, status, body, headers=None):
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class _HTTP2Request(_FCMEndpoints):
+    """ Request on one stream of an HTTP/2 connection. """
+
+    def __init__(self, connection, stream_id, headers):
+        self.server = connection.server
+        self.connection = connection
+        self.stream_id = stream_id
+        self.headers = headers
+        self.path = headers.get(':path')
+
+    def _respond(self, status, body, headers=None):
+        self.connection.respond(self.stream_id, status, body, headers)
+
+
+class _HTTP2Connection(object):
+    """ Serves an HTTP/2 connection with `h2`, a thread per stream. """
+
+    def __init__(self, handler):
+        import h2.config
+        import h2.connection
+        import h2.events
+        import h2.settings
+
+        self.events = h2.events
+        self.handler = handler
+        self.server = handler.server
+        self.conn = h2.connection.H2Connection(h2.config.H2Configuration(
+            client_side=False, header_encoding='utf-8'))
+        self.conn.local_settings = h2.settings.Settings(
+            client=False, initial_values={
+                h2.settings.SettingCodes.MAX_CONCURRENT_STREAMS:
+                    self.server.max_streams})
+        # guards the connection state, notified on flow control updates
+        self.lock = threading.Condition()
+        self.streams = {}
+        self.closed = False
+
+    def serve(self):
+        with self.lock:
+            self.conn.initiate_connection()
+            self._flush()
+
+        events = self.events
+        while not self.closed:
+            data = self.handler.rfile.read1(65535)
+            if not data:
+                break
+            with self.lock:
+                for event in self.conn.receive_data(data):
+                    if isinstance(event, events.RequestReceived):
+                        self.streams[event.stream_id] = (
+                            CaseInsensitiveDict(event.headers), [])
+                    elif isinstance(event, events.DataReceived):
+                        self.streams[event.stream_id][1].append(event.data)
+                        self.conn.acknowledge_received_data(
+                            event.flow_controlled_length, event.stream_id)
+                    elif isinstance(event, events.StreamEnded):
+                        self._dispatch(event.stream_id)
+                    elif isinstance(event, events.ConnectionTerminated):
+                        self.closed = True
+                    elif isinstance(event, events.StreamReset):
+                        self.streams.pop(event.stream_id, None)
+                self._flush()
+                self.lock.notify_all()
+        with self.lock:
+            self.closed = True
+            self.lock.notify_all()
+
+    def _dispatch(self, stream_id):
+        headers, chunks = self.streams.pop(stream_id)
+        request = _HTTP2Request(self, stream_id, headers)
+        thread = threading.Thread(target=self._run, args=(request, chunks))
+        thread.daemon = True
+        thread.start()
+
+    def _run(self, request, chunks):
+        self.server._on_stream(1)
+        try:
+            if request.headers.get(':method') != 'POST':
+                return request._respond(501, b'')
+            request._handle(b''.join(chunks))
+        finally:
+            self.server._on_stream(-1)
+
+    def respond(self, stream_id, status, body, headers=None):
+        headers = [(':status', str(status)),
+                   ('content-length', str(len(body)))] + \
+            [(key.lower(), value) for key, value in (headers or {}).items()]
+        with self.lock:
+            self.conn.send_headers(stream_id, headers, end_stream=not body)
+            while body and not self.closed:
+                size = min(self.conn.local_flow_control_window(stream_id),
+                           self.conn.max_outbound_frame_size)
+                if size <= 0:
+                    # wait for the client to open the window
+                    self._flush()
+                    self.lock.wait()
+                    continue
+                self.conn.send_data(stream_id, body[:size],
+                                    end_stream=size >= len(body))
+                body = body[size:]
+            self._flush()
+
+    def _flush(self):
+        data = self.conn.data_to_send()
+        if data:
+            self.handler.connection.sendall(data)
+
+
+class FakeFCMServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    FakeFCMServer
+
+    HTTP server speaking the FCM legacy HTTP protocol, run from a background
+    thread with a thread per connection. Connections are kept alive, so the
+    connection pool of the client is exercised like against FCM. Clients
+    starting with the HTTP/2 connection preface are served HTTP/2, with a
+    thread per stream, which needs `h2 <https://python-hyper.org/h2>`_.
+
+    Per registration ID outcomes are drawn at random from `errors` and
+    `canonical_rate`, the rest succeeds. Use :func:`burst` to answer the
+    next requests with a 5xx error, `server_error_rate` for random ones.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 1024
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, errors=None,
+                 canonical_rate=0.0, server_error_rate=0.0, retry_after=None,
+                 api_key=None, record=False, seed=None,
+                 codec=DEFAULT_CODEC, access_token_ttl=3600, max_streams=100,
+                 compress_responses=False):
+        """
+        :param host: (str) address to listen on.
+        :param port: (int) port to listen on, 0 for any free one.
+        :param latency: (float) seconds to wait before answering, or a
+            callable returning them, like ``lambda: random.expovariate(20)``.
+        :param errors: (dict) ``{error code: rate}`` of per registration ID
+            errors, like ``{'Unavailable': 0.01, 'NotRegistered': 0.05}``.
+        :param canonical_rate: (float) rate of successes with a canonical ID.
+        :param server_error_rate: (float) rate of requests answered with 503.
+        :param retry_after: (int) ``Retry-After`` seconds sent with 5xx
+            errors.
+        :param api_key: (str) answer 401 to other API keys, and only issue
+            access tokens to the service account of this client email.
+        :param record: (bool) keep ``(headers, payload)`` of every request
+            in :attr:`requests`.
+        :param seed: seed of the outcomes.
+        :param codec: JSON codec, see :mod:`fcmclient.codec`.
+        :param access_token_ttl: (int) lifetime in seconds of the access
+            tokens issued.
+        :param max_streams: (int) max concurrent streams of an HTTP/2
+            connection.
+        :param compress_responses: (bool) gzip responses to clients
+            accepting it. Compressed requests are always accepted.
+        """
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port), FakeFCMHandler)
+        self.latency = latency
+        self.errors = sorted((errors or {}).items())
+        self.canonical_rate = canonical_rate
+        self.server_error_rate = server_error_rate
+        self.retry_after = retry_after
+        self.api_key = api_key
+        self.record = record
+        self.codec = codec
+        self.access_token_ttl = access_token_ttl
+        self.max_streams = max_streams
+        self.compress_responses = compress_responses
+        #: ``(headers, payload)`` of the requests, if recorded.
+        self.requests = []
+        #: number of requests and of registration ID's received.
+        self.request_count = 0
+        self.token_count = 0
+        #: number of request body bytes received, as sent.
+        self.bytes_received = 0
+        #: number of connections accepted.
+        self.connection_count = 0
+        #: max number of HTTP/2 streams served at the same time.
+        self.peak_streams = 0
+        self._streams = 0
+        #: number of access tokens issued.
+        self.access_token_count = 0
+        # {access token: expiry time}
+        self._access_tokens = {}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._bursts = []
+        self._message_ids = itertools.count(1)
+        self._multicast_ids = itertools.count(1)
+        self.thread = None
+        self.start()
+
+    @property
+    def url(self):
+        """ URL to pass to :class:`fcmclient.FCM`. """
+        host, port = self.server_address[:2]
+        return 'http://%s:%s/fcm/send' % (host, port)
+
+    @property
+    def v1_url(self):
+        """ URL to pass to :class:`fcmclient.v1.FCMv1`. """
+        host, port = self.server_address[:2]
+        return 'http://%s:%s/v1/projects/fake-project/messages:send' % (
+            host, port)
+
+    @property
+    def token_url(self):
+        """ Token endpoint to pass to :class:`fcmclient.v1.ServiceAccount`.
+        """
+        host, port = self.server_address[:2]
+        return 'http://%s:%s%s' % (host, port, TOKEN_PATH)
+
+    def start(self):
+        """ Serve from a background thread, done on construction. """
+        if self.thread is not None:
+            return
+        self.thread = threading.Thread(
+            target=self.serve_forever, kwargs={'poll_interval': 0.01},
+            name='fake-fcm-server')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """ Stop serving and close the socket. """
+        if self.thread is not None:
+            self.shutdown()
+            self.thread = None
+        self.server_close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def burst(self, count, status=503, retry_after=None):
+        """ Answer the next `count` requests with `status`, and a
+            ``Retry-After`` header if given.
+        """
+        with self._lock:
+            self._bursts.append([count, status, retry_after])
+
+    def _issue_token(self, claims):
+        """ Token response to a JWT with `claims`. """
+        with self._lock:
+            self.access_token_count += 1
+            token = 'fake-token-%d' % self.access_token_count
+            self._access_tokens[token] = time.time() + self.access_token_ttl
+        return {
+            'access_token': token,
+            'expires_in': self.access_token_ttl,
+            'token_type': 'Bearer',
+        }
+
+    def _valid_token(self, token):
+        return self._access_tokens.get(token, 0) > time.time()
+
+    def revoke_tokens(self):
+        """ Answer 401 to the access tokens issued so far. """
+        with self._lock:
+            self._access_tokens.clear()
+
+    def _on_body(self, size):
+        with self._lock:
+            self.bytes_received += size
+
+    def _on_connection(self):
+        with self._lock:
+            self.connection_count += 1
+
+    def _on_stream(self, delta):
+        with self._lock:
+            self._streams += delta
+            self.peak_streams = max(self.peak_streams, self._streams)
+
+    def _on_request(self, headers, payload, token_count=None):
+        """ Count the request and pick its status. """
+        if token_count is None:
+            token_count = len(payload.get('registration_ids') or ())
+        with self._lock:
+            self.request_count += 1
+            self.token_count += token_count
+            if self.record:
+                self.requests.append((headers, payload))
+
+            if self._bursts:
+                burst = self._bursts[0]
+                burst[0] -= 1
+                if burst[0] <= 0:
+                    self._bursts.pop(0)
+                return burst[1], burst[2] or self.retry_after
+            if self.server_error_rate and \
+                    self._random.random() < self.server_error_rate:
+                return 503, self.retry_after
+        return 200, None
+
+    def message_id(self, registration_id):
+        """ Message ID of a successful send to `registration_id`. """
+        return '0:%d' % next(self._message_ids)
+
+    def outcome(self, registration_id):
+        """ Random ``(error code or None, canonical)`` outcome of a send to
+            `registration_id`.
+        """
+        with self._lock:
+            draw = self._random.random()
+        return self._outcome(draw)
+
+    def _outcome(self, draw):
+        for error, rate in self.errors:
+            if draw < rate:
+                return error, False
+            draw -= rate
+        return None, draw < self.canonical_rate
+
+    def topic_response(self, topic):
+        """ JSON response to a message to a topic or condition. """
+        return {'message_id': next(self._message_ids)}
+
+    def response(self, registration_ids):
+        """ JSON response to a multicast to `registration_ids`. """
+        with self._lock:
+            draws = [self._random.random() for _ in registration_ids]
+            multicast_id = next(self._multicast_ids)
+
+        results = []
+        failure = canonical = 0
+        for registration_id, draw in zip(registration_ids, draws):
+            error, is_canonical = self._outcome(draw)
+            if error is not None:
+                results.append({'error': error})
+                failure += 1
+                continue
+            result = {'message_id': self.message_id(registration_id)}
+            if is_canonical:
+                result['registration_id'] = 'canonical-' + registration_id
+                canonical += 1
+            results.append(result)
+
+        return {
+            'multicast_id': multicast_id,
+            'success': len(results) - failure,
+            'failure': failure,
+            'canonical_ids': canonical,
+            'results': results,
+        }
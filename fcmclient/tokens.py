@@ -0,0 +1,359 @@
+# Copyright 2018 Joya Communications, John Loehrer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Bookkeeping of registration ID's (device tokens) across sends.
+"""
+
+import array
+import collections
+import hashlib
+import os
+import struct
+import tempfile
+import threading
+import time
+
+import six
+
+__all__ = ('TokenCache', 'TokenSet', 'token_digest')
+
+#: Errors telling a registration ID will never work again for this sender.
+DEAD_ERRORS = frozenset(['NotRegistered', 'InvalidRegistration',
+                         'MismatchSenderId'])
+
+#: Default seconds a registration ID is remembered.
+DEFAULT_TTL = 7 * 24 * 3600
+
+#: Default max number of registration ID's remembered.
+DEFAULT_MAX_SIZE = 1000000
+
+#: Bytes of a registration ID digest.
+DIGEST_SIZE = 16
+
+# 64 bit unsigned array items of TokenSet
+try:
+    array.array('Q')
+    _TYPECODE = 'Q'
+except ValueError:  # python 2, where long is 64 bit on 64 bit unix
+    _TYPECODE = 'L'
+
+_KEY = struct.Struct('<Q')
+
+
+def token_digest(token):
+    """ Fixed width digest of a registration ID. """
+    if isinstance(token, six.text_type):
+        token = token.encode('utf-8')
+    return hashlib.sha1(token).digest()[:DIGEST_SIZE]
+
+
+class TokenCache(object):
+    """
+    TokenCache
+
+    Remembers dead registration ID's, reported as ``NotRegistered``,
+    ``InvalidRegistration`` or ``MismatchSenderId``, and canonical ID's of
+    registration ID's, until your database catches up. Pass it to
+    :class:`fcmclient.FCM` as `token_cache`: every result fills it, and
+    messages are filtered through it before they are split and sent, so
+    dead registration ID's are dropped and others replaced by their
+    canonical ID.
+
+    Registration ID's are kept as :func:`token_digest` for `ttl` seconds.
+    Once `max_size` of them are known, the oldest entries are evicted.
+    Given a `path`, the cache is loaded from that file and :func:`save`
+    writes it back in a compact binary form.
+    """
+    # digest, expiry time, length of the canonical ID that follows
+    RECORD = struct.Struct('=%dsdH' % DIGEST_SIZE)
+
+    def __init__(self, ttl=DEFAULT_TTL, max_size=DEFAULT_MAX_SIZE, path=None,
+                 clock=time.time):
+        """
+        :param ttl: (float) seconds to remember a registration ID.
+        :param max_size: (int) max number of registration ID's.
+        :param path: (str) file to load from and :func:`save` to.
+        :param clock: (callable) wall clock time in seconds, expiry times
+            are saved.
+        """
+        self.ttl = ttl
+        self.max_size = max_size
+        self.path = path
+        self.clock = clock
+        # {digest: (expiry time, canonical ID or None if dead)}
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        if path is not None and os.path.exists(path):
+            self.load()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add_dead(self, token):
+        """ Remember `token` as dead. """
+        self._add(token_digest(token), None)
+
+    def add_canonical(self, token, canonical_id):
+        """ Remember to send to `canonical_id` instead of `token`. """
+        self._add(token_digest(token), canonical_id)
+
+    def _add(self, digest, canonical_id):
+        with self._lock:
+            self._entries.pop(digest, None)
+            self._entries[digest] = (self.clock() + self.ttl, canonical_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def is_dead(self, token):
+        """ True if `token` is known to be dead. """
+        entry = self._get(token_digest(token), self.clock())
+        return entry is not None and entry[1] is None
+
+    def canonical(self, token):
+        """ Canonical ID of `token`, or None. """
+        entry = self._get(token_digest(token), self.clock())
+        return None if entry is None else entry[1]
+
+    def _get(self, digest, now):
+        entry = self._entries.get(digest)
+        if entry is not None and entry[0] <= now:
+            with self._lock:
+                self._entries.pop(digest, None)
+            return None
+        return entry
+
+    def filter(self, registration_ids):
+        """ `registration_ids` without dead ones, replaced by their canonical
+            ID's where known.
+
+            :return: list, or None if nothing changed.
+        """
+        if not self._entries:
+            return None
+
+        now = self.clock()
+        result = None
+        for i, token in enumerate(registration_ids):
+            entry = self._get(token_digest(token), now)
+            if entry is None:
+                if result is not None:
+                    result.append(token)
+                continue
+
+            if result is None:
+                result = list(registration_ids[:i])
+            if entry[1] is not None:
+                result.append(entry[1])
+        return result
+
+    def filter_message(self, message):
+        """ Message with the registration ID's of `message` passed through
+            :func:`filter`, `message` itself if nothing changed, or None if
+            all of them are dead.
+        """
+        registration_ids = self.filter(message.registration_ids)
+        if registration_ids is None:
+            return message
+        if not registration_ids:
+            return None
+        return message._retry(registration_ids)
+
+    def update(self, result):
+        """ Remember the dead registration ID's and canonical ID's of a
+            :class:`fcmclient.Result`.
+        """
+        if result.failure_count:
+            for token in result.not_registered:
+                self.add_dead(token)
+            for token, error in result.failed.items():
+                if error in DEAD_ERRORS:
+                    self.add_dead(token)
+        if result.canonical_count:
+            for token, canonical_id in result.canonical.items():
+                self.add_canonical(token, canonical_id)
+
+    def load(self):
+        """ Read the entries saved in `path`, skipping expired ones. """
+        now = self.clock()
+        size = self.RECORD.size
+        with open(self.path, 'rb') as f:
+            data = f.read()
+
+        entries = []
+        offset = 0
+        while offset + size <= len(data):
+            digest, expires, length = self.RECORD.unpack_from(data, offset)
+            offset += size
+            canonical_id = None
+            if length:
+                canonical_id = data[offset:offset + length].decode('utf-8')
+                offset += length
+            if expires > now:
+                entries.append((digest, (expires, canonical_id)))
+
+        with self._lock:
+            for digest, entry in entries:
+                self._entries.pop(digest, None)
+                self._entries[digest] = entry
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def save(self):
+        """ Write the live entries to `path`, replacing it atomically. """
+        now = self.clock()
+        with self._lock:
+            entries = list(self._entries.items())
+
+        chunks = []
+        for digest, (expires, canonical_id) in entries:
+            if expires <= now:
+                continue
+            if canonical_id is None:
+                chunks.append(self.RECORD.pack(digest, expires, 0))
+            else:
+                encoded = canonical_id.encode('utf-8')
+                chunks.append(self.RECORD.pack(digest, expires, len(encoded)))
+                chunks.append(encoded)
+
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix='.fcm-tokens')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(b''.join(chunks))
+            os.rename(tmp, self.path)
+        except Exception:
+            os.unlink(tmp)
+            raise
+
+
+class TokenSet(object):
+    """
+    TokenSet
+
+    Set of registration ID's for deduplicating a campaign, see the `dedupe`
+    argument of :func:`fcmclient.FCM.send_many` and
+    :func:`fcmclient.FCM.iter_send`.
+
+    Only a 64 bit digest of each registration ID is kept, in an open
+    addressing hash table on a flat array, which takes 11 to 22 bytes per
+    registration ID instead of about 200 for a ``set`` of 152 character
+    strings: ten million registration ID's take at most about 210 MB. Two
+    different registration ID's share a digest with a chance of about
+    ``n * n / 2 ** 65``, one in 370000 for ten million, in which case the
+    second one is taken for a duplicate.
+    """
+    MAX_LOAD = 0.75
+
+    def __init__(self, capacity=1024):
+        """
+        :param capacity: (int) expected number of registration ID's, the
+            table grows as needed.
+        """
+        size = 8
+        while size * self.MAX_LOAD < capacity:
+            size <<= 1
+        self._resize(size)
+        self._len = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._len
+
+    def __contains__(self, token):
+        key = self._key(token)
+        table, mask = self._table, self._mask
+        i = key & mask
+        while True:
+            slot = table[i]
+            if slot == key:
+                return True
+            if not slot:
+                return False
+            i = (i + 1) & mask
+
+    @staticmethod
+    def _key(token):
+        # 0 marks a free slot
+        return _KEY.unpack_from(token_digest(token))[0] or 1
+
+    def _resize(self, size):
+        self._table = array.array(_TYPECODE, [0]) * size
+        self._mask = size - 1
+        self._max_len = int(size * self.MAX_LOAD)
+
+    def _insert(self, key):
+        table, mask = self._table, self._mask
+        i = key & mask
+        while True:
+            slot = table[i]
+            if not slot:
+                break
+            if slot == key:
+                return False
+            i = (i + 1) & mask
+
+        table[i] = key
+        self._len += 1
+        if self._len > self._max_len:
+            self._grow()
+        return True
+
+    def _grow(self):
+        old = self._table
+        self._resize(len(old) * 2)
+        table, mask = self._table, self._mask
+        for key in old:
+            if not key:
+                continue
+            i = key & mask
+            while table[i]:
+                i = (i + 1) & mask
+            table[i] = key
+
+    def add(self, token):
+        """ Add `token`.
+
+            :return: True if it was not in the set yet.
+        """
+        key = self._key(token)
+        with self._lock:
+            return self._insert(key)
+
+    def filter(self, registration_ids):
+        """ Add `registration_ids`, returning those that were not in the set
+            yet, in order.
+
+            :return: list, or None if all of them were new.
+        """
+        result = None
+        with self._lock:
+            for i, token in enumerate(registration_ids):
+                if self._insert(self._key(token)):
+                    if result is not None:
+                        result.append(token)
+                elif result is None:
+                    result = list(registration_ids[:i])
+        return result
+
+    def filter_message(self, message):
+        """ Message with the registration ID's of `message` passed through
+            :func:`filter`, `message` itself if nothing changed, or None if
+            all of them were seen before.
+        """
+        registration_ids = self.filter(message.registration_ids)
+        if registration_ids is None:
+            return message
+        if not registration_ids:
+            return None
+        return message._retry(registration_ids)
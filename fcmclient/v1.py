@@ -0,0 +1,614 @@
+# Copyright 2018 Joya Communications, John Loehrer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Client for the FCM HTTP v1 API, authenticated with a service account::
+
+    pip install fcm-client[v1]
+
+The v1 API takes one registration ID per request and an OAuth2 access
+token instead of the API key. :class:`FCMv1` sends the usual
+:class:`fcmclient.JSONMessage` and :class:`fcmclient.TopicMessage` objects,
+fanning multicasts out to one request per registration ID over its pooled
+connections, and returns the same :class:`fcmclient.Result` objects, with
+v1 error codes translated to their legacy counterparts (see
+:data:`ERROR_CODES`).
+
+Access tokens are obtained with a JWT signed locally with the private key of
+the service account, which needs `cryptography
+<https://cryptography.io>`_. One token per service account is shared by
+all clients of the process and refreshed from a background thread ahead of
+its expiry, so sends do not wait for it.
+
+This module is not imported by :mod:`fcmclient`, import it explicitly::
+
+    from fcmclient.v1 import FCMv1
+"""
+
+import base64
+import json
+import logging
+import os
+import threading
+import time
+from concurrent import futures
+
+import requests
+import six
+
+from .api import FCM, FCMAuthenticationError, TopicMessage, TOPIC_PREFIX, \
+    RETRY_ERRORS, _DECODED, _clock
+
+__all__ = ('FCMv1', 'ServiceAccount', 'AccessTokenProvider', 'get_provider')
+
+log = logging.getLogger(__name__)
+
+#: Default URL of the v1 send endpoint, formatted with the project ID.
+FCM_V1_URL = 'https://fcm.googleapis.com/v1/projects/%s/messages:send'
+
+#: Default Google OAuth2 token endpoint.
+TOKEN_URL = 'https://oauth2.googleapis.com/token'
+
+#: OAuth2 scopes needed to send messages.
+SCOPES = ('https://www.googleapis.com/auth/firebase.messaging',)
+
+#: Default seconds before expiry an access token is refreshed.
+DEFAULT_REFRESH_MARGIN = 300
+
+#: v1 error codes and the legacy error codes they are reported as, others
+#: are reported as they are. Retryable responses, 5xx and 429, are reported
+#: as ``Unavailable``, and ``INVALID_ARGUMENT`` responses blaming the
+#: registration ID as ``InvalidRegistration``.
+ERROR_CODES = {
+    'UNREGISTERED': 'NotRegistered',
+    'SENDER_ID_MISMATCH': 'MismatchSenderId',
+    'UNAVAILABLE': 'Unavailable',
+    'INTERNAL': 'InternalServerError',
+    'QUOTA_EXCEEDED': 'DeviceMessageRateExceeded',
+    'THIRD_PARTY_AUTH_ERROR': 'InvalidApnsCredential',
+}
+
+_JWT_GRANT = 'urn:ietf:params:oauth:grant-type:jwt-bearer'
+
+# field of an invalid registration ID in ``BadRequest`` error details
+_TOKEN_FIELD = 'message.token'
+
+# lifetime of the signed JWT, the max Google accepts
+_JWT_LIFETIME = 3600
+
+# a token this close to its expiry, or a quarter of its lifetime if less,
+# is not used anymore
+_EXPIRY_SKEW = 10.0
+
+# max seconds between attempts of a failing background refresh
+_MAX_REFRESH_DELAY = 60.0
+
+# legacy options and where they go in a v1 android config
+_ANDROID_OPTIONS = {
+    'collapse_key': ('collapse_key', lambda v: v),
+    'priority': ('priority', lambda v: v.upper()),
+    'time_to_live': ('ttl', lambda v: '%ds' % v),
+    'restricted_package_name': ('restricted_package_name', lambda v: v),
+}
+
+# v1 message fields passed through from the payload as they are
+_V1_FIELDS = ('android', 'apns', 'webpush', 'fcm_options')
+
+
+def _b64(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=')
+
+
+def _rs256_signer(private_key):
+    """ Sign with the PEM encoded RSA `private_key`, using cryptography. """
+    try:
+        from cryptography.hazmat.backends import default_backend
+        from cryptography.hazmat.primitives import hashes, serialization
+        from cryptography.hazmat.primitives.asymmetric import padding
+    except ImportError:
+        raise ImportError("Signing service account JWTs requires "
+                          "cryptography: pip install fcm-client[v1]")
+
+    if isinstance(private_key, six.text_type):
+        private_key = private_key.encode('utf-8')
+    key = serialization.load_pem_private_key(
+        private_key, password=None, backend=default_backend())
+    return lambda data: key.sign(data, padding.PKCS1v15(), hashes.SHA256())
+
+
+class ServiceAccount(object):
+    """
+    ServiceAccount
+
+    Service account credentials, exchanged for OAuth2 access tokens.
+    """
+
+    def __init__(self, info, token_url=None, scopes=SCOPES, signer=None):
+        """
+        :param info: (dict or str) service account key as downloaded from
+            the Firebase console, or the path of its JSON file.
+        :param token_url: (str) OAuth2 token endpoint, defaults to the
+            ``token_uri`` of the key.
+        :param scopes: (tuple) OAuth2 scopes to request.
+        :param signer: (callable) signs bytes with the private key of the
+            account, defaults to RS256 with `cryptography`.
+        """
+        if isinstance(info, six.string_types):
+            with open(info) as f:
+                info = json.load(f)
+
+        self.client_email = info['client_email']
+        self.project_id = info.get('project_id')
+        self.private_key_id = info.get('private_key_id')
+        self.token_url = token_url or info.get('token_uri') or TOKEN_URL
+        self.scopes = tuple(scopes)
+        self._sign = signer or _rs256_signer(info['private_key'])
+
+    @property
+    def key(self):
+        """ Accounts with equal keys share their access token. """
+        return self.client_email, self.token_url, self.scopes
+
+    def assertion(self, now=None):
+        """ Signed JWT to exchange for an access token. """
+        now = int(time.time() if now is None else now)
+        header = {'alg': 'RS256', 'typ': 'JWT'}
+        if self.private_key_id:
+            header['kid'] = self.private_key_id
+        claims = {
+            'iss': self.client_email,
+            'scope': ' '.join(self.scopes),
+            'aud': self.token_url,
+            'iat': now,
+            'exp': now + _JWT_LIFETIME,
+        }
+        signed = b'.'.join(
+            _b64(json.dumps(part, separators=(',', ':')).encode('utf-8'))
+            for part in (header, claims))
+        return (signed + b'.' + _b64(self._sign(signed))).decode('ascii')
+
+    def fetch_token(self, session, timeout=None):
+        """
+        Exchange a fresh :func:`assertion` for an access token.
+
+        :return: tuple of the access token and its lifetime in seconds.
+        :raises:
+            - :class:`fcmclient.FCMAuthenticationError` if the account is
+              rejected.
+            - ``requests.exceptions.RequestException`` on network problems
+              and server errors.
+        """
+        response = session.post(self.token_url, timeout=timeout, data={
+            'grant_type': _JWT_GRANT,
+            'assertion': self.assertion(),
+        })
+        if response.status_code in (400, 401, 403):
+            raise FCMAuthenticationError(
+                "Service account rejected: %s" % response.text)
+        response.raise_for_status()
+        data = response.json()
+        return data['access_token'], float(data.get('expires_in', 3600))
+
+
+class AccessTokenProvider(object):
+    """
+    AccessTokenProvider
+
+    Keeps a valid access token of a :class:`ServiceAccount` at hand.
+
+    A daemon thread fetches the first token as soon as the provider is
+    started, and a new one `refresh_margin` seconds before the current one
+    expires, or half way through its lifetime if that is shorter. Failed
+    refreshes are retried with backoff while the current token is still
+    good. :func:`get` only fetches a token itself if there is no valid one,
+    that is before the first fetch completed or after refreshing failed for
+    the whole margin.
+
+    Use :func:`get_provider` to share one provider per service account in
+    the process. A forked child starts its own thread on first use.
+    """
+
+    def __init__(self, account, refresh_margin=DEFAULT_REFRESH_MARGIN,
+                 timeout=10.0, clock=time.time):
+        """
+        :param account: (:class:`ServiceAccount`) account to authenticate.
+        :param refresh_margin: (float) seconds before expiry to refresh.
+        :param timeout: (float) timeout of token requests in seconds.
+        :param clock: (callable) wall clock time in seconds.
+        """
+        self.account = account
+        self.refresh_margin = refresh_margin
+        self.timeout = timeout
+        self.clock = clock
+        #: number of tokens fetched.
+        self.fetch_count = 0
+        # (token, time it is good until, refresh time), replaced as a whole
+        self._current = (None, 0.0, 0.0)
+        self._pid = None
+        self._stopped = False
+        self._reset()
+
+    def _reset(self):
+        """ Fresh locks, session and thread for this process. """
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._session = requests.Session()
+        self._thread = None
+
+    def get(self):
+        """ A valid access token, fetched right away if there is none. """
+        if self._thread is None or self._pid != os.getpid():
+            self.start()
+        token, valid_until, _ = self._current
+        if token is not None and valid_until > self.clock():
+            return token
+        return self.refresh(force=False)
+
+    def refresh(self, force=True):
+        """ Fetch a new access token, unless another thread just did and
+            `force` is False.
+        """
+        return self._refresh(None if force else 1)
+
+    def _refresh(self, due):
+        """ Fetch a new access token, unless the current one is good until
+            after now by the time at index `due` of ``_current``. Checked
+            under the lock, so concurrent callers fetch only once.
+        """
+        with self._lock:
+            current = self._current
+            if due is not None and current[0] is not None and \
+                    current[due] > self.clock():
+                return current[0]
+
+            started = self.clock()
+            token, lifetime = self.account.fetch_token(
+                self._session, timeout=self.timeout)
+            expires = started + lifetime
+            self._current = (
+                token,
+                expires - min(_EXPIRY_SKEW, lifetime / 4.0),
+                expires - min(self.refresh_margin, lifetime / 2.0))
+            self.fetch_count += 1
+        self._wakeup.set()
+        return token
+
+    def invalidate(self, token):
+        """ Stop using `token`, after FCM rejected it. """
+        with self._lock:
+            if self._current[0] == token:
+                self._current = (None, 0.0, 0.0)
+        self._wakeup.set()
+
+    def start(self):
+        """ Start the refresh thread, if not running in this process. """
+        with self._start_lock:
+            if self._pid != os.getpid():
+                self._reset()
+            if self._thread is not None:
+                return
+            self._stopped = False
+            self._thread = threading.Thread(
+                target=self._run, name='fcm-token-refresh')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        """ Stop the refresh thread. """
+        self._stopped = True
+        self._wakeup.set()
+        thread, self._thread = self._thread, None
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+    def _run(self):
+        failures = 0
+        while not self._stopped:
+            self._wakeup.clear()
+            token, _, refresh_at = self._current
+            wait = refresh_at - self.clock()
+            if token is None or wait <= 0:
+                try:
+                    self._refresh(2)
+                    failures = 0
+                    continue
+                except Exception:
+                    failures += 1
+                    wait = min(_MAX_REFRESH_DELAY, 2 ** failures)
+                    log.warning("Refreshing FCM access token failed",
+                                exc_info=True)
+            self._wakeup.wait(wait)
+
+
+_providers = {}
+_providers_lock = threading.Lock()
+
+
+def get_provider(account, refresh_margin=DEFAULT_REFRESH_MARGIN):
+    """ The :class:`AccessTokenProvider` of the process for `account`. """
+    with _providers_lock:
+        provider = _providers.get(account.key)
+        if provider is None:
+            provider = _providers[account.key] = AccessTokenProvider(
+                account, refresh_margin=refresh_margin)
+        return provider
+
+
+class _Response(object):
+    """ Legacy response assembled from v1 responses, decoded already. """
+
+    def __init__(self, status_code, retry_after, data):
+        self.status_code = status_code
+        self.headers = {'Retry-After': str(retry_after or 0)}
+        self.content = data
+
+
+class FCMv1(FCM):
+    """
+    FCMv1
+
+    Sends messages with the FCM HTTP v1 API. Takes all the arguments of
+    :class:`fcmclient.FCM` but the API key, and works the same way.
+
+    A multicast to N registration ID's takes N requests, sent in parallel on
+    up to `concurrency` threads shared by all sends of the client. The
+    result covers all of them: a registration ID whose request failed with a
+    network error, a 5xx or a 429 is to be retried, the result only has the
+    5xx status code if this is the case for all of them. A network error is
+    raised if all requests failed with one.
+    """
+
+    def __init__(self, credentials, project_id=None, url=None,
+                 concurrency=None, refresh_margin=DEFAULT_REFRESH_MARGIN,
+                 **kwargs):
+        """
+        :param credentials: (:class:`ServiceAccount`, dict or str) service
+            account, or the arguments of one.
+        :param project_id: (str) Firebase project, defaults to the one of
+            the service account.
+        :param url: (str) v1 send endpoint, defaults to :data:`FCM_V1_URL`.
+        :param concurrency: (int) max parallel requests of this client, and
+            the number of its threads. Defaults to `pool_size`, times
+            `max_streams` with ``http2`` but at most
+            :data:`fcmclient.api.DEFAULT_MAX_CONCURRENCY`.
+        :param refresh_margin: (float) seconds before expiry the access
+            token is refreshed, see :class:`AccessTokenProvider`.
+        :param kwargs: arguments of :class:`fcmclient.FCM`.
+        """
+        if not isinstance(credentials, ServiceAccount):
+            credentials = ServiceAccount(credentials)
+        self.credentials = credentials
+        self.project_id = project_id or credentials.project_id
+        if url is None:
+            if not self.project_id:
+                raise ValueError("Firebase project ID is required")
+            url = FCM_V1_URL % self.project_id
+
+        self.provider = get_provider(credentials, refresh_margin)
+        # fetches the first token in the background
+        self.provider.start()
+
+        # the service account takes the place of the API key
+        super(FCMv1, self).__init__(credentials.client_email, url=url,
+                                    **kwargs)
+        self.concurrency = concurrency or self._max_concurrency()
+        self._executor = futures.ThreadPoolExecutor(
+            max_workers=self.concurrency)
+
+    def _create_session(self):
+        session = super(FCMv1, self)._create_session()
+        # a bearer token is set per request
+        del session.headers['Authorization']
+        return session
+
+    def warm_up(self):
+        """ Fetch the access token and connect to FCM ahead of the first
+            send. Problems are not raised here.
+        """
+        try:
+            self.provider.get()
+        except (requests.exceptions.RequestException,
+                FCMAuthenticationError):
+            pass
+        super(FCMv1, self).warm_up()
+
+    def close(self):
+        """ Close all pooled connections and stop the send threads. """
+        self._executor.shutdown()
+        super(FCMv1, self).close()
+
+    def encode(self, message):
+        """ v1 request bodies of `message`, one per registration ID, or one
+            for a :class:`fcmclient.TopicMessage`.
+        """
+        codec = self.codec
+        payload = message.payload
+        base = _v1_message(payload, codec)
+        if isinstance(message, TopicMessage):
+            if message.topic is not None:
+                base['topic'] = message.topic[len(TOPIC_PREFIX):]
+            else:
+                base['condition'] = message.condition
+            body = {'message': base}
+            if payload.get('dry_run'):
+                body['validate_only'] = True
+            return [codec.dumps(body)]
+
+        # the shared part is encoded once, the token spliced in per request
+        head = b'{"validate_only":true,' if payload.get('dry_run') else b'{'
+        head += b'"message":'
+        head += codec.dumps(base)[:-1] + b',' if base else b'{'
+        head += b'"token":'
+        return [head + codec.dumps(token) + b'}}'
+                for token in message.registration_ids]
+
+    def _post(self, message, event=None):
+        """ Post the v1 requests of message and merge their responses. """
+        started = _clock()
+        bodies = [self._compress(body) for body in self.encode(message)]
+        encoded = _clock()
+        if len(bodies) == 1:
+            responses = [self._post_one(bodies[0])]
+        else:
+            responses = list(self._executor.map(self._post_one, bodies))
+        received = _clock()
+
+        response = self._merge(message, responses)
+        if event is not None:
+            event.payload_bytes = sum(len(body) for body, _ in bodies)
+            event.status_code = response.status_code
+            event.timings['encode'] = encoded - started
+            event.timings['request'] = received - encoded
+        try:
+            return message._result(response, self.backoff, codec=_DECODED)
+        finally:
+            if event is not None:
+                event.timings['decode'] = _clock() - received
+
+    def _post_one(self, request):
+        """ Post one v1 request, a ``(body, headers)`` tuple, returning the
+            response or the network error. A rejected access token is
+            replaced once.
+        """
+        body, headers = request
+        headers = dict(headers or {})
+        for attempt in range(2):
+            try:
+                token = self.provider.get()
+                headers['Authorization'] = 'Bearer %s' % token
+                response = self.session.post(
+                    self.url, data=body, headers=headers,
+                    **self.requests_options)
+            except requests.exceptions.RequestException as e:
+                return e
+            if response.status_code != 401 or \
+                    self._error_code(response) is not None:
+                return response
+            self.provider.invalidate(token)
+        raise FCMAuthenticationError("Authentication Error")
+
+    def _error_code(self, response):
+        """ FCM error code of a v1 error response, if any. """
+        try:
+            error = self.codec.loads(response.content)['error']
+        except (ValueError, KeyError, TypeError):
+            return None
+        code = None
+        invalid_token = False
+        for detail in error.get('details') or ():
+            if code is None:
+                code = detail.get('errorCode')
+            for violation in detail.get('fieldViolations') or ():
+                if violation.get('field') == _TOKEN_FIELD:
+                    invalid_token = True
+        if invalid_token and (code or error.get('status')) == \
+                'INVALID_ARGUMENT':
+            # the same payload may well be valid for other tokens
+            return 'InvalidRegistration'
+        return code
+
+    def _merge(self, message, responses):
+        """ Legacy response covering all v1 `responses` of `message`. """
+        results = []
+        failure = 0
+        retryable = 0
+        status_code = None
+        retry_after = 0
+        for response in responses:
+            if isinstance(response, Exception):
+                results.append({'error': 'Unavailable'})
+                failure += 1
+                retryable += 1
+                continue
+
+            if response.status_code == 200:
+                name = self.codec.loads(response.content).get('name')
+                results.append({'message_id': name})
+                continue
+
+            failure += 1
+            try:
+                retry_after = max(retry_after, int(
+                    response.headers.get('Retry-After', 0)))
+            except ValueError:
+                pass
+            error = self._error_code(response)
+            if error is None:
+                try:
+                    data = self.codec.loads(response.content)
+                    error = data['error']['status']
+                except (ValueError, KeyError, TypeError):
+                    error = 'HTTP %d' % response.status_code
+            error = ERROR_CODES.get(error, error)
+
+            if response.status_code >= 500 or response.status_code == 429:
+                retryable += 1
+                if response.status_code >= 500 and status_code is None:
+                    status_code = response.status_code
+                if error not in RETRY_ERRORS:
+                    error = 'Unavailable'
+            results.append({'error': error})
+
+        if retryable == len(responses):
+            if status_code is None:
+                errors = [e for e in responses if isinstance(e, Exception)]
+                if len(errors) == len(responses):
+                    raise errors[0]
+                status_code = 503
+            return _Response(status_code, retry_after, None)
+
+        if isinstance(message, TopicMessage):
+            return _Response(200, retry_after, results[0])
+        return _Response(200, retry_after, {
+            'multicast_id': None,
+            'success': len(results) - failure,
+            'failure': failure,
+            'canonical_ids': 0,
+            'results': results,
+        })
+
+
+def _v1_message(payload, codec):
+    """ v1 message fields of a legacy payload, but the target. """
+    message = {}
+    data = payload.get('data')
+    if data:
+        # v1 data values are strings
+        message['data'] = {
+            k: v if isinstance(v, six.string_types)
+            else codec.dumps(v).decode('utf-8')
+            for k, v in six.iteritems(data)}
+
+    android = {}
+    notification = payload.get('notification')
+    if notification:
+        notification = dict(notification)
+        message['notification'] = {}
+        if 'title' in notification:
+            message['notification']['title'] = notification.pop('title')
+        if 'text' in notification:
+            message['notification']['body'] = notification.pop('text')
+        if notification:
+            android['notification'] = notification
+
+    for option, (field, convert) in six.iteritems(_ANDROID_OPTIONS):
+        if option in payload:
+            android[field] = convert(payload[option])
+    for field in _V1_FIELDS:
+        if field in payload:
+            message[field] = dict(payload[field])
+    if android:
+        message['android'] = dict(android, **message.get('android', {}))
+    return message
@@ -29,7 +29,12 @@ setup(
     packages=[PKGNAME],
     license="Apache 2.0",
     keywords='fcm push notification google cloud messaging android',
-    install_requires=['requests', 'six'],
+    install_requires=['requests', 'six', 'futures; python_version < "3"'],
+    extras_require={
+        'async': ['aiohttp; python_version >= "3.6"'],
+        'v1': ['cryptography'],
+        'http2': ['httpx[http2]; python_version >= "3.6"'],
+    },
     entry_points={
         'console_scripts': ['%s = %s.cli:main' % (PKGNAME, PKGNAME)]
     },
@@ -1,10 +1,45 @@
 import unittest
+import requests
 import requests_mock
+import mock
 import string
 import random
 import pickle
+import collections
+import json
+import os
+import shutil
+import tempfile
+import zlib
+import threading
+import time
+import six
 import fcmclient
 import fcmclient.api
+import fcmclient.bench
+import fcmclient.cli
+import fcmclient.bulk
+import fcmclient.codec
+import fcmclient.limits
+import fcmclient.testing
+import fcmclient.v1
+
+try:
+    import asyncio
+    import fcmclient.aio
+except (ImportError, SyntaxError):
+    asyncio = None
+
+try:
+    import h2
+    import fcmclient.http2
+except ImportError:
+    h2 = None
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
 
 API_KEY_CHARSET = string.ascii_letters + string.digits
 REG_ID_CHARSET = string.ascii_letters + string.digits + '-_/'
@@ -18,6 +53,17 @@ def generate_api_key():
     return ''.join([random.choice(API_KEY_CHARSET) for _ in range(40)])
 
 
+class LocalFCMServer(fcmclient.testing.FakeFCMServer):
+    """ Stand-in for FCM recording requests, message ID's name the ID. """
+
+    def __init__(self, **kwargs):
+        kwargs.setdefault('record', True)
+        fcmclient.testing.FakeFCMServer.__init__(self, **kwargs)
+
+    def message_id(self, registration_id):
+        return '1:%s' % registration_id
+
+
 class FCMClientTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -60,6 +106,1837 @@ class FCMClientTestCase(unittest.TestCase):
             return fcmclient.FCM(self.api_key).send(message)
 
 
+class FCMSessionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.api_key = generate_api_key()
+        self.reg_id = generate_reg_id()
+
+    def response(self, count=1):
+        return {
+            "multicast_id": 1,
+            "success": count,
+            "canonical_ids": 0,
+            "results": [{"message_id": "1:%s" % i} for i in range(count)]
+        }
+
+    def test_session_reused(self):
+        client = fcmclient.FCM(self.api_key, timeout=5)
+        session = client.session
+        message = fcmclient.JSONMessage([self.reg_id], {'foo': 'bar'})
+        with requests_mock.Mocker() as m:
+            m.post(fcmclient.api.FCM_URL, json=self.response())
+            client.send(message)
+            client.send(message)
+            self.assertEqual(m.call_count, 2)
+            for req in m.request_history:
+                self.assertEqual(req.headers['Authorization'],
+                                 'key=%s' % self.api_key)
+                self.assertEqual(req.timeout, 5)
+        self.assertIs(client.session, session)
+
+    def test_pool_size(self):
+        client = fcmclient.FCM(self.api_key, pool_size=32)
+        adapter = client.session.get_adapter(fcmclient.api.FCM_URL)
+        self.assertEqual(adapter._pool_maxsize, 32)
+
+    def test_warm_up(self):
+        with requests_mock.Mocker() as m:
+            m.head(fcmclient.api.FCM_URL, status_code=405)
+            fcmclient.FCM(self.api_key, warm_up=True)
+            self.assertEqual(m.call_count, 1)
+
+    def test_context_manager(self):
+        with fcmclient.FCM(self.api_key) as client:
+            client.session.close = mock.Mock()
+        client.session.close.assert_called_once_with()
+
+
+class LazyResultTestCase(unittest.TestCase):
+
+    def create_response(self, **kwargs):
+        req = requests_mock.adapter._RequestObjectProxy._create(
+            'post',
+            fcmclient.api.FCM_URL,
+            {})
+        return requests_mock.create_response(req, **kwargs)
+
+    def result(self, results, **counts):
+        message = fcmclient.JSONMessage(
+            [str(i) for i in range(len(results))])
+        body = {"multicast_id": 1, "results": results}
+        body.update(counts)
+        response = self.create_response(json=body, status_code=200)
+        return fcmclient.Result(message, response, 1000)
+
+    def test_counts_without_parsing(self):
+        res = self.result(
+            [{"message_id": "1:0"}, {"message_id": "1:1"}],
+            success=2, failure=0, canonical_ids=0)
+        with mock.patch.object(fcmclient.Result, '_parse_response') as parse:
+            self.assertEqual(res.success_count, 2)
+            self.assertEqual(res.failure_count, 0)
+            self.assertEqual(res.canonical_count, 0)
+            self.assertFalse(res.needs_retry())
+            self.assertFalse(parse.called)
+        self.assertEqual(res.success, {'0': '1:0', '1': '1:1'})
+
+    def test_parse_failures(self):
+        res = self.result(
+            [{"message_id": "1:0", "registration_id": "c"},
+             {"error": "Unavailable"},
+             {"error": "NotRegistered"}],
+            success=1, failure=2, canonical_ids=1)
+        self.assertEqual(res.multicast_id, 1)
+        self.assertTrue(res.needs_retry())
+        self.assertEqual(res.retry().registration_ids, ['1'])
+        self.assertEqual(res.canonical, {'0': 'c'})
+        self.assertEqual(res.not_registered, ['2'])
+
+    def test_decode_once(self):
+        response = self.create_response(json={
+            "multicast_id": 1, "success": 1, "failure": 1,
+            "canonical_ids": 0,
+            "results": [{"message_id": "1:0"}, {"error": "NotRegistered"}]},
+            status_code=200)
+        codec = mock.Mock(wraps=fcmclient.JSONCodec())
+        res = fcmclient.Result(fcmclient.JSONMessage(['0', '1']), response,
+                               1000, codec=codec)
+        self.assertEqual(res.not_registered, ['1'])
+        self.assertEqual(res.success, {'0': '1:0'})
+        self.assertEqual(res.error_counts, {'NotRegistered': 1})
+        self.assertEqual(codec.loads.call_count, 1)
+
+    @unittest.skipIf(tracemalloc is None, "tracemalloc not available")
+    def test_retained_size(self):
+        results = [{"message_id": "0:%d" % (1500000000000000 + i)}
+                   for i in range(1000)]
+        message = fcmclient.JSONMessage([str(i) for i in range(1000)])
+        response = self.create_response(json={
+            "multicast_id": 1, "success": 1000, "failure": 0,
+            "canonical_ids": 0, "results": results}, status_code=200)
+        content = response.content
+
+        tracemalloc.start()
+        try:
+            res = fcmclient.Result(message, response, 1000)
+            retained, _ = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        self.assertTrue(retained < len(content),
+                        (retained, len(content)))
+        self.assertEqual(res.success['999'], '0:1500000000000999')
+
+    def test_counts_missing_from_response(self):
+        res = self.result(
+            [{"message_id": "1:0", "registration_id": "c"},
+             {"error": "Unavailable"},
+             {"error": "InvalidRegistration"}])
+        self.assertEqual(res.success_count, 1)
+        self.assertEqual(res.failure_count, 2)
+        self.assertEqual(res.canonical_count, 1)
+
+    def test_invalid_response(self):
+        message = fcmclient.JSONMessage(['A', 'B'])
+        response = self.create_response(
+            json={"multicast_id": 1, "results": [{"message_id": "1:0"}]})
+        self.assertRaises(ValueError, fcmclient.Result, message, response,
+                          1000)
+
+
+class CompactResultTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.message = fcmclient.JSONMessage(['A', 'B', 'C', 'D', 'E', 'F'])
+        req = requests_mock.adapter._RequestObjectProxy._create(
+            'post', fcmclient.api.FCM_URL, {})
+        response = requests_mock.create_response(req, json={
+            "multicast_id": 1,
+            "success": 3,
+            "failure": 3,
+            "canonical_ids": 1,
+            "results": [
+                {"message_id": "1:0"},
+                {"error": "Unavailable"},
+                {"message_id": "1:2", "registration_id": "CC"},
+                {"error": "NotRegistered"},
+                {"error": "MismatchSenderId"},
+                {"message_id": "1:5"},
+            ]})
+        self.res = fcmclient.Result(self.message, response, 1000)
+
+    def test_slots(self):
+        self.assertFalse(hasattr(self.res, '__dict__'))
+        self.assertRaises(AttributeError, setattr, self.res, 'foo', 1)
+
+    def test_compact(self):
+        registration_ids, status, message_ids, canonicals, failed = \
+            self.res._compact()
+        self.assertIs(registration_ids, self.message.registration_ids)
+        self.assertEqual(status.typecode, 'b')
+        self.assertEqual(list(status), [
+            fcmclient.api.STATUS_SUCCESS,
+            fcmclient.api.STATUS_RETRY,
+            fcmclient.api.STATUS_SUCCESS,
+            fcmclient.api.STATUS_NOT_REGISTERED,
+            fcmclient.api.STATUS_FAILED,
+            fcmclient.api.STATUS_SUCCESS,
+        ])
+        self.assertEqual(canonicals, {2: 'CC'})
+        self.assertEqual(failed, {4: 'MismatchSenderId'})
+
+    def test_views(self):
+        success = self.res.success
+        self.assertEqual(len(success), 3)
+        self.assertEqual(list(success), ['A', 'C', 'F'])
+        self.assertEqual(list(success.items()),
+                         [('A', '1:0'), ('C', '1:2'), ('F', '1:5')])
+        self.assertEqual(list(success.values()), ['1:0', '1:2', '1:5'])
+        self.assertEqual(success['C'], '1:2')
+        self.assertEqual(success.get('B'), None)
+        self.assertIn('F', success)
+        self.assertRaises(KeyError, lambda: success['B'])
+        self.assertEqual(dict(success), {'A': '1:0', 'C': '1:2', 'F': '1:5'})
+
+        self.assertEqual(self.res.canonical, {'C': 'CC'})
+        self.assertEqual(len(self.res.canonical), 1)
+        self.assertEqual(self.res.failed, {'E': 'MismatchSenderId'})
+        self.assertEqual(self.res.not_registered, ['D'])
+        self.assertEqual(len(self.res.not_registered), 1)
+
+    def test_views_not_serializable(self):
+        self.assertRaises(TypeError, json.dumps, self.res.success)
+        self.assertEqual(json.loads(json.dumps(dict(self.res.success))),
+                         {'A': '1:0', 'C': '1:2', 'F': '1:5'})
+        self.assertEqual(json.dumps(list(self.res.not_registered)), '["D"]')
+        self.assertEqual(self.res.not_registered[0], 'D')
+        self.assertEqual(self.res.retry().registration_ids, ['B'])
+
+    def test_error_counts(self):
+        self.assertEqual(self.res.error_counts, {
+            'Unavailable': 1, 'NotRegistered': 1, 'MismatchSenderId': 1})
+        bulk = fcmclient.BulkResult(self.message, [self.res, self.res], 1000)
+        self.assertEqual(bulk.error_counts['NotRegistered'], 2)
+
+    def test_bulk_views(self):
+        bulk = fcmclient.BulkResult(self.message, [self.res, self.res], 1000)
+        self.assertEqual(len(bulk.success), 6)
+        self.assertEqual(list(bulk.not_registered), ['D', 'D'])
+        self.assertEqual(len(bulk.failed), 2)
+        self.assertEqual(bulk.retry().registration_ids, ['B', 'B'])
+
+
+class SendManyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.fcm = fcmclient.FCM(generate_api_key())
+
+    def respond(self, request, context):
+        """ Every 10th ID unavailable, every 7th gets a canonical ID. """
+        results = []
+        for reg_id in request.json()['registration_ids']:
+            n = int(reg_id)
+            if n % 10 == 0:
+                results.append({"error": "Unavailable"})
+            elif n % 7 == 0:
+                results.append({"message_id": "1:%s" % n,
+                                "registration_id": "c%s" % n})
+            else:
+                results.append({"message_id": "1:%s" % n})
+        return {"multicast_id": 1, "results": results}
+
+    def test_send_many(self):
+        reg_ids = [str(i) for i in range(1, 2501)]
+        message = fcmclient.JSONMessage(reg_ids, {'foo': 'bar'})
+        with requests_mock.Mocker() as m:
+            m.post(fcmclient.api.FCM_URL, json=self.respond)
+            res = self.fcm.send_many(message, concurrency=3)
+            sizes = sorted(len(req.json()['registration_ids'])
+                           for req in m.request_history)
+            self.assertEqual(sizes, [500, 1000, 1000])
+
+        self.assertEqual(len(res.results), 3)
+        self.assertEqual(res.success_count, 2250)
+        self.assertEqual(res.failure_count, 250)
+        self.assertEqual(len(res.success), 2250)
+        self.assertEqual(res.canonical['7'], 'c7')
+        self.assertEqual(len(res.canonical),
+                         len([i for i in range(1, 2501)
+                              if i % 7 == 0 and i % 10 != 0]))
+        self.assertEqual(sorted(res.retry().registration_ids, key=int),
+                         [str(i) for i in range(10, 2501, 10)])
+        self.assertEqual(res.retry().data, {'foo': 'bar'})
+        self.assertEqual(res.errors, [])
+
+    def test_send_many_network_error(self):
+        reg_ids = [str(i) for i in range(1, 1501)]
+        message = fcmclient.JSONMessage(reg_ids, {'foo': 'bar'})
+        with requests_mock.Mocker() as m:
+            m.post(fcmclient.api.FCM_URL,
+                   exc=fcmclient.api.requests.exceptions.ConnectTimeout)
+            res = self.fcm.send_many(message)
+
+        self.assertEqual(len(res.errors), 2)
+        self.assertEqual(res.success, {})
+        self.assertTrue(res.needs_retry())
+        self.assertEqual(sorted(res.retry().registration_ids), sorted(reg_ids))
+
+    def test_send_many_retry_after(self):
+        message = fcmclient.JSONMessage(['A', 'B', 'C'])
+        with requests_mock.Mocker() as m:
+            m.post(fcmclient.api.FCM_URL, status_code=503,
+                   headers={'Retry-After': '120'})
+            res = self.fcm.send_many(message, chunk_size=2)
+
+        self.assertEqual(res.delay(), 120)
+        self.assertEqual(sorted(res.retry().registration_ids),
+                         ['A', 'B', 'C'])
+
+
+class CodecTestCase(unittest.TestCase):
+
+    def codecs(self):
+        for name, _ in fcmclient.codec.CODECS:
+            try:
+                yield fcmclient.get_codec(name)
+            except ImportError:
+                pass
+
+    def test_roundtrip(self):
+        message = fcmclient.JSONMessage(
+            [generate_reg_id() for _ in range(10)],
+            {'str': u'\u00e9/', 1: 2}, message_title='t', time_to_live=0)
+        for codec in self.codecs():
+            body = codec.dumps(message.payload)
+            self.assertIsInstance(body, bytes)
+            decoded = codec.loads(body)
+            self.assertEqual(decoded['data'], {'str': u'\u00e9/', '1': 2})
+            self.assertEqual(decoded['registration_ids'],
+                             message.registration_ids)
+
+    def test_get_codec(self):
+        self.assertIsInstance(fcmclient.get_codec('json'),
+                              fcmclient.JSONCodec)
+        codec = fcmclient.JSONCodec()
+        self.assertIs(fcmclient.get_codec(codec), codec)
+        self.assertIsNotNone(fcmclient.get_codec())
+        self.assertRaises(ValueError, fcmclient.get_codec, 'yaml')
+
+    def test_fcm_codec(self):
+        codec = mock.Mock(wraps=fcmclient.JSONCodec())
+        client = fcmclient.FCM(generate_api_key(), codec=codec)
+        message = fcmclient.JSONMessage(['A'], {'foo': 'bar'})
+        with requests_mock.Mocker() as m:
+            m.post(fcmclient.api.FCM_URL, json={
+                "multicast_id": 1, "results": [{"message_id": "1:0"}]})
+            res = client.send(message)
+            self.assertEqual(m.last_request.json(), message.payload)
+        self.assertEqual(res.success, {'A': '1:0'})
+        codec.dumps.assert_called_once_with(message.payload)
+        self.assertEqual(codec.loads.call_count, 1)
+
+    def test_bench(self):
+        out = six.StringIO()
+        rows = fcmclient.bench.bench_codec(number=1, out=out)
+        self.assertEqual(rows[0][0], 'requests')
+        self.assertIn('json', out.getvalue())
+
+    def test_bench_hot_paths(self):
+        rows = fcmclient.bench.bench_hot_paths(2)
+        rows.append(fcmclient.bench.bench_send(4, 2, 10))
+        self.assertEqual([row.name for row in rows], [
+            'construct 1000', 'encode 1000', 'parse 1', 'parse 100',
+            'parse 1000', 'retry 20', 'send 10 x2'])
+        self.assertTrue(all(row.ops_per_sec > 0 for row in rows))
+        self.assertTrue(all(row.p50 <= row.p99 for row in rows))
+
+    def test_bench_cli(self):
+        out = six.StringIO()
+        # the console script exits with the return value
+        self.assertIsNone(fcmclient.cli.main(
+            ['bench', '-n', '2', '-r', '4', '-c', '2', '-t', '10'], out=out))
+        self.assertIn('p99 us', out.getvalue())
+        self.assertIn('send 10 x2', out.getvalue())
+
+    def test_bench_cli_tokens(self):
+        stderr = six.StringIO()
+        with mock.patch('sys.stderr', stderr):
+            self.assertRaises(SystemExit, fcmclient.cli.main,
+                              ['bench', '-t', '1001'])
+        self.assertIn('--tokens must be between 1 and 1000',
+                      stderr.getvalue())
+
+
+class CLITestCase(unittest.TestCase):
+
+    def test_send(self):
+        server = LocalFCMServer(errors={'NotRegistered': 1.0})
+        self.addCleanup(server.stop)
+        out = six.StringIO()
+        fcmclient.cli.main(['-k', generate_api_key(), '-u', server.url,
+                            '-r', 'A', '-d', '{"a": 1}'], out=out)
+        self.assertEqual(server.requests[0][1]['data'], {'a': 1})
+        self.assertIn("'not_registered': ['A']", out.getvalue())
+        self.assertIn("'failure_count': 1", out.getvalue())
+
+    def bulk(self, args, **kwargs):
+        server = LocalFCMServer(**kwargs)
+        self.addCleanup(server.stop)
+        out, err = six.StringIO(), six.StringIO()
+        with mock.patch('sys.stderr', err):
+            status = fcmclient.cli.main(
+                ['bulk', '-k', generate_api_key(), '-u', server.url,
+                 '--backoff', '1', '-p', '0'] + args, out=out)
+        lines = [json.loads(line) for line in out.getvalue().splitlines()]
+        return server, status, lines, err.getvalue()
+
+    def test_bulk(self):
+        path = os.path.join(tempfile.mkdtemp(), 'tokens.csv')
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        tokens = ['t%d' % i for i in range(250)]
+        with open(path, 'w') as f:
+            f.write('user,token\n')
+            f.writelines('%d,%s\n' % (i, t) for i, t in enumerate(tokens))
+
+        server, status, lines, err = self.bulk(
+            [path, '--column', '1', '--skip-header', '-s', '50', '-c', '4',
+             '-d', '{"a": 1}'],
+            errors={'NotRegistered': 0.1, 'Unavailable': 0.2},
+            canonical_rate=0.1, seed=1)
+        # dead registration ID's are an expected outcome
+        self.assertEqual(status, 0)
+        self.assertEqual(sorted(line['token'] for line in lines),
+                         sorted(tokens))
+        statuses = collections.Counter(line['status'] for line in lines)
+        self.assertEqual(set(statuses), set(['success', 'dead']))
+        self.assertTrue(all(line['error'] == 'NotRegistered'
+                            for line in lines if line['status'] == 'dead'))
+        canonical = len([line for line in lines if 'canonical' in line])
+        self.assertTrue(canonical > 0)
+        self.assertIn('%d success (%d canonical), %d dead' % (
+            statuses['success'], canonical, statuses['dead']), err)
+        self.assertTrue(server.token_count > 250)
+        self.assertEqual(server.requests[0][1]['data'], {'a': 1})
+        self.assertIn('done, 250 tokens', err)
+        self.assertIn('/s: ', err)
+
+    def test_bulk_stdin(self):
+        stdin = six.StringIO('A\n\nB\n  C  \n')
+        with mock.patch('sys.stdin', stdin):
+            server, status, lines, err = self.bulk([])
+        self.assertEqual(status, 0)
+        self.assertEqual(lines, [
+            {'token': 'A', 'status': 'success', 'message_id': '1:A'},
+            {'token': 'B', 'status': 'success', 'message_id': '1:B'},
+            {'token': 'C', 'status': 'success', 'message_id': '1:C'},
+        ])
+
+    def test_bulk_gave_up(self):
+        with mock.patch('sys.stdin', six.StringIO('A\nB\n')):
+            server, status, lines, err = self.bulk(
+                ['-', '-a', '1'], errors={'Unavailable': 1.0})
+        self.assertEqual(status, 1)
+        self.assertEqual(lines, [{'token': 'A', 'status': 'gave_up'},
+                                 {'token': 'B', 'status': 'gave_up'}])
+        self.assertEqual(server.token_count, 4)
+        self.assertIn('2 retries, 0 pending', err)
+
+    def test_bulk_sender_clock(self):
+        server = LocalFCMServer(errors={'Unavailable': 1.0})
+        self.addCleanup(server.stop)
+        fcm = fcmclient.FCM(generate_api_key(), url=server.url)
+        self.addCleanup(fcm.close)
+        self.now = 0.0
+        sleeps = []
+
+        def sleep(seconds):
+            sleeps.append(seconds)
+            self.now += seconds
+
+        out = six.StringIO()
+        sender = fcmclient.bulk.BulkSender(fcm, out, max_attempts=2,
+                                           clock=lambda: self.now)
+        with mock.patch('time.sleep', sleep):
+            counts = sender.send([fcmclient.JSONMessage(['A', 'B'])])
+        self.assertEqual(counts['gave_up'], 2)
+        self.assertEqual(sender.retries, 4)
+        # waits the backoff on the same clock the retries are due on
+        self.assertEqual(len(sleeps), 2)
+        self.assertTrue(all(0 < seconds < 10 for seconds in sleeps), sleeps)
+
+
+class StreamTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.fcm = fcmclient.FCM(generate_api_key())
+        self.pulled = 0
+
+    def source(self, count):
+        for i in range(count):
+            self.pulled += 1
+            yield str(i)
+
+    def respond(self, request, context):
+        reg_ids = request.json()['registration_ids']
+        return {"multicast_id": 1,
+                "results": [{"message_id": "1:%s" % i} for i in reg_ids]}
+
+    def test_stream(self):
+        messages = fcmclient.JSONMessage.stream(
+            self.source(2500), data={'foo': 'bar'}, time_to_live=60)
+        first = next(messages)
+        self.assertEqual(self.pulled, 1000)
+        self.assertEqual(first.registration_ids,
+                         [str(i) for i in range(1000)])
+        rest = list(messages)
+        self.assertEqual([len(msg.registration_ids) for msg in rest],
+                         [1000, 500])
+        for msg in rest:
+            self.assertEqual(msg.data, {'foo': 'bar'})
+            self.assertEqual(msg.options, {'time_to_live': 60})
+
+    def test_stream_empty(self):
+        self.assertEqual(list(fcmclient.JSONMessage.stream([])), [])
+
+    def test_iter_send(self):
+        messages = fcmclient.JSONMessage.stream(
+            self.source(10000), chunk_size=100)
+        seen = []
+        with requests_mock.Mocker() as m:
+            m.post(fcmclient.api.FCM_URL, json=self.respond)
+            for res in self.fcm.iter_send(messages, concurrency=4):
+                # never more than `concurrency` chunks ahead
+                self.assertLessEqual(self.pulled - len(seen) * 100, 400)
+                seen.extend(res.success)
+
+        self.assertEqual(sorted(seen, key=int),
+                         [str(i) for i in range(10000)])
+
+
+class CoalesceTestCase(unittest.TestCase):
+
+    def test_coalesce(self):
+        messages = []
+        for i in range(300):
+            data = {'foo': 'bar'} if i % 3 else {'foo': 'baz'}
+            messages.append(fcmclient.JSONMessage(
+                ['%s-%s' % (i, n) for n in range(10)], data,
+                time_to_live=60))
+
+        merged = fcmclient.coalesce(messages)
+        self.assertEqual([len(msg.registration_ids) for msg in merged],
+                         [1000, 1000, 1000])
+        self.assertEqual([msg.data for msg in merged],
+                         [{'foo': 'baz'}, {'foo': 'bar'}, {'foo': 'bar'}])
+        self.assertEqual(merged[1].registration_ids[:2], ['1-0', '1-1'])
+        self.assertEqual(merged[1].options, {'time_to_live': 60})
+        self.assertEqual(
+            sorted(i for msg in merged for i in msg.registration_ids),
+            sorted(i for msg in messages for i in msg.registration_ids))
+
+    def test_options_differ(self):
+        messages = [
+            fcmclient.JSONMessage(['A'], {'foo': 'bar'}, time_to_live=60),
+            fcmclient.JSONMessage(['B'], {'foo': 'bar'}, time_to_live=30),
+            fcmclient.JSONMessage(['C'], {'foo': 'bar'}, time_to_live=60),
+        ]
+        merged = fcmclient.coalesce(messages, chunk_size=1000)
+        self.assertEqual([msg.registration_ids for msg in merged],
+                         [['A', 'C'], ['B']])
+
+    def test_template(self):
+        base = fcmclient.JSONMessage(['A', 'B', 'C'], {'foo': 'bar'},
+                                     template=True)
+        merged = fcmclient.coalesce(base.split(1), chunk_size=2)
+        self.assertEqual([msg.registration_ids for msg in merged],
+                         [['A', 'B'], ['C']])
+        for msg in merged:
+            self.assertIs(msg._template, base._template)
+
+
+class AdaptiveLimiterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0.0
+        self.limiter = fcmclient.AdaptiveLimiter(
+            initial=4, min_limit=1, max_limit=6, clock=lambda: self.now)
+
+    def test_acquire(self):
+        started = [self.limiter.try_acquire() for _ in range(5)]
+        self.assertEqual(started, [0.0] * 4 + [None])
+        self.assertEqual(self.limiter.acquire(timeout=0), None)
+        self.limiter.release(started[0])
+        self.assertEqual(self.limiter.in_flight, 3)
+        self.assertEqual(self.limiter.limit, 4)
+
+    def test_additive_increase(self):
+        for _ in range(4):
+            self.now += 1
+            started = self.limiter.acquire()
+            self.now += 0.1
+            self.limiter.release(started, congested=False)
+        self.assertEqual(self.limiter.limit, 4)
+        for _ in range(50):
+            started = self.limiter.acquire()
+            self.now += 0.1
+            self.limiter.release(started, congested=False)
+        self.assertEqual(self.limiter.limit, 6)
+
+    def test_slow_latency_holds(self):
+        started = self.limiter.acquire()
+        self.now += 0.1
+        self.limiter.release(started, congested=False)
+        for _ in range(10):
+            started = self.limiter.acquire()
+            self.now += 1
+            self.limiter.release(started, congested=False)
+        self.assertEqual(self.limiter._limit, 4.25)
+
+    def test_multiplicative_decrease(self):
+        started = [self.limiter.acquire() for _ in range(4)]
+        self.now += 1
+        for s in started:
+            self.limiter.release(s, congested=True)
+        # requests in flight at the decrease count only once
+        self.assertEqual(self.limiter.limit, 2)
+
+        for _ in range(3):
+            self.now += 1
+            started = self.limiter.acquire()
+            self.now += 1
+            self.limiter.release(started, congested=True)
+        self.assertEqual(self.limiter.limit, 1)
+
+    def test_fcm(self):
+        limiter = fcmclient.AdaptiveLimiter(initial=8, max_limit=16)
+        client = fcmclient.FCM(generate_api_key(), limiter=limiter)
+        message = fcmclient.JSONMessage(['A'])
+        with requests_mock.Mocker() as m:
+            m.post(fcmclient.api.FCM_URL, status_code=503,
+                   headers={'Retry-After': '10'})
+            res = client.send(message)
+            self.assertEqual(res.status_code, 503)
+            self.assertEqual(limiter.limit, 4)
+
+            m.post(fcmclient.api.FCM_URL,
+                   exc=fcmclient.api.requests.exceptions.ConnectTimeout)
+            self.assertRaises(fcmclient.api.requests.exceptions.Timeout,
+                              client.send, message)
+            self.assertEqual(limiter.limit, 2)
+            self.assertEqual(limiter.in_flight, 0)
+
+            m.post(fcmclient.api.FCM_URL, json={
+                "multicast_id": 1, "results": [{"message_id": "1:0"}]})
+            for _ in range(5):
+                client.send(message)
+            self.assertEqual(limiter.limit, 3)
+
+
+class RateLimiterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 100.0
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'fcm-rate')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def limiter(self, **kwargs):
+        kwargs.setdefault('clock', lambda: self.now)
+        limiter = fcmclient.RateLimiter(**kwargs)
+        self.addCleanup(limiter.close)
+        return limiter
+
+    def test_requests(self):
+        limiter = self.limiter(requests_per_second=10, burst=0.5)
+        waits = [limiter.reserve() for _ in range(7)]
+        self.assertEqual(waits[:5], [0.0] * 5)
+        self.assertAlmostEqual(waits[5], 0.1)
+        self.assertAlmostEqual(waits[6], 0.2)
+        self.now += 1
+        self.assertEqual(limiter.reserve(), 0)
+
+    def test_tokens(self):
+        limiter = self.limiter(requests_per_second=100, tokens_per_second=1000)
+        self.assertEqual(limiter.reserve(1000), 0)
+        self.assertAlmostEqual(limiter.reserve(500), 0.5)
+        self.now += 0.5
+        self.assertAlmostEqual(limiter.reserve(1000), 1.0)
+
+    def test_validation(self):
+        self.assertRaises(ValueError, fcmclient.RateLimiter)
+
+    @unittest.skipIf(fcmclient.limits.fcntl is None, "needs fcntl")
+    def test_shared_file(self):
+        first = self.limiter(requests_per_second=10, path=self.path)
+        second = self.limiter(requests_per_second=10, path=self.path)
+        for _ in range(5):
+            first.reserve()
+        for _ in range(5):
+            self.assertEqual(second.reserve(), 0)
+        self.assertAlmostEqual(first.reserve(), 0.1)
+
+    @unittest.skipIf(fcmclient.limits.fcntl is None or
+                     not hasattr(os, 'fork'), "needs fcntl and fork")
+    def test_processes(self):
+        limiter = self.limiter(requests_per_second=1000, burst=0.1,
+                               path=self.path, clock=lambda: 1.0)
+        limiter.reserve()
+        pids = []
+        for _ in range(4):
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    for _ in range(100):
+                        limiter.reserve()
+                finally:
+                    os._exit(0)
+            pids.append(pid)
+        for pid in pids:
+            os.waitpid(pid, 0)
+        # 100 budget minus 402 requests
+        self.assertAlmostEqual(limiter.reserve(), 0.302)
+
+    def test_fcm(self):
+        limiter = mock.Mock(wraps=self.limiter(tokens_per_second=1000))
+        client = fcmclient.FCM(generate_api_key(), rate_limiter=limiter)
+        message = fcmclient.JSONMessage(['A', 'B'])
+        with requests_mock.Mocker() as m:
+            m.post(fcmclient.api.FCM_URL, json={
+                "multicast_id": 1,
+                "results": [{"message_id": "1:0"}, {"message_id": "1:1"}]})
+            client.send(message)
+        limiter.acquire.assert_called_once_with(2)
+
+
+class CircuitBreakerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 100.0
+        self.breaker = fcmclient.CircuitBreaker(
+            failure_threshold=2, reset_timeout=10, clock=lambda: self.now)
+
+    def test_trips_on_consecutive_failures(self):
+        breaker = self.breaker
+        breaker.record(True)
+        breaker.record(False)
+        breaker.record(True)
+        self.assertEqual(breaker.state, breaker.CLOSED)
+        breaker.before_send()
+        breaker.record(True)
+        self.assertEqual(breaker.state, breaker.OPEN)
+        with self.assertRaises(fcmclient.CircuitOpenError) as ctx:
+            breaker.before_send()
+        self.assertEqual(ctx.exception.retry_after, 10)
+
+    def test_retry_after(self):
+        breaker = self.breaker
+        breaker.record(True, retry_after=30)
+        self.now += 29
+        with self.assertRaises(fcmclient.CircuitOpenError) as ctx:
+            breaker.before_send()
+        self.assertEqual(ctx.exception.retry_after, 1)
+
+    def test_half_open(self):
+        breaker = self.breaker
+        breaker.record(True, retry_after=5)
+        self.now += 5
+        self.assertEqual(breaker.state, breaker.HALF_OPEN)
+        breaker.before_send()
+        # only one probe at a time
+        self.assertRaises(fcmclient.CircuitOpenError, breaker.before_send)
+        breaker.record(True)
+        self.assertEqual(breaker.state, breaker.OPEN)
+
+        self.now += 10
+        breaker.before_send()
+        breaker.record(False)
+        self.assertEqual(breaker.state, breaker.CLOSED)
+        breaker.before_send()
+
+    def test_healthy_while_open(self):
+        breaker = self.breaker
+        breaker.record(True, 30)
+        breaker.record(False)
+        self.assertEqual(breaker.state, breaker.OPEN)
+        self.assertRaises(fcmclient.CircuitOpenError, breaker.before_send)
+
+    def test_ignores_requests_sent_before_open(self):
+        breaker = self.breaker
+        early = breaker.before_send()
+        self.now += 1
+        late = breaker.before_send()
+        breaker.record(True, 5, admitted=late)
+        self.now += 5
+        probe = breaker.before_send()
+        # an old request succeeding says nothing about the probe
+        breaker.record(False, admitted=early)
+        self.assertEqual(breaker.state, breaker.HALF_OPEN)
+        self.assertRaises(fcmclient.CircuitOpenError, breaker.before_send)
+        breaker.record(False, admitted=probe)
+        self.assertEqual(breaker.state, breaker.CLOSED)
+
+    def test_fcm(self):
+        client = fcmclient.FCM(generate_api_key(), breaker=self.breaker)
+        message = fcmclient.JSONMessage(['A', 'B'])
+        with requests_mock.Mocker() as m:
+            m.post(fcmclient.api.FCM_URL, status_code=503,
+                   headers={'Retry-After': '20'})
+            res = client.send(message)
+            self.assertEqual(res.retry_after, 20)
+
+            self.now += 5
+            self.assertRaises(fcmclient.CircuitOpenError,
+                              client.send, message)
+            res = client.send_many(message)
+            self.assertEqual(m.call_count, 1)
+
+        self.assertEqual(res.retry_after, 15)
+        self.assertEqual(res.delay(), 15)
+        self.assertEqual(res.retry().registration_ids, ['A', 'B'])
+
+
+class ObserverTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = LocalFCMServer()
+        self.events = []
+        self.fcm = fcmclient.FCM(generate_api_key(), url=self.server.url,
+                                 observers=[self.events.append])
+
+    def tearDown(self):
+        self.fcm.close()
+        self.server.stop()
+
+    def test_request_event(self):
+        message = fcmclient.JSONMessage(['A', 'B', 'C'], {'foo': 'bar'})
+        res = self.fcm.send(message)
+        event, = self.events
+        self.assertEqual(event.kind, 'request')
+        self.assertIs(event.message, message)
+        self.assertEqual(event.token_count, 3)
+        self.assertEqual(event.payload_bytes,
+                         len(message.encode(self.fcm.codec)))
+        self.assertEqual(event.status_code, 200)
+        self.assertEqual(event.success_count, 3)
+        self.assertEqual(event.failure_count, 0)
+        self.assertEqual(sorted(event.timings), [
+            'decode', 'encode', 'read', 'request', 'total'])
+        self.assertTrue(event.timings['total'] >= event.timings['request'])
+
+        # all success details are kept without parsing
+        self.assertEqual(len(res.success), 3)
+        self.assertEqual(len(self.events), 1)
+
+    def test_failure_event(self):
+        self.server.errors = [('NotRegistered', 1.0)]
+        res = self.fcm.send(fcmclient.JSONMessage(['A', 'B', 'C']))
+        event, = self.events
+        self.assertEqual(event.failure_count, 3)
+        self.assertIn('decode', event.timings)
+
+        # details are parsed within the decode timing
+        self.assertEqual(res.not_registered, ['A', 'B', 'C'])
+        self.assertEqual(len(self.events), 1)
+
+    def test_error(self):
+        self.server.stop()
+        message = fcmclient.JSONMessage(['A'])
+        self.assertRaises(requests.exceptions.RequestException,
+                          self.fcm.send, message)
+        event, = self.events
+        self.assertIsInstance(event.error,
+                              requests.exceptions.RequestException)
+        self.assertIsNone(event.status_code)
+
+    def test_failing_observer(self):
+        self.fcm.observers.insert(0, mock.Mock(side_effect=RuntimeError))
+        res = self.fcm.send(fcmclient.JSONMessage(['A']))
+        self.assertEqual(res.success_count, 1)
+        self.assertEqual(len(self.events), 1)
+
+    def test_limits(self):
+        self.fcm.limiter = fcmclient.AdaptiveLimiter()
+        self.fcm.rate_limiter = fcmclient.RateLimiter(1000)
+        self.fcm.send(fcmclient.JSONMessage(['A']))
+        self.assertIn('limiter', self.events[0].timings)
+        self.assertIn('rate_limit', self.events[0].timings)
+
+    def test_limiter_wait(self):
+        self.server.latency = 0.1
+        self.fcm.limiter = fcmclient.AdaptiveLimiter(
+            initial=1, max_limit=1, latency_tolerance=None)
+        threads = [threading.Thread(target=self.fcm.send,
+                                    args=(fcmclient.JSONMessage(['A']),))
+                   for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # the second send waits for the first to finish
+        waits = sorted(event.timings['limiter'] for event in self.events)
+        self.assertTrue(waits[0] < 0.05, waits)
+        self.assertTrue(waits[1] >= 0.05, waits)
+
+
+class MetricsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 100.0
+        self.metrics = fcmclient.Metrics(buckets=(0.1, 1.0),
+                                         clock=lambda: self.now)
+        self.fcm = fcmclient.FCM(generate_api_key(),
+                                 observers=[self.metrics])
+
+    def send(self, reg_ids, **kwargs):
+        message = fcmclient.JSONMessage(reg_ids)
+        with requests_mock.Mocker() as m:
+            m.post(fcmclient.api.FCM_URL, **kwargs)
+            return self.fcm.send(message)
+
+    def test_counters(self):
+        self.send(['A', 'B', 'C', 'D'], json={
+            "multicast_id": 1,
+            "success": 1,
+            "failure": 3,
+            "canonical_ids": 0,
+            "results": [
+                {"message_id": "1:0"},
+                {"error": "Unavailable"},
+                {"error": "NotRegistered"},
+                {"error": "NotRegistered"},
+            ]})
+        self.send(['A', 'B'], status_code=503)
+        counters = self.metrics.snapshot()['counters']
+        self.assertEqual(counters[('requests', '200')], 1)
+        self.assertEqual(counters[('requests', '503')], 1)
+        self.assertEqual(counters[('tokens', None)], 6)
+        self.assertEqual(counters[('results', 'success')], 1)
+        self.assertEqual(counters[('results', 'failure')], 3)
+        self.assertEqual(counters[('errors', 'Unavailable')], 1)
+        self.assertEqual(counters[('errors', 'NotRegistered')], 2)
+        self.assertEqual(counters[('retries', None)], 3)
+
+    def test_histograms(self):
+        metrics = self.metrics
+        for seconds in (0.05, 0.5, 5):
+            event = fcmclient.RequestEvent('parse',
+                                           fcmclient.JSONMessage(['A']))
+            event.timings['parse'] = seconds
+            metrics(event)
+        counts, total = metrics.snapshot()['histograms']['parse']
+        self.assertEqual(counts, [1, 2, 3])
+        self.assertAlmostEqual(total, 5.55)
+
+    def test_threads(self):
+        message = fcmclient.JSONMessage(['A', 'B'])
+
+        def record():
+            for _ in range(100):
+                self.metrics(fcmclient.RequestEvent('request', message))
+
+        threads = [threading.Thread(target=record) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        snapshot = self.metrics.snapshot()
+        self.assertEqual(snapshot['counters'][('requests', 'error')], 400)
+        # shards of finished threads are folded into the base shard
+        self.assertEqual(self.metrics._shards, [])
+
+    def test_finished_threads(self):
+        message = fcmclient.JSONMessage(['A'])
+        self.metrics(fcmclient.RequestEvent('request', message))
+        for _ in range(20):
+            thread = threading.Thread(target=self.metrics, args=(
+                fcmclient.RequestEvent('request', message),))
+            thread.start()
+            thread.join()
+        # only the shards of live threads are kept
+        self.assertEqual(len(self.metrics._shards), 2)
+        snapshot = self.metrics.snapshot()
+        self.assertEqual(snapshot['counters'][('requests', 'error')], 21)
+        self.assertEqual(snapshot['counters'][('tokens', None)], 21)
+        self.assertEqual(len(self.metrics._shards), 1)
+
+    def test_tokens_per_second(self):
+        self.now += 10
+        self.send(['A', 'B'], json={
+            "multicast_id": 1, "success": 2, "failure": 0,
+            "canonical_ids": 0,
+            "results": [{"message_id": "1:0"}, {"message_id": "1:1"}]})
+        self.assertAlmostEqual(
+            self.metrics.snapshot()['tokens_per_second'], 0.2)
+        self.now += 1
+        self.assertEqual(self.metrics.snapshot()['tokens_per_second'], 0)
+
+    def test_export(self):
+        self.send(['A'], json={
+            "multicast_id": 1, "success": 0, "failure": 1,
+            "canonical_ids": 0, "results": [{"error": "InvalidRegistration"}]})
+        text = self.metrics.export()
+        self.assertIn('# TYPE fcm_requests_total counter\n'
+                      'fcm_requests_total{status="200"} 1\n', text)
+        self.assertIn(
+            'fcm_errors_total{error="InvalidRegistration"} 1\n', text)
+        self.assertIn('fcm_tokens_total 1\n', text)
+        self.assertIn('# TYPE fcm_latency_seconds histogram\n', text)
+        self.assertIn('fcm_latency_seconds_bucket{phase="total",le="+Inf"} 1',
+                      text)
+        self.assertIn('fcm_latency_seconds_count{phase="decode"} 1', text)
+
+
+class FakeFCMServerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.api_key = generate_api_key()
+
+    def server(self, **kwargs):
+        server = fcmclient.testing.FakeFCMServer(**kwargs)
+        self.addCleanup(server.stop)
+        fcm = fcmclient.FCM(self.api_key, url=server.url, pool_size=20)
+        self.addCleanup(fcm.close)
+        return server, fcm
+
+    def test_errors(self):
+        server, fcm = self.server(
+            errors={'Unavailable': 0.2, 'NotRegistered': 0.1},
+            canonical_rate=0.1, seed=1)
+        res = fcm.send(fcmclient.JSONMessage([str(i) for i in range(1000)]))
+        counts = res.error_counts
+        self.assertTrue(150 < counts['Unavailable'] < 250)
+        self.assertTrue(50 < counts['NotRegistered'] < 150)
+        self.assertTrue(0 < res.canonical_count < 150)
+        self.assertEqual(res.failure_count, sum(counts.values()))
+        self.assertEqual(len(res.retry().registration_ids),
+                         counts['Unavailable'])
+
+    def test_burst(self):
+        server, fcm = self.server()
+        server.burst(2, status=503, retry_after=7)
+        message = fcmclient.JSONMessage(['A'])
+        self.assertEqual(fcm.send(message).retry_after, 7)
+        self.assertEqual(fcm.send(message).status_code, 503)
+        res = fcm.send(message)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(server.request_count, 3)
+
+    def test_topic(self):
+        server, fcm = self.server()
+        res = fcm.send(fcmclient.TopicMessage('news'))
+        self.assertEqual(res.message_id, 1)
+        self.assertEqual(server.request_count, 1)
+
+    def test_api_key(self):
+        server, fcm = self.server(api_key='other')
+        self.assertRaises(fcmclient.FCMAuthenticationError,
+                          fcm.send, fcmclient.JSONMessage(['A']))
+
+    def test_concurrency(self):
+        server, fcm = self.server(latency=lambda: random.uniform(0, 0.02))
+        messages = fcmclient.JSONMessage.stream(
+            (str(i) for i in range(10000)), chunk_size=100)
+        results = list(fcm.iter_send(messages, concurrency=20))
+        self.assertEqual(sum(res.success_count for res in results), 10000)
+        self.assertEqual(server.request_count, 100)
+        self.assertEqual(server.token_count, 10000)
+        self.assertEqual(server.requests, [])
+
+
+class FCMv1TestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = LocalFCMServer(api_key='sender@example.com')
+        self.addCleanup(self.server.stop)
+
+    def fcm(self, **kwargs):
+        account = fcmclient.v1.ServiceAccount(
+            {'client_email': 'sender@example.com',
+             'project_id': 'fake-project',
+             'private_key': 'unused'},
+            token_url=self.server.token_url,
+            signer=lambda data: b'signature')
+        fcm = fcmclient.v1.FCMv1(account, url=self.server.v1_url, **kwargs)
+        self.addCleanup(fcm.close)
+        self.addCleanup(fcm.provider.stop)
+        return fcm
+
+    def test_assertion(self):
+        account = self.fcm().credentials
+        parts = [json.loads(fcmclient.v1.base64.urlsafe_b64decode(
+            part + '=' * (-len(part) % 4)).decode('utf-8'))
+            for part in account.assertion(now=1000).split('.')[:2]]
+        self.assertEqual(parts[0], {'alg': 'RS256', 'typ': 'JWT'})
+        self.assertEqual(parts[1], {
+            'iss': 'sender@example.com',
+            'scope': 'https://www.googleapis.com/auth/firebase.messaging',
+            'aud': self.server.token_url,
+            'iat': 1000,
+            'exp': 4600,
+        })
+        self.assertTrue(account.assertion().endswith('.c2lnbmF0dXJl'))
+
+    def test_send(self):
+        fcm = self.fcm()
+        message = fcmclient.JSONMessage(
+            ['A', 'B'], data={'n': 1, 's': 'x'}, message_title='title',
+            message_body='body', time_to_live=60, priority='high')
+        res = fcm.send(message)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(dict(res.success), {
+            'A': 'projects/fake-project/messages/1:A',
+            'B': 'projects/fake-project/messages/1:B',
+        })
+        self.assertEqual(self.server.request_count, 2)
+        self.assertEqual(self.server.access_token_count, 1)
+
+        headers, payload = self.server.requests[0]
+        self.assertEqual(headers['Authorization'], 'Bearer fake-token-1')
+        payload = dict(payload, token=None)
+        self.assertEqual(payload, {
+            'data': {'n': '1', 's': 'x'},
+            'notification': {'title': 'title', 'body': 'body'},
+            'android': {'ttl': '60s', 'priority': 'HIGH'},
+            'token': None,
+        })
+
+    def test_errors(self):
+        fcm = self.fcm()
+        errors = {'dead': 'NotRegistered', 'busy': 'Unavailable',
+                  'bad': 'InvalidRegistration', 'other': 'MismatchSenderId'}
+        self.server.outcome = lambda reg_id: (errors.get(reg_id), False)
+        res = fcm.send_many(fcmclient.JSONMessage(
+            ['ok', 'dead', 'busy', 'bad', 'other']), chunk_size=2)
+        self.assertEqual(list(res.success), ['ok'])
+        self.assertEqual(list(res.not_registered), ['dead'])
+        self.assertEqual(dict(res.failed), {'bad': 'InvalidRegistration',
+                                            'other': 'MismatchSenderId'})
+        self.assertEqual(res.retry().registration_ids, ['busy'])
+
+        # learnt by a token cache like legacy errors
+        cache = fcmclient.TokenCache()
+        cache.update(res)
+        self.assertEqual(set(cache.filter(list(errors) + ['ok'])),
+                         set(['ok', 'busy']))
+
+    def test_server_error(self):
+        fcm = self.fcm()
+        self.server.burst(2, status=503, retry_after=7)
+        message = fcmclient.JSONMessage(['A', 'B'])
+        res = fcm.send(message)
+        self.assertEqual(res.status_code, 503)
+        self.assertEqual(res.retry_after, 7)
+        self.assertIs(res.retry(), message)
+
+    def test_topic(self):
+        fcm = self.fcm()
+        res = fcm.send(fcmclient.TopicMessage('news', data={'a': 'b'}))
+        self.assertEqual(res.message_id, 'projects/fake-project/messages/1')
+        self.assertEqual(self.server.requests[0][1],
+                         {'topic': 'news', 'data': {'a': 'b'}})
+
+    def test_shared_token(self):
+        fcm = self.fcm()
+        other = self.fcm()
+        self.assertIs(fcm.provider, other.provider)
+        fcm.send(fcmclient.JSONMessage(['A']))
+        other.send(fcmclient.JSONMessage(['B']))
+        self.assertEqual(self.server.access_token_count, 1)
+
+    def test_refresh_ahead(self):
+        self.server.access_token_ttl = 2
+        fcm = self.fcm()
+        fcm.send(fcmclient.JSONMessage(['A']))
+        self.assertEqual(fcm.provider.fetch_count, 1)
+        # refreshed in the background half way through the lifetime
+        deadline = time.time() + 5
+        while fcm.provider.fetch_count < 2 and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(fcm.provider.fetch_count, 2)
+        with mock.patch.object(fcm.credentials, 'fetch_token') as fetch:
+            self.assertEqual(fcm.send(fcmclient.JSONMessage(['A'])).
+                             success_count, 1)
+            self.assertFalse(fetch.called)
+
+    def test_revoked_token(self):
+        fcm = self.fcm()
+        fcm.send(fcmclient.JSONMessage(['A']))
+        self.server.revoke_tokens()
+        res = fcm.send(fcmclient.JSONMessage(['A']))
+        self.assertEqual(res.success_count, 1)
+        self.assertEqual(self.server.access_token_count, 2)
+
+    def test_authentication_error(self):
+        self.server.api_key = 'other@example.com'
+        fcm = self.fcm()
+        self.assertRaises(fcmclient.FCMAuthenticationError,
+                          fcm.send, fcmclient.JSONMessage(['A']))
+
+
+@unittest.skipIf(h2 is None, "httpx[http2] is not installed")
+class HTTP2TestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = LocalFCMServer(latency=0.02, max_streams=20)
+        self.addCleanup(self.server.stop)
+
+    def fcm(self, **kwargs):
+        fcm = fcmclient.FCM(generate_api_key(), url=self.server.url,
+                            http2=True, **kwargs)
+        self.addCleanup(fcm.close)
+        return fcm
+
+    def test_send(self):
+        fcm = self.fcm()
+        self.assertIsInstance(fcm.session, fcmclient.http2.HTTP2Session)
+        res = fcm.send(fcmclient.JSONMessage(['A', 'B']))
+        self.assertEqual(dict(res.success), {'A': '1:A', 'B': '1:B'})
+        headers, payload = self.server.requests[0]
+        self.assertEqual(headers['Authorization'], 'key=%s' % fcm.api_key)
+        self.assertNotIn('Connection', headers)
+
+    def test_multiplexed(self):
+        fcm = self.fcm(pool_size=2, max_streams=10)
+        messages = fcmclient.JSONMessage.stream(
+            (str(i) for i in range(500)), chunk_size=5)
+        results = list(fcm.iter_send(messages))
+        self.assertEqual(sum(res.success_count for res in results), 500)
+        self.assertEqual(self.server.connection_count, 2)
+        self.assertTrue(2 < self.server.peak_streams <= 20)
+        self.assertEqual(fcm.session.streams, 0)
+
+    def test_server_stream_limit(self):
+        fcm = self.fcm(pool_size=1, max_streams=100)
+        messages = fcmclient.JSONMessage.stream(
+            (str(i) for i in range(200)), chunk_size=5)
+        self.assertEqual(len(list(fcm.iter_send(messages))), 40)
+        self.assertEqual(self.server.connection_count, 1)
+        self.assertTrue(2 < self.server.peak_streams <= 20)
+
+    def test_default_concurrency(self):
+        self.assertEqual(self.fcm(pool_size=2, max_streams=10)
+                         ._max_concurrency(), 20)
+        self.assertEqual(self.fcm()._max_concurrency(),
+                         fcmclient.api.DEFAULT_MAX_CONCURRENCY)
+
+    def test_network_error(self):
+        fcm = fcmclient.FCM(generate_api_key(), http2=True, timeout=1,
+                            url='http://127.0.0.1:1/fcm/send')
+        self.addCleanup(fcm.close)
+        self.assertRaises(requests.exceptions.ConnectionError,
+                          fcm.send, fcmclient.JSONMessage(['A']))
+        self.assertRaises(TypeError, fcm.session.post, self.server.url,
+                          stream=True)
+
+    def test_v1(self):
+        server = self.server
+        server.api_key = 'sender@example.com'
+        account = fcmclient.v1.ServiceAccount(
+            {'client_email': 'sender@example.com',
+             'private_key': 'unused'},
+            token_url=server.token_url, signer=lambda data: b'signature')
+        fcm = fcmclient.v1.FCMv1(account, url=server.v1_url, http2=True,
+                                 pool_size=1, max_streams=20)
+        self.addCleanup(fcm.close)
+        self.addCleanup(fcm.provider.stop)
+        res = fcm.send(fcmclient.JSONMessage([str(i) for i in range(100)]))
+        print('DBG', res.success_count, res.failed, list(res.not_registered)[:3])
+        self.assertEqual(res.success_count, 100)
+        self.assertEqual(fcm.concurrency, 20)
+        # one HTTP/2 connection and one to the token endpoint
+        self.assertEqual(server.connection_count, 2)
+        self.assertTrue(server.peak_streams > 1)
+
+
+class CompressionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = LocalFCMServer()
+        self.addCleanup(self.server.stop)
+        self.reg_ids = [generate_reg_id() for _ in range(100)]
+
+    def fcm(self, **kwargs):
+        fcm = fcmclient.FCM(generate_api_key(), url=self.server.url, **kwargs)
+        self.addCleanup(fcm.close)
+        return fcm
+
+    def test_gzip_compress(self):
+        data = json.dumps(self.reg_ids).encode('utf-8')
+        compressed = fcmclient.codec.gzip_compress(data, 1)
+        self.assertEqual(zlib.decompress(compressed, 31),
+                         data)
+        self.assertEqual(compressed, fcmclient.codec.gzip_compress(data, 1))
+
+    def test_above_threshold(self):
+        message = fcmclient.JSONMessage(self.reg_ids)
+        size = len(message.encode())
+        res = self.fcm(compress_threshold=size).send(message)
+        self.assertEqual(res.success_count, 100)
+        headers, payload = self.server.requests[0]
+        self.assertEqual(headers['Content-Encoding'], 'gzip')
+        self.assertEqual(payload, message.payload)
+        self.assertTrue(self.server.bytes_received < size)
+
+    def test_below_threshold(self):
+        message = fcmclient.JSONMessage(self.reg_ids)
+        size = len(message.encode())
+        self.fcm(compress_threshold=size + 1).send(message)
+        headers, payload = self.server.requests[0]
+        self.assertNotIn('Content-Encoding', headers)
+        self.assertEqual(self.server.bytes_received, size)
+
+    def test_observed(self):
+        metrics = fcmclient.Metrics()
+        fcm = self.fcm(compress_threshold=0, observers=[metrics])
+        fcm.send(fcmclient.JSONMessage(self.reg_ids))
+        self.assertIn('compress', metrics.snapshot()['histograms'])
+
+    def test_compressed_response(self):
+        self.server.compress_responses = True
+        res = self.fcm().send(fcmclient.JSONMessage(self.reg_ids))
+        self.assertEqual(res.success_count, 100)
+        self.assertEqual(res.success[self.reg_ids[0]],
+                         '1:%s' % self.reg_ids[0])
+
+    def test_v1(self):
+        server = self.server
+        server.compress_responses = True
+        account = fcmclient.v1.ServiceAccount(
+            {'client_email': 'sender@example.com', 'private_key': 'unused'},
+            token_url=server.token_url, signer=lambda data: b'signature')
+        fcm = fcmclient.v1.FCMv1(account, url=server.v1_url,
+                                 compress_threshold=0)
+        self.addCleanup(fcm.close)
+        self.addCleanup(fcm.provider.stop)
+        res = fcm.send(fcmclient.JSONMessage(['A', 'B'], data={'a': 'b'}))
+        self.assertEqual(dict(res.success), {
+            'A': 'projects/fake-project/messages/1:A',
+            'B': 'projects/fake-project/messages/1:B',
+        })
+        headers, payload = server.requests[0]
+        self.assertEqual(headers['Content-Encoding'], 'gzip')
+        self.assertEqual(payload['data'], {'a': 'b'})
+
+
+class TokenCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'tokens')
+        self.cache = self.create()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def create(self, **kwargs):
+        kwargs.setdefault('ttl', 60)
+        return fcmclient.TokenCache(clock=lambda: self.now, **kwargs)
+
+    def test_filter(self):
+        cache = self.cache
+        self.assertIsNone(cache.filter(['A', 'B']))
+        cache.add_dead('B')
+        cache.add_canonical('C', 'CC')
+        self.assertTrue(cache.is_dead('B'))
+        self.assertEqual(cache.canonical('C'), 'CC')
+        self.assertIsNone(cache.filter(['A', 'D']))
+        self.assertEqual(cache.filter(['A', 'B', 'C', 'D']), ['A', 'CC', 'D'])
+
+        message = fcmclient.JSONMessage(['B', 'C'], {'foo': 'bar'})
+        filtered = cache.filter_message(message)
+        self.assertEqual(filtered.registration_ids, ['CC'])
+        self.assertEqual(filtered.data, {'foo': 'bar'})
+        self.assertIsNone(cache.filter_message(fcmclient.JSONMessage(['B'])))
+
+    def test_ttl(self):
+        self.cache.add_dead('A')
+        self.now += 60
+        self.assertFalse(self.cache.is_dead('A'))
+        self.assertEqual(len(self.cache), 0)
+
+    def test_max_size(self):
+        cache = self.create(max_size=2)
+        for token in 'ABC':
+            cache.add_dead(token)
+        self.assertFalse(cache.is_dead('A'))
+        self.assertTrue(cache.is_dead('B'))
+        self.assertTrue(cache.is_dead('C'))
+
+    def test_update(self):
+        req = requests_mock.adapter._RequestObjectProxy._create(
+            'post', fcmclient.api.FCM_URL, {})
+        response = requests_mock.create_response(req, json={
+            "multicast_id": 1, "success": 1, "failure": 3,
+            "canonical_ids": 1,
+            "results": [
+                {"message_id": "1:0", "registration_id": "AA"},
+                {"error": "NotRegistered"},
+                {"error": "InvalidRegistration"},
+                {"error": "Unavailable"},
+            ]})
+        message = fcmclient.JSONMessage(['A', 'B', 'C', 'D'])
+        self.cache.update(fcmclient.Result(message, response, 1000))
+        self.assertEqual(self.cache.filter(message.registration_ids),
+                         ['AA', 'D'])
+
+    def test_save(self):
+        cache = self.create(path=self.path)
+        cache.add_dead('A')
+        cache.add_canonical('B', u'BB\u00e9')
+        cache.add_dead('C')
+        self.now += 30
+        cache.add_dead('D')
+        cache.save()
+        self.assertEqual(os.path.getsize(self.path),
+                         4 * cache.RECORD.size + 4)
+
+        self.now += 40
+        loaded = self.create(path=self.path)
+        self.assertEqual(len(loaded), 1)
+        self.assertTrue(loaded.is_dead('D'))
+        self.now -= 40
+        loaded.load()
+        self.assertEqual(loaded.canonical('B'), u'BB\u00e9')
+
+    def test_fcm(self):
+        server = fcmclient.testing.FakeFCMServer(
+            errors={'NotRegistered': 0.5}, canonical_rate=1.0, seed=2,
+            record=True)
+        self.addCleanup(server.stop)
+        fcm = fcmclient.FCM(generate_api_key(), url=server.url,
+                            token_cache=self.cache)
+        reg_ids = [str(i) for i in range(100)]
+        res = fcm.send_many(fcmclient.JSONMessage(reg_ids), chunk_size=30)
+        dead = set(res.not_registered)
+        self.assertTrue(dead)
+
+        res = fcm.send_many(fcmclient.JSONMessage(reg_ids), chunk_size=30)
+        sent = server.requests[-1][1]['registration_ids']
+        self.assertTrue(all(reg_id.startswith('canonical-')
+                            for reg_id in sent))
+        self.assertEqual(len(res.message.registration_ids), 100 - len(dead))
+        self.assertEqual(server.request_count, 4 + 2)
+
+        res = fcm.send(fcmclient.JSONMessage(sorted(dead)))
+        self.assertEqual(res.success_count, 0)
+        self.assertEqual(server.request_count, 6)
+
+
+class TokenSetTestCase(unittest.TestCase):
+
+    def test_set(self):
+        seen = fcmclient.TokenSet(capacity=4)
+        self.assertTrue(seen.add('A'))
+        self.assertFalse(seen.add('A'))
+        self.assertIn('A', seen)
+        self.assertNotIn('B', seen)
+
+        reg_ids = [generate_reg_id() for _ in range(1000)]
+        self.assertIsNone(seen.filter(reg_ids))
+        self.assertEqual(len(seen), 1001)
+        self.assertTrue(all(reg_id in seen for reg_id in reg_ids))
+        self.assertEqual(seen._table.itemsize, 8)
+        self.assertTrue(len(seen._table) <= 4 * len(seen))
+
+    def test_filter(self):
+        seen = fcmclient.TokenSet()
+        self.assertEqual(seen.filter(['A', 'B', 'A', 'C', 'B']),
+                         ['A', 'B', 'C'])
+        self.assertEqual(seen.filter(['D', 'A']), ['D'])
+        self.assertIsNone(seen.filter_message(fcmclient.JSONMessage(['C'])))
+
+    def test_send_many(self):
+        server = fcmclient.testing.FakeFCMServer(record=True)
+        self.addCleanup(server.stop)
+        cache = fcmclient.TokenCache()
+        cache.add_canonical('B', 'C')
+        fcm = fcmclient.FCM(generate_api_key(), url=server.url,
+                            token_cache=cache)
+        message = fcmclient.JSONMessage(['A', 'B', 'C', 'A', 'D'])
+        res = fcm.send_many(message, chunk_size=2, dedupe=True)
+        self.assertEqual(res.message.registration_ids, ['A', 'C', 'D'])
+        self.assertEqual(server.token_count, 3)
+
+    def test_iter_send(self):
+        server = fcmclient.testing.FakeFCMServer()
+        self.addCleanup(server.stop)
+        fcm = fcmclient.FCM(generate_api_key(), url=server.url)
+        seen = fcmclient.TokenSet()
+        tokens = [str(i % 150) for i in range(500)]
+        results = list(fcm.iter_send(
+            fcmclient.JSONMessage.stream(tokens, chunk_size=100),
+            dedupe=seen))
+        self.assertEqual(len(results), 2)
+        self.assertEqual(server.token_count, 150)
+        results = list(fcm.iter_send([fcmclient.JSONMessage(['1', 'new'])],
+                                     dedupe=seen))
+        self.assertEqual(results[0].message.registration_ids, ['new'])
+
+
+class TopicMessageTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.fcm = fcmclient.FCM(generate_api_key())
+
+    def send(self, message, **kwargs):
+        with requests_mock.Mocker() as m:
+            m.post(fcmclient.api.FCM_URL, **kwargs)
+            res = self.fcm.send(message)
+            if m.called:
+                self.assertEqual(m.last_request.json(), message.payload)
+            return res
+
+    def test_message(self):
+        message = fcmclient.TopicMessage('news', data={'foo': 'bar'},
+                                         time_to_live=60)
+        self.assertEqual(message.payload, {
+            'to': '/topics/news', 'data': {'foo': 'bar'},
+            'time_to_live': 60})
+        self.assertEqual(message.topic, '/topics/news')
+        self.assertEqual(fcmclient.TopicMessage('/topics/news').topic,
+                         '/topics/news')
+        self.assertEqual(len(message.registration_ids), 0)
+        self.assertEqual(list(message.split(1000)), [message])
+
+        condition = "'dogs' in topics || 'cats' in topics"
+        message = fcmclient.TopicMessage(condition=condition)
+        self.assertEqual(message.payload, {'condition': condition})
+
+        self.assertRaises(ValueError, fcmclient.TopicMessage)
+        self.assertRaises(ValueError, fcmclient.TopicMessage,
+                          'news', condition=condition)
+        self.assertRaises(ValueError, fcmclient.TopicMessage, 'no news')
+
+        copy = pickle.loads(pickle.dumps(message))
+        self.assertEqual(copy.condition, condition)
+
+    def test_success(self):
+        message = fcmclient.TopicMessage('news')
+        res = self.send(message, json={'message_id': 6177433633397011933})
+        self.assertIsInstance(res, fcmclient.TopicResult)
+        self.assertEqual(res.message_id, 6177433633397011933)
+        self.assertIsNone(res.error_code)
+        self.assertEqual(res.success_count, 1)
+        self.assertEqual(res.failure_count, 0)
+        self.assertEqual(res.success, {})
+        self.assertFalse(res.needs_retry())
+
+    def test_error(self):
+        message = fcmclient.TopicMessage('news')
+        res = self.send(message, json={'error': 'TopicsMessageRateExceeded'})
+        self.assertEqual(res.error_code, 'TopicsMessageRateExceeded')
+        self.assertEqual(res.failure_count, 1)
+        self.assertEqual(res.error_counts, {'TopicsMessageRateExceeded': 1})
+        self.assertTrue(res.needs_retry())
+        self.assertIs(res.retry(), message)
+
+        res = self.send(message, json={'error': 'InvalidParameters'})
+        self.assertFalse(res.needs_retry())
+
+    def test_server_error(self):
+        message = fcmclient.TopicMessage('news')
+        res = self.send(message, status_code=503,
+                        headers={'Retry-After': '10'})
+        self.assertIsInstance(res, fcmclient.TopicResult)
+        self.assertIs(res.retry(), message)
+        self.assertEqual(res.delay(), 10)
+
+        self.fcm.breaker = fcmclient.CircuitBreaker(failure_threshold=1)
+        self.send(message, status_code=503)
+        res = self.fcm._send_chunk(message)
+        self.assertIsInstance(res.error, fcmclient.CircuitOpenError)
+        self.assertIs(res.retry(), message)
+
+    def test_retry_scheduler(self):
+        scheduler = fcmclient.RetryScheduler(self.fcm, clock=lambda: 0)
+        for _ in range(2):
+            # identical topic messages are not merged
+            scheduler.add(self.send(fcmclient.TopicMessage('news'),
+                                    status_code=503,
+                                    headers={'Retry-After': '1'}))
+        self.assertEqual(len(scheduler.pop_due(now=1)), 2)
+
+
+class RetrySchedulerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0.0
+        self.fcm = fcmclient.FCM(generate_api_key(), backoff=1000)
+        self.handled = []
+        self.given_up = []
+        self.scheduler = fcmclient.RetryScheduler(
+            self.fcm, max_attempts=2, clock=lambda: self.now,
+            on_result=lambda res, n: self.handled.append((res, n)),
+            on_give_up=lambda res, n: self.given_up.append((res, n)))
+
+    def unavailable(self, reg_ids, **headers):
+        message = fcmclient.JSONMessage(reg_ids)
+        req = requests_mock.adapter._RequestObjectProxy._create(
+            'post', fcmclient.api.FCM_URL, {})
+        response = requests_mock.create_response(
+            req, status_code=503, headers=headers)
+        return fcmclient.Result(message, response, 1000)
+
+    def test_order(self):
+        self.scheduler.add(self.unavailable(['A'], **{'Retry-After': '30'}))
+        self.scheduler.add(self.unavailable(['B'], **{'Retry-After': '10'}))
+        self.scheduler.add(self.unavailable(['C'], **{'Retry-After': '20'}))
+        self.assertEqual(len(self.scheduler), 3)
+        self.assertEqual(self.scheduler.next_due(), 10)
+        self.assertEqual(self.scheduler.pop_due(5), [])
+        self.scheduler.coalesce = False
+        due = self.scheduler.pop_due(25)
+        self.assertEqual([(msg.registration_ids, n) for msg, n in due],
+                         [(['B'], 0), (['C'], 0)])
+        self.assertEqual(len(self.scheduler), 1)
+
+    def test_coalesce(self):
+        self.scheduler.add(self.unavailable(['A']), attempt=1)
+        self.scheduler.add(self.unavailable(['B']))
+        self.scheduler.add(self.unavailable(['C']))
+        due = self.scheduler.pop_due(100)
+        self.assertEqual([(sorted(msg.registration_ids), n)
+                          for msg, n in due],
+                         [(['A', 'B', 'C'], 1)])
+
+    def test_backoff(self):
+        self.scheduler.add(self.unavailable(['A']), attempt=1)
+        # backoff 1000ms << 1 with random shift of +-500ms
+        self.assertTrue(1.5 <= self.scheduler.next_due() < 2.5)
+
+    def test_nothing_to_retry(self):
+        message = fcmclient.JSONMessage(['A'])
+        result = fcmclient.Result(message, None, 1000)
+        result._retry_message = None
+        self.assertFalse(self.scheduler.add(result))
+        self.assertEqual(len(self.scheduler), 0)
+
+    def test_send_due(self):
+        self.scheduler.add(self.unavailable(['A', 'B']))
+        self.assertEqual(self.scheduler.send_due(), 0)
+        with requests_mock.Mocker() as m:
+            m.post(fcmclient.api.FCM_URL, [
+                {'json': {"multicast_id": 1, "results": [
+                    {"message_id": "1:0"}, {"error": "Unavailable"}]}},
+                {'status_code': 500},
+                {'status_code': 500},
+            ])
+            self.now = 100
+            self.assertEqual(self.scheduler.send_due(), 1)
+            self.assertEqual(self.handled[-1][0].success, {'A': '1:0'})
+            self.assertEqual(len(self.scheduler), 1)
+
+            self.now = 200
+            self.assertEqual(self.scheduler.send_due(), 1)
+            self.assertEqual(len(self.scheduler), 0)
+
+        self.assertEqual([n for _, n in self.handled], [0, 1])
+        self.assertEqual(len(self.given_up), 1)
+        res, attempt = self.given_up[0]
+        self.assertEqual(attempt, 2)
+        self.assertEqual(res.retry().registration_ids, ['B'])
+
+    def test_start(self):
+        done = threading.Event()
+        self.fcm.backoff = 1
+        scheduler = fcmclient.RetryScheduler(
+            self.fcm, on_result=lambda res, n: done.set())
+        with requests_mock.Mocker() as m:
+            m.post(fcmclient.api.FCM_URL, json={
+                "multicast_id": 1, "results": [{"message_id": "1:0"}]})
+            with scheduler:
+                scheduler.add(self.unavailable(['A'], **{'Retry-After': '0'}))
+                self.assertTrue(done.wait(5))
+        self.assertEqual(len(scheduler), 0)
+
+
+class CampaignTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = fcmclient.testing.FakeFCMServer(
+            errors={'NotRegistered': 0.1, 'Unavailable': 0.1},
+            canonical_rate=0.1, seed=1)
+        self.addCleanup(self.server.stop)
+
+    def campaign(self, **kwargs):
+        kwargs.setdefault('url', self.server.url)
+        return fcmclient.Campaign('key', processes=2, chunk_size=100,
+                                  backoff=1, **kwargs)
+
+    def test_send(self):
+        reg_ids = ['t%d' % i for i in range(3000)]
+        report = self.campaign().send(iter(reg_ids), data={'n': 1})
+        self.assertEqual(report.token_count, 3000)
+        self.assertTrue(2500 < report.success_count < 3000)
+        self.assertEqual(report.failure_count,
+                         sum(report.errors.values()) + report.gave_up_count)
+        self.assertEqual(len(report.dead), report.errors['NotRegistered'])
+        self.assertEqual(len(set(report.dead)), len(report.dead))
+        self.assertTrue(set(report.dead) <= set(reg_ids))
+        self.assertTrue(0 < len(report.canonical) < 3000)
+        self.assertTrue(report.retry_count > 0)
+        self.assertEqual(self.server.token_count, 3000 + report.retry_count)
+        self.assertTrue(report.tokens_per_second > 0)
+
+    def test_iter_send(self):
+        reports = list(self.campaign().iter_send(
+            ('t%d' % i for i in range(500)), data={'n': 1}))
+        self.assertTrue(len(reports) >= 5)
+        self.assertEqual(sum(r.token_count for r in reports), 500)
+        self.assertTrue(all(r.elapsed is None for r in reports))
+
+    def test_worker_error(self):
+        self.server.api_key = 'other'
+        self.assertRaises(fcmclient.FCMAuthenticationError,
+                          self.campaign().send, ['A', 'B'])
+
+    def test_source_error(self):
+        def registration_ids():
+            yield 'A'
+            raise IOError('cursor closed')
+
+        self.assertRaises(IOError, self.campaign().send, registration_ids())
+
+    def test_report(self):
+        report = fcmclient.CampaignReport()
+        report.success_count = 3
+        report.failure_count = 2
+        report.errors = {'NotRegistered': 1, 'MismatchSenderId': 1}
+        report.canonical = {'A': 'AA'}
+        report.dead = ['B', 'C']
+        copy = fcmclient.CampaignReport._loads(
+            pickle.loads(pickle.dumps(report._dumps())))
+        copy.merge(fcmclient.CampaignReport())
+        self.assertEqual(copy.token_count, 5)
+        self.assertEqual(copy.errors, report.errors)
+        self.assertEqual(copy.canonical, {'A': 'AA'})
+        self.assertEqual(copy.dead, ['B', 'C'])
+        self.assertEqual(fcmclient.CampaignReport._loads(
+            fcmclient.CampaignReport()._dumps()).dead, [])
+
+
+@unittest.skipIf(asyncio is None, "aiohttp is not installed")
+class AsyncFCMTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = LocalFCMServer()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.api_key = generate_api_key()
+        self.fcm = fcmclient.aio.AsyncFCM(
+            self.api_key, url=self.server.url, pool_size=4)
+
+    def tearDown(self):
+        self.loop.run_until_complete(self.fcm.close())
+        self.loop.close()
+        asyncio.set_event_loop(None)
+        self.server.stop()
+
+    def test_send(self):
+        message = fcmclient.JSONMessage(['A', 'B'], {'foo': 'bar'})
+        res = self.loop.run_until_complete(self.fcm.send(message))
+        self.assertIsInstance(res, fcmclient.Result)
+        self.assertEqual(res.success, {'A': '1:A', 'B': '1:B'})
+        self.assertFalse(res.needs_retry())
+
+        headers, payload = self.server.requests[0]
+        self.assertEqual(headers['Authorization'], 'key=%s' % self.api_key)
+        self.assertEqual(payload, message.payload)
+
+    def test_compress(self):
+        self.server.compress_responses = True
+        fcm = fcmclient.aio.AsyncFCM(self.api_key, url=self.server.url,
+                                     compress_threshold=0)
+        res = self.loop.run_until_complete(
+            fcm.send(fcmclient.JSONMessage(['A', 'B'])))
+        self.loop.run_until_complete(fcm.close())
+        self.assertEqual(res.success, {'A': '1:A', 'B': '1:B'})
+        headers, payload = self.server.requests[0]
+        self.assertEqual(headers['Content-Encoding'], 'gzip')
+        self.assertEqual(payload['registration_ids'], ['A', 'B'])
+
+    def test_send_concurrent(self):
+        messages = [fcmclient.JSONMessage([str(i)]) for i in range(50)]
+        results = self.loop.run_until_complete(asyncio.gather(
+            *[self.fcm.send(msg) for msg in messages]))
+        self.assertEqual([list(res.success) for res in results],
+                         [[str(i)] for i in range(50)])
+
+    def test_send_many(self):
+        reg_ids = [str(i) for i in range(2500)]
+        message = fcmclient.JSONMessage(reg_ids)
+        res = self.loop.run_until_complete(self.fcm.send_many(message))
+        self.assertIsInstance(res, fcmclient.BulkResult)
+        self.assertEqual(len(res.success), 2500)
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_iter_send(self):
+        messages = fcmclient.JSONMessage.stream(
+            (str(i) for i in range(2500)), chunk_size=500)
+        agen = self.fcm.iter_send(messages)
+        results = []
+        while True:
+            try:
+                results.append(self.loop.run_until_complete(agen.__anext__()))
+            except StopAsyncIteration:
+                break
+        self.assertEqual(len(results), 5)
+        self.assertEqual(sum(len(res.success) for res in results), 2500)
+
+    def test_limiter(self):
+        limiter = fcmclient.AdaptiveLimiter(
+            initial=2, max_limit=4, latency_tolerance=None)
+        self.fcm.limiter = limiter
+        reg_ids = [str(i) for i in range(100)]
+        res = self.loop.run_until_complete(
+            self.fcm.send_many(fcmclient.JSONMessage(reg_ids), chunk_size=5))
+        self.assertEqual(len(res.success), 100)
+        self.assertEqual(limiter.in_flight, 0)
+        self.assertTrue(limiter.limit > 2)
+
+    def test_observers(self):
+        events = []
+        self.fcm.observers.append(events.append)
+        self.server.errors = [('NotRegistered', 1.0)]
+        message = fcmclient.JSONMessage(['A', 'B'])
+        res = self.loop.run_until_complete(self.fcm.send(message))
+        event, = events
+        self.assertEqual(event.status_code, 200)
+        self.assertEqual(event.success_count, 0)
+        self.assertEqual(sorted(event.timings), [
+            'decode', 'encode', 'limiter', 'read', 'request', 'total'])
+        self.assertEqual(res.not_registered, ['A', 'B'])
+        self.assertEqual(len(events), 1)
+
+    def test_retry_scheduler(self):
+        message = fcmclient.JSONMessage(['A', 'B'])
+        unavailable = fcmclient.Result(message, None, 1)
+        handled = []
+
+        def on_result(res, attempt):
+            handled.append(res)
+            scheduler.stop()
+
+        scheduler = fcmclient.aio.AsyncRetryScheduler(
+            self.fcm, on_result=on_result)
+        scheduler.add(unavailable)
+        self.loop.run_until_complete(
+            asyncio.wait_for(scheduler.run(), 5))
+        self.assertEqual(handled[0].success, {'A': '1:A', 'B': '1:B'})
+
+    def test_send_many_network_error(self):
+        self.server.stop()
+        message = fcmclient.JSONMessage(['A', 'B', 'C'])
+        res = self.loop.run_until_complete(
+            self.fcm.send_many(message, chunk_size=2))
+        self.assertEqual(len(res.errors), 2)
+        self.assertEqual(sorted(res.retry().registration_ids),
+                         ['A', 'B', 'C'])
+
+
 class JsonMessageTestCase(unittest.TestCase):
     """ API tests. """
 
@@ -154,6 +2031,30 @@ class JsonMessageTestCase(unittest.TestCase):
         self.assertEqual(pmsg.options, msg.options)
         self.assertEqual(pmsg.data, msg.data)
 
+    def test_template(self):
+        msg = fcmclient.JSONMessage(
+            ['A', 'B', 'C'], {'str': u'\u00e9', 'int': 90},
+            message_title='title', time_to_live=90, template=True)
+        self.assertEqual(json.loads(msg.encode().decode('utf-8')),
+                         msg.payload)
+
+        chunks = list(msg.split(2))
+        retry = chunks[1]._retry(['C'])
+        for chunk in chunks + [retry]:
+            self.assertIs(chunk._template, msg._template)
+            self.assertEqual(json.loads(chunk.encode().decode('utf-8')),
+                             chunk.payload)
+
+        self.assertIs(msg.encode(), msg.encode())
+
+        plain = fcmclient.JSONMessage(['A'], payload={}, template=True)
+        self.assertEqual(plain.encode(), b'{"registration_ids":["A"]}')
+
+        # pickled messages fall back to encoding the whole payload
+        pmsg = pickle.loads(pickle.dumps(msg))
+        self.assertEqual(json.loads(pmsg.encode().decode('utf-8')),
+                         msg.payload)
+
 
 if __name__ == '__main__':
     unittest.main()